@@ -1,34 +1,47 @@
-export LD_LIBRARY_PATH=.:$LD_LIBRARY_PATH
-
-logonmgr.py "$@"
-
----------------------------------------------------------
-
 #!/usr/bin/env python
 ######################################################################################
 # logonmgr - Logon Manager for ETL environment
 # Maintenance Log
 #
-# logonmgr [-f/ile logonfilename] <command> <args>
+# logonmgr [-timing] [-f/ile logonfilename] <command> <args>
 #               [-version]
 #
 #       commands:
 #
 #       add <connection_name> <keywords>
+#       batch [-n] < commands
 #       create_ts <connection_name>
 #       create_userid <connection_name>
 #       database <connection_name>
 #       dbms <connection_name>
 #       dboptions <connection_name>
 #       delete <connection_name>
-#       export <connection_name|all>
+#       export [-j <n>] [<connection_name>|<pattern>|all|--prefix <prefix> [field1 field2 ...]]
+#       get [-format shell|json|nul] [-attrs attr1,attr2,...] <connection_name>[:attr1,attr2,...] ...
 #       help
 #       help-commands
 #       info
 #       last_updt_ts <connection_name>
 #       last_updt_userid <connection_name>
-#       list
-#       load_from_textfile filename
+#       list [<pattern>|--prefix <prefix>] [--limit <n>] [--after <connection_name>]
+#       load_from_textfile [-j <n>] filename
+#       bulk_add [-j <n>] filename
+#       import_logons [-j <n>] [-full] dbaccess|adwlogons
+#       query <attr1=value1> [<attr2=value2> ...]
+#       reindex
+#       compile
+#       stats [-space]
+#       compact [-in-place]
+#       convert sqlite|gdbm
+#       journal [prune <seq>]
+#       replay <source> [--since <seq>]
+#       sync [-pull] [-dry-run] [-prefer local|remote|newer] <other logons file>
+#       diff [-audit] <other logons file>|-export <export file>
+#       migrate-envelope [-j <n>]
+#       migrate-legacy [-j <n>] <old logons.db>
+#       rotate-keys [-j <n>] [-bits <bits>]
+#       upgrade [-n]
+#       serve [socket_path]
 #       server <connection_name>
 #       set <connection_name> <attribute> <value>
 #       show <connection_name>
@@ -58,8 +71,10 @@ logonmgr.py "$@"
 #       database <connection_name>
 #        Retrieves database attribute for connection name
 #
-#       list No arguments
-#        Lists entries in logonmgr
+#       list [<pattern>|--prefix <prefix>] [--limit <n>] [--after <connection_name>]
+#        Lists entries in logonmgr in name order: all of them, those matching a glob pattern (e.g. 'td_*')
+#        or those starting with prefix. --limit and --after page through the names n at a time.
+#        Names come from a sorted name index, so listing a namespace costs time in proportion to the result
 #
 #       update <connection_name> <attr1=value1 [<attr2=value2> ...]
 #        Updates one or more attributes for a logonmgr entry
@@ -76,48 +91,229 @@ logonmgr.py "$@"
 #       add <connection_name> <keywords>
 #        Adds an entry to logonmgr
 #
-#       export <connection_name>
-#        Exports a logonmgr entry in add format
+#       batch [-n] < commands
+#        Runs add, set, update, delete and rm-options command lines read from stdin (a leading logonmgr,
+#        shell quoting and # comments are allowed) with one open of the logons file and one write lock,
+#        as one transaction: the changes are committed together if every line succeeds and rolled back
+#        otherwise, and the result of each line is shown. The records being replaced are kept in
+#        <logons file>.undo until the commit, so the next writer rolls back a batch that was killed
+#        halfway. -n rolls back in any case
+#
+#       export [-j <n>] [<connection_name>|<pattern>|all|--prefix <prefix> [field1 field2 ...]]
+#        Exports a logonmgr entry, the entries matching a glob pattern or starting with prefix, or all
+#        entries in pipe-delimited format, or just the given fields.
+#        Passwords are decrypted by <n> worker processes; records are written in connection name order
 #
 #       dboptions <connection_name>
 #        Retrieves dboptions attribute for connection name
 #
 #       info
-#        Shows logonmgr version, number of entries, last date modified.
+#        Shows logonmgr version, number of entries, entries without a password, last date modified.
 #
 #       last_updt_userid <connection_name>
 #        Retrieves last_updt_userid audit trail attribute for connection name
 #
-#       load_from_textfile filename
+#       load_from_textfile [-j <n>] filename
 #        Loads logonmgr datastore with entries exported via the export command. Expects same field order as in export command
+#        Passwords are encrypted by <n> worker processes (default $LOGONMGR_JOBS or number of cpus)
+#
+#       import_logons [-j <n>] [-full] dbaccess|adwlogons
+#        Imports the logons in $HOME/dbaccess or in the $ADWCMNDIR/td/env/*logon.dat files. The size,
+#        mtime and content digest of every source are kept in the logons file, so a re-import reads
+#        only the files that changed and parses, encrypts (in <n> worker processes) and writes only the
+#        logons whose content changed. -full imports every logon again
+#
+#       bulk_add [-j <n>] filename
+#        Adds the entries in a file of add command arguments, one entry per line. Existing entries are rejected
 #
 #       create_userid <connection_name>
 #        Retrieves create_userid audit trail attribute for connection name
 #
 #       delete <connection_name>
 #        Removes a logonmgr entry
+#
+#       get [-format shell|json|nul] [-attrs attr1,attr2,...] <connection_name>[:attr1,attr2,...] ...
+#        Retrieves several attributes of several entries with one open of the logons file
+#        (default userid,password). Passwords are decrypted only when asked for.
+#        eval "$(logonmgr get tdprod db2prod:userid,password,database)" sets
+#        TDPROD_USERID, TDPROD_PASSWORD, DB2PROD_USERID, ... in the calling shell. Characters of the
+#        names other than letters, digits and _ become _ and a name starting with a digit gets a _
+#        prefix (td-prod.1 -> TD_PROD_1_USERID, 2prod -> _2PROD_USERID); names that still come out
+#        the same are reported and left out. -format json leaves out, and reports, entries with values
+#        that are not UTF-8 text, which -format nul returns as they are
+#
+#       query <attr1=value1> [<attr2=value2> ...]
+#        Shows the entries matching all of the given attribute values. Uses the secondary
+#        indexes on userid, server, dbms, database, create_userid and last_updt_userid
+#
+#       reindex
+#        Rebuilds the secondary indexes and the sorted name index. Needed once for logons files
+#        created before indexing. Query looks up values with % or | in them by reading every entry
+#        on a file indexed by an older logonmgr, which did not escape them in its index keys,
+#        until reindex has rebuilt its indexes
+#
+#       migrate-envelope [-j <n>]
+#        Switches to envelope encryption: passwords are encrypted with a random data key that is
+#        itself encrypted with the RSA key pair, so decrypting many passwords costs one RSA
+#        operation. Re-encrypts existing passwords in place; old and new records are both readable
+#
+#       migrate-legacy [-j <n>] <old logons.db>
+#        Copies the entries of an old shelve logons file, audit attributes included, reading it in
+#        this process. A logons file without entries takes over the old eiw_ctl keys, so passwords
+#        are copied still encrypted; otherwise they are re-encrypted with this file's keys by <n>
+#        worker processes and entries this file already has are left alone. A new logons.gdbm
+#        created next to a logons.db does this on its own
+#
+#       rotate-keys [-j <n>] [-bits <bits>]
+#        Generates a new eiw_ctl key pair (default 512 bits) and data key and re-encrypts every password with
+#        them in <n> worker processes, committing every 500 entries so readers and writers only wait briefly.
+#        Until it finishes, passwords are read with the new or the old keys; the old ones are then removed.
+#        Progress is kept in the logons file, so an interrupted rotation resumes where it stopped when
+#        rotate-keys is run again. Leaves the file in envelope mode. Replicas follow it through replay
+#
+#       compile
+#        Writes <logons file>.snap, an immutable memory mapped hash table of the logons file records.
+#        Read commands use it instead of opening the logons file for as long as the logons file is
+#        unchanged, so concurrent readers share the page cache and take no lock. Changes are told by
+#        the size, mtime and inode of the logons file and by the write generation writers count in
+#        <logons file>.gen, which catches rewrites of the same size within the mtime resolution.
+#        Run it again after changes; set LOGONMGR_NO_SNAPSHOT to ignore the snapshot
+#
+#       stats [-space]
+#        Shows the number of entries per dbms and per server, the entries without a password and the
+#        newest last_updt_ts, from a record the writers keep current (run reindex to build it on a file
+#        indexed by an older logonmgr). -space reads the whole file instead to show its size against the
+#        live data (keys and records), the gdbm bucket layout and free list, and the space used by
+#        neither records nor buckets, most of which compact gives back
+#
+#       compact [-in-place]
+#        Rewrites the logons file without the space gdbm leaves behind when entries are updated or
+#        deleted. The records are copied to <logons file>.compact under the shared lock, so readers are
+#        not held up, and the copy is renamed over the file under the write lock. -in-place has gdbm
+#        reorganize the file while holding the write lock. An up to date snapshot is compiled again.
+#        An SQLite logons file is vacuumed instead
+#
+#       convert sqlite|gdbm
+#        Moves the logons file to the SQLite or the gdbm backend, copying it to <logons file>.convert
+#        while readers carry on and renaming the copy over it under the write lock, like compact.
+#        An SQLite logons file has a table column per attribute, indexed for query, and runs in WAL
+#        mode: readers never wait for the writer and see the last commit, writers take turns. Commands
+#        tell the backends apart by the file contents; $LOGONMGR_BACKEND=sqlite makes new logons files
+#        SQLite. Readers need write access to the directory for the -wal and -shm files SQLite keeps
+#        next to the logons file. SQLite files keep the entry statistics in the meta table, like gdbm
+#        files; run reindex to build them on one converted by an older logonmgr
+#
+#       journal [prune <seq>]
+#        Every committed change is appended to <logons file>.journal/ with a sequence number.
+#        Shows the journal segments and the last sequence number, or removes the segments that hold
+#        only changes before <seq>. $LOGONMGR_JOURNAL_SEGMENT sets the segment size (default 16MB).
+#        $LOGONMGR_NO_JOURNAL turns journaling off, for files that are not replicated: changes made
+#        with it set are never replayed on other hosts
+#
+#       replay <source> [--since <seq>]
+#        Applies the changes journaled by the logons file <source> (or a copy of its journal directory)
+#        after <seq>, so other hosts' stores are updated in time proportional to the changes. Without
+#        --since replay continues after the last change replayed from the same source. The stores must
+#        share the eiw_ctl keys; a new or empty store takes them over from the journal
+#
+#       sync [-pull] [-dry-run] [-prefer local|remote|newer] <other logons file>
+#        Synchronizes this logons file (e.g. -l, the host-local copy) with another (e.g. the central
+#        store). The record hashes found at the last sync are kept in this file, so only the entries
+#        changed on either side since then are transferred, with their passwords re-encrypted when
+#        the files have different keys. An entry changed on both sides is a conflict (exit status 1)
+#        unless -prefer says which side wins. The first sync copies entries found on one side only
+#        and settles the others by last_updt_ts. -pull leaves the other file unchanged
+#
+#       diff [-audit] <other logons file>|-export <export file>
+#        Compares this logons file with another (e.g. QA against prod before a promotion) or with a
+#        file written by export, reading both in connection name order rather than all at once.
+#        Prints - for entries only in this file, + for those only in the other and ~ with the fields
+#        that differ. Equal records are not decoded and passwords are decrypted only where their
+#        ciphertexts differ (every password of an entry in an export file, which holds plaintext);
+#        passwords are never shown. -audit compares the audit trail attributes too. Exits with
+#        status 1 if there are differences
+#
+#       upgrade [-n]
+#        Rewrites the entries in the compact record format (a version byte and a marshalled tuple
+#        with timestamps in microseconds) instead of pickled objects, and reports the record sizes
+#        and decoding times before and after. -n only reports. New logons files use the compact
+#        format from the start; files that have not been upgraded stay readable by older versions
+#
+#       serve [socket_path]
+#        Runs a resident lookup daemon on a Unix socket. Read commands issued while it is
+#        running are answered by the daemon instead of opening the logons file. The socket
+#        is only accessible to the user running the daemon. Commands are answered one at a time.
+#
+# Python API:
+#       import logonmgr
+#       with logonmgr.LogonStore(path) as store:
+#               entry = store.get('tdprod')
+#               password = store.decrypt_password(entry)
+#        LogonStore also offers get_many, query, add, update and delete. Open it with flag='w'
+#        to make changes. The commands above are thin wrappers over it.
+# Locking:
+#       Readers share and writers take exclusively a lock on <logons file>.lock. Writers hold it only
+#       while committing, so a deploy running update makes batch jobs wait briefly instead of failing.
+#       A waiting writer holds back new readers. Waits are retried with backoff for up to
+#       $LOGONMGR_LOCK_TIMEOUT seconds (default 60) before logonmgr exits with status 4, and waits of
+#       $LOGONMGR_LOCK_REPORT seconds (default 1) or more are reported on stderr.
+# Timing:
+#       -timing or $LOGONMGR_TIMING writes the wall time of each phase of the run (startup, imports,
+#       options, daemon, open, lock_wait, keys, rsa, command, close) to stderr as one JSON line when
+#       logonmgr exits. $LOGONMGR_METRICS_FILE adds every run to a Prometheus textfile (for the node
+#       exporter textfile collector): a duration histogram and run counts by command and exit status,
+#       and seconds by command and phase. Without these, nothing is measured.
+# Host-local cache:
+#       With $LOGONMGR_CACHE_DIR set, read commands use a snapshot of the logons file compiled into that
+#       directory (e.g. on local disk while the logons file is on NFS) instead of the logons file. Each
+#       run checks it against the size, mtime and inode of the logons file and the write generation in
+#       <logons file>.gen, one stat and one small read, and compiles it again, one process at a time,
+#       when the logons file changed; a reader that waits more than $LOGONMGR_CACHE_WAIT seconds
+#       (default 5) for another one compiling it reads the logons file instead. The new copy is renamed
+#       into place, so readers see the old or the new one whole. Write commands always use the logons
+#       file itself. The copy holds the keys, like the logons file, and gets its permissions: use a
+#       cache directory per user. Reading the .gen file makes NFS clients revalidate it, so a change
+#       shows on the next run even where the attribute cache still holds the old size and mtime
 # Third party vendor modules - rsa, xml.dom.ext (These must be installed in
 # target environments)
 
 
-import shelve, sys, os, rsa, types, datetime, time, commands
+import sys, os, types, datetime, time
+import cPickle, cStringIO, marshal, re, struct
 import exceptions
-import glob, stat, pydoc
-import anydbm
-anydbm._defaultmod = __import__('gdbm') #       'gdbm' type for anydbm causes the db to be created in a non-proprietary format of Linux file type 'data' rather than SQLite 3.x or Berkeley DB
+import stat
+module_started = time.time()
+# rsa, gdbm, pydoc and the modules used by the lookup daemon, its client and the worker
+# pools are imported by the functions that need them: a plain lookup like list or userid
+# should not pay for importing the crypto library or building help text.
 
 #Initialize global variables
 dbpath = None
-eiw_ctl = None
-db = None
+store = None            # LogonStore the commands work on
+worker_keys = None      # KeyRing of a parallel_map worker process
+serving = False         # True in the lookup daemon, which answers commands in process
 status = 0
 version = "logonmgr Version 5"
+timings = None          # Timings of this run when -timing or $LOGONMGR_TIMING is given
 
 cmds = {}
 command_help = {}
 
+# prefix of passwords encrypted with the data key of an envelope mode logons file
+envelope_magic = '\x00ENV1'
+
 valid_attrs =   ['name','userid','password','server','dbms','database','dboptions']
 
+# attributes with a secondary index (attribute value -> connection names) for the query command
+index_attrs = ['userid','server','dbms','database','create_userid','last_updt_userid']
+
+served_cmds = ['userid','password','server','dbms','database','dboptions','show','query','export',
+                'create_userid','create_ts','last_updt_userid','last_updt_ts','get']
+
+# attributes the get command can retrieve
+getter_attrs = ['name','userid','password','server','dbms','database','dboptions',
+                'create_userid','create_ts','last_updt_userid','last_updt_ts']
+
 class CommandHelp(object):
         def __init__(self,cmd=None,args=None,desc=None):
                 self.cmd = cmd
@@ -130,9 +326,43 @@ class CommandHelp(object):
 
 class ConnectionEntryError(exceptions.Exception):
         def __init__(self,args=None):
-                self.args = args
+                exceptions.Exception.__init__(self,args)
+
+# version byte that starts a compact entry record. Pickles never start with it, so entries
+# written before the upgrade command are still read, through unpickle
+record_version = '\x01'
+
+# ConnectionEntry attributes in compact record order
+entry_fields = ['name','userid','password','server','dbms','database','dboptions',
+                'create_ts','last_updt_ts','create_userid','last_updt_userid']
+
+def timestamp_now():
+        """ local time in integer microseconds since the epoch, as the audit timestamps are kept """
+        return int(time.time() * 1000000)
+
+def parse_timestamp(value):
+        """ microseconds of a str(datetime) audit timestamp from an old record; other values are kept as they are """
+        if type(value) != types.StringType:
+                return value
+        try:
+                seconds, dot, micro = value.partition('.')
+                us = int(time.mktime(time.strptime(seconds,'%Y-%m-%d %H:%M:%S'))) * 1000000 + int(micro.ljust(6,'0'))
+        except ValueError:
+                return value
+        if format_timestamp(us) != value:       # e.g. a time skipped by a daylight saving change
+                return value
+        return us
+
+def format_timestamp(value):
+        """ audit timestamp rendered as str(datetime.datetime.now()) used to store it """
+        if type(value) in (types.IntType, types.LongType):
+                return str(datetime.datetime.fromtimestamp(value // 1000000).replace(microsecond=value % 1000000))
+        return value
 
 class ConnectionEntry(object):
+        __slots__ = ['name','userid','password','server','dbms','database','dboptions',
+                     '_create_ts','_last_updt_ts','create_userid','last_updt_userid']
+
         def __init__(self,name=None,userid=None,password=None,server=None,database=None,dbms=None,dboptions=None,attr_dict=None):
                 """
                         Constructor
@@ -144,8 +374,8 @@ class ConnectionEntry(object):
                 self.server = server
                 self.dbms = dbms
                 self.database = database
-                self.create_ts = str(datetime.datetime.now())
-                self.last_updt_ts = str(datetime.datetime.now())
+                self.create_ts = timestamp_now()
+                self.last_updt_ts = self.create_ts
                 self.create_userid = os.environ['USER']
                 self.last_updt_userid = os.environ['USER']
 
@@ -160,23 +390,72 @@ class ConnectionEntry(object):
                 if attr_dict == None:
                         pass
                 else:
-                        self.__dict__.update(attr_dict)
+                        self.update_attrs(attr_dict)
+
+        def _get_create_ts(self):
+                return format_timestamp(self._create_ts)
+
+        def _set_create_ts(self,value):
+                self._create_ts = parse_timestamp(value)
+
+        def _get_last_updt_ts(self):
+                return format_timestamp(self._last_updt_ts)
+
+        def _set_last_updt_ts(self,value):
+                self._last_updt_ts = parse_timestamp(value)
+
+        # audit timestamps are kept in microseconds and read as strings
+        create_ts = property(_get_create_ts,_set_create_ts)
+        last_updt_ts = property(_get_last_updt_ts,_set_last_updt_ts)
+
+        def value(self,attr):
+                """ value of an attribute by name, None for attributes the entry does not have """
+                if attr not in entry_fields:
+                        return None
+                return object.__getattribute__(self,attr)
+
+        def update_attrs(self,attr_dict):
+                """ sets attributes from a dictionary; keys that are not entry attributes are ignored """
+                for (key,value) in attr_dict.items():
+                        if key in entry_fields:
+                                object.__setattr__(self,key,value)
+
+        def record(self):
+                """ attribute values in entry_fields order, timestamps in microseconds """
+                return (self.name, self.userid, self.password, self.server, self.dbms, self.database, self.dboptions,
+                        self._create_ts, self._last_updt_ts, self.create_userid, self.last_updt_userid)
 
+        @classmethod
+        def from_record(cls,record):
+                entry = cls.__new__(cls)
+                entry.__setstate__(record)
+                return entry
+
+        def __getstate__(self):
+                """
+                        the attribute dictionary, timestamps as strings, as older versions pickled entries:
+                        they read it back into the __dict__ of their ConnectionEntry
+                """
+                state = {}
+                for field in entry_fields:
+                        state[field] = self.value(field)
+                return state
+
+        def __setstate__(self,state):
+                """ state is a record tuple, or the attribute dictionary of an entry pickled by older versions """
+                if type(state) == types.DictType:
+                        for field in entry_fields:
+                                object.__setattr__(self,field,None)
+                        self.update_attrs(state)
+                else:
+                        (self.name, self.userid, self.password, self.server, self.dbms, self.database, self.dboptions,
+                         self._create_ts, self._last_updt_ts, self.create_userid, self.last_updt_userid) = state
 
         def toDict(self):
                 """ Converts Connection object to a dictionary object """
                 d = {}
-                d['name'] = self.name
-                d['userid'] = self.userid
-                d['password'] = self.password
-                d['server'] = self.server
-                d['dbms'] = self.dbms
-                d['dboptions'] = self.dboptions
-                d['database'] = self.database
-                d['create_ts'] = self.create_ts
-                d['last_updt_ts'] = self.last_updt_ts
-                d['create_userid'] = self.create_userid
-                d['last_updt_userid'] = self.last_updt_userid
+                for field in entry_fields:
+                        d[field] = self.value(field)
                 d['type'] = 'connection'
                 return d
 
@@ -187,26 +466,2638 @@ class ConnectionEntry(object):
                 """
                 s = '{'
                 for field in ['name','userid']:
-                        s += field + ":" + str(self.__dict__.get(field,None)) + ","
+                        s += field + ":" + str(self.value(field)) + ","
                 if self.password:
                         s += "password:[encrypted],"
                 else:
                         s += "password:None,"
                 for field in ['server','dbms','dboptions','database','create_ts','last_updt_ts','create_userid','last_updt_userid']:
-                        s += field + ":" + str(self.__dict__.get(field,None)) + ","
+                        s += field + ":" + str(self.value(field)) + ","
                 s += '}'
                 return s
 
-def list(args):
+def find_global(module,name):
         """
-                list keys of Connection entries
+                Entries written by the logonmgr script are pickled as __main__.ConnectionEntry.
+                Resolve them (and logonmgr.ConnectionEntry) to this module's class so a logons
+                file can be read whether logonmgr runs as a script or is imported.
         """
-        keys = sorted(db.keys())
-        for key in keys:
-                if key == 'eiw_ctl':
-                        pass
+        if name == 'ConnectionEntry' and module in ('__main__','logonmgr'):
+                return ConnectionEntry
+        __import__(module)
+        return sys.modules[module].__dict__[name]
+
+def unpickle(data):
+        unpickler = cPickle.Unpickler(cStringIO.StringIO(data))
+        unpickler.find_global = find_global
+        return unpickler.load()
+
+def encode_entry(entry):
+        """ compact record of an entry: the version byte and the marshalled record tuple """
+        try:
+                return record_version + marshal.dumps(entry.record())
+        except ValueError:
+                # dboptions holding values marshal cannot write are still pickled
+                return cPickle.dumps(entry,-1)
+
+def decode_record(data):
+        """ value of a stored record, compact entry or pickle """
+        if data[:1] == record_version:
+                return ConnectionEntry.from_record(marshal.loads(data[1:]))
+        return unpickle(data)
+
+def hmac_modules():
+        """ hmac and the sha256 constructor, imported on first use: only the commands that
+            encrypt or decrypt passwords pay for loading them """
+        import hmac, hashlib
+        return (hmac, hashlib.sha256)
+
+def envelope_subkeys(key):
+        """ cipher and mac keys derived from a data key """
+        (hmac, sha256) = hmac_modules()
+        return (hmac.new(key,'enc',sha256).digest(), hmac.new(key,'mac',sha256).digest())
+
+def envelope_stream(enc_key,nonce,length):
+        """ keystream of HMAC-SHA256(enc_key, nonce + counter) blocks """
+        (hmac, sha256) = hmac_modules()
+        blocks = []
+        for counter in xrange((length + 31) // 32):
+                blocks.append(hmac.new(enc_key,nonce + struct.pack('>I',counter),sha256).digest())
+        return ''.join(blocks)[:length]
+
+def envelope_encrypt(keys,plaintext):
+        """ magic + nonce + ciphertext + truncated HMAC-SHA256 tag over all of it """
+        (hmac, sha256) = hmac_modules()
+        (enc_key, mac_key) = keys
+        nonce = os.urandom(16)
+        stream = envelope_stream(enc_key,nonce,len(plaintext))
+        body = ''.join([chr(ord(a) ^ ord(b)) for (a,b) in zip(plaintext,stream)])
+        record = envelope_magic + nonce + body
+        return record + hmac.new(mac_key,record,sha256).digest()[:16]
+
+def envelope_decrypt(keys,ciphertext):
+        (hmac, sha256) = hmac_modules()
+        (enc_key, mac_key) = keys
+        record, tag = ciphertext[:-16], ciphertext[-16:]
+        if not hmac.compare_digest(hmac.new(mac_key,record,sha256).digest()[:16],tag):
+                raise ValueError, "password record failed integrity check"
+        nonce, body = record[len(envelope_magic):len(envelope_magic) + 16], record[len(envelope_magic) + 16:]
+        stream = envelope_stream(enc_key,nonce,len(body))
+        return ''.join([chr(ord(a) ^ ord(b)) for (a,b) in zip(body,stream)])
+
+def is_envelope(ciphertext):
+        return ciphertext.startswith(envelope_magic)
+
+def is_internal_key(key):
+        """ True for keys that hold logonmgr bookkeeping (keys, indexes) rather than connection entries """
+        return key == 'eiw_ctl' or key.startswith('__')
+
+def key_part(value):
+        """ value with % and | escaped, so a value cannot run into the parts of a key that follow it """
+        return ('%s' % value).replace('%','%25').replace('|','%7C')
+
+def index_key(attr,value):
+        """ key of the root record of the secondary index of the connection names with attr == value """
+        return '__idx__|%s|%s' % (attr, key_part(value))
+
+# marker record of an indexed file; reindex and new files store index_marker in it, older versions
+# stored index_attrs and did not escape the values in index keys, see RecordBackend.query
+index_marker = (index_attrs, 'escaped')
+
+# root record of the sorted connection name index: (next page number, [(first name, page number), ...]).
+# The names themselves are kept in sorted pages of up to 2 * name_page_size names, split when full.
+# The secondary index records are roots of pages of the same kind
+names_key = '__names__'
+# entry statistics kept current by the writers for info and stats: see index_changes
+stats_key = '__stats__'
+name_page_size = 512
+
+def page_key(root,page):
+        """ key of a page of names under the root record at root """
+        return '%s|%d' % (root, page)
+
+def glob_prefix(pattern):
+        """ the literal start of a glob pattern, which every name it matches starts with """
+        m = re.search(r'[*?\[]',pattern)
+        if m is None:
+                return pattern
+        return pattern[:m.start()]
+
+def empty_stats():
+        return {'entries' : 0, 'no_password' : 0, 'dbms' : {}, 'server' : {}, 'last_updt_ts' : None}
+
+def index_changes(entry,sign,batch):
+        """
+                record in batch that entry's names are added (sign 1) to or removed (sign -1) from its index records,
+                and how it changes the entry statistics
+        """
+        delta = batch.setdefault(stats_key,empty_stats())
+        delta['entries'] += sign
+        if entry.password is None:
+                delta['no_password'] += sign
+        for attr in ('dbms','server'):
+                value = entry.value(attr)
+                delta[attr][value] = delta[attr].get(value,0) + sign
+        if sign > 0 and entry.last_updt_ts is not None:
+                delta['last_updt_ts'] = max(delta['last_updt_ts'],entry.last_updt_ts)
+        adds, removes = batch.setdefault(names_key,(set(),set()))
+        if sign > 0:
+                removes.discard(entry.name)
+                adds.add(entry.name)
+        else:
+                adds.discard(entry.name)
+                removes.add(entry.name)
+        for attr in index_attrs:
+                value = entry.value(attr)
+                if value is None:
+                        continue
+                adds, removes = batch.setdefault(index_key(attr,value),(set(),set()))
+                if sign > 0:
+                        removes.discard(entry.name)
+                        adds.add(entry.name)
+                else:
+                        adds.discard(entry.name)
+                        removes.add(entry.name)
+
+def new_entry(keys,attrs):
+        """ ConnectionEntry from an attribute dictionary holding a plaintext password """
+        attrs = dict(attrs)
+        if attrs.get('password',None) is not None:
+                attrs['password'] = keys.encrypt(attrs['password'])
+        return ConnectionEntry(attr_dict=attrs)
+
+class KeyRing(object):
+        """
+                The eiw_ctl RSA key pair and, for envelope mode logons files, the data key it wraps.
+                Picklable, so it can be handed to worker processes. During a key rotation previous
+                is the KeyRing of the old keys, which decrypts the passwords not yet re-encrypted.
+        """
+        def __init__(self,eiw_ctl,wrapped_data_key=None,previous=None):
+                self.eiw_ctl = eiw_ctl
+                self.wrapped_data_key = wrapped_data_key
+                self.data_key = None
+                self.previous = previous
+
+        def envelope_keys(self):
+                """
+                        Unwraps the data key on first use. This is the only RSA operation needed
+                        to read any number of envelope records.
+                """
+                if self.data_key is None and self.wrapped_data_key is not None:
+                        with timed('rsa'):
+                                import rsa
+                                self.data_key = envelope_subkeys(rsa.decrypt(self.wrapped_data_key,self.eiw_ctl[1]))
+                return self.data_key
+
+        def encrypt(self,plaintext):
+                """
+                        Encrypts a password for storage. Logons files that have been migrated to envelope
+                        mode use the data key, all others encrypt directly with the eiw_ctl public key
+                """
+                keys = self.envelope_keys()
+                if keys is None:
+                        with timed('rsa'):
+                                import rsa
+                                return rsa.encrypt(plaintext,self.eiw_ctl[0])
+                return envelope_encrypt(keys,plaintext)
+
+        def decrypt(self,ciphertext):
+                """ Decrypts a stored password, whichever mode (and, during a key rotation, keys) it was written with """
+                if is_envelope(ciphertext):
+                        try:
+                                return envelope_decrypt(self.envelope_keys(),ciphertext)
+                        except ValueError:
+                                if self.previous is None:
+                                        raise
+                                return self.previous.decrypt(ciphertext)
+                if self.previous is not None:
+                        # a rotation always creates a data key, so only the old keys encrypted with RSA directly
+                        return self.previous.decrypt(ciphertext)
+                with timed('rsa'):
+                        import rsa
+                        return rsa.decrypt(ciphertext,self.eiw_ctl[1])
+
+        def is_current(self,ciphertext):
+                """ True if ciphertext was encrypted with this key ring's data key """
+                if not is_envelope(ciphertext) or self.envelope_keys() is None:
+                        return False
+                try:
+                        envelope_decrypt(self.envelope_keys(),ciphertext)
+                except ValueError:
+                        return False
+                return True
+
+# compiled snapshot file: header, hash table of (crc32 of key, record offset) slots, records of
+# (key length, value length, key, value), then the NUL separated sorted connection names
+class RecordBackend(object):
+        """
+                Backend of a logons file kept as records in a dbm style mapping: entries are encoded records
+                under their connection names, the keys, secondary indexes, name index and statistics are
+                pickles under internal keys, kept current by LogonStore. The gdbm file and the snapshot
+                are record backends, and so is the in-memory copy served by the daemon.
+                Backends offer get, record, put, delete, has_key, iter_keys, names, iter_names, query,
+                stats, space and compact, so LogonStore works on any of them alike.
+        """
+        name = 'gdbm'
+        index_records = True            # LogonStore keeps the index records (SQLite indexes its columns itself)
+        compacts_in_place = False       # compact copies the file rather than have it reorganized under the lock
+
+        def __init__(self,db,path=None):
+                self.db = db
+                self.path = path
+
+        def record(self,key):
+                """ stored record of key, None if there is none """
+                try:
+                        return self.db[key]
+                except KeyError:
+                        return None
+
+        def get(self,key,default=None):
+                """ ConnectionEntry, or bookkeeping value, stored under key """
+                data = self.record(key)
+                if data is None:
+                        return default
+                return decode_record(data)
+
+        def put(self,key,data,value=None):
+                """ stores the record data, the encoding of value, under key """
+                self.db[key] = data
+
+        def delete(self,key):
+                del self.db[key]
+
+        def has_key(self,key):
+                return self.db.has_key(key)
+
+        def keys(self):
+                return self.db.keys()
+
+        def iter_keys(self):
+                return iter(self.keys())
+
+        def names(self):
+                """ sorted connection names """
+                return [name for name in self.iter_names('')]
+
+        def iter_names(self,start=''):
+                """ sorted connection names from the first one not before start, read from the name index pages """
+                import bisect
+                root = self.get(names_key)
+                if root is None:
+                        for name in sorted([key for key in self.keys() if not is_internal_key(key) and key >= start]):
+                                yield name
+                        return
+                (next_page, pages) = root
+                i = max(bisect.bisect_right([first for (first, page) in pages],start) - 1, 0)
+                for (first, page) in pages[i:]:
+                        names = self.get(page_key(names_key,page),[])
+                        for name in names[bisect.bisect_left(names,start):]:
+                                yield name
+
+        def query(self,criteria):
+                """
+                        Names of the candidates for criteria from the secondary indexes of its index_attrs and name,
+                        the other criteria are left to the caller. None if the file has no indexes or criteria none of these.
+                """
+                if not self.has_key('__idx__'):
+                        return None
+                escaped = self.get('__idx__') == index_marker
+                names = None
+                for (attr, value) in criteria.items():
+                        if attr == 'name':
+                                found = set([value])
+                        elif attr in index_attrs:
+                                if not escaped and key_part(value) != value:
+                                        continue        # indexed by an older version under a key that may collide
+                                found = self.index_names(index_key(attr,value))
+                        else:
+                                continue
+                        names = found if names is None else names & found
+                if names is None:
+                        return None
+                return sorted(names)
+
+        def index_names(self,key):
+                """ set of the connection names in the pages of the secondary index record at key """
+                root = self.get(key)
+                if not root:
+                        return set()
+                if isinstance(root,set):
+                        return root     # written by an older logonmgr, paged once it changes
+                names = set()
+                for (first, page) in root[1]:
+                        names.update(self.get(page_key(key,page),[]))
+                return names
+
+        def stats(self):
+                return self.get(stats_key)
+
+        def space(self,stats):
+                """ adds how the backend uses its file to the space statistics of LogonStore.space """
+                return stats
+
+        def begin(self):
+                """ nothing to start: LogonStore holds the write lock of a record backend """
+                return True
+
+        def commit(self):
+                self.sync()
+
+        def compact(self):
+                pass
+
+        def sync(self):
+                pass
+
+        def close(self):
+                pass
+
+class GdbmBackend(RecordBackend):
+        """ a gdbm logons file """
+        def __init__(self,path,flag='r',mode=0666):
+                import gdbm
+                RecordBackend.__init__(self,gdbm.open(path,flag,mode),path)
+
+        def iter_keys(self):
+                key = self.db.firstkey()
+                while key is not None:
+                        yield key
+                        key = self.db.nextkey(key)
+
+        def space(self,stats):
+                """ the gdbm_header layout and the bytes used by neither records nor buckets nor directory (unused) """
+                header = gdbm_header(self.path)
+                if header is not None:
+                        stats.update(header)
+                        needed = header['block_size'] + header['dir_size'] + header['buckets'] * header['bucket_size'] + stats['live_bytes']
+                        stats['unused'] = max(stats['file_bytes'] - needed,0)
+                return stats
+
+        def compact(self):
+                """ has gdbm reorganize the file in place, which needs the write lock """
+                self.db.reorganize()
+
+        def sync(self):
+                self.db.sync()
+
+        def close(self):
+                self.db.close()
+
+snapshot_magic = 'LMSNAP02'
+snapshot_header = struct.Struct('<8sdQQQIIQQ')  # magic, source mtime, size, inode, write generation, slots, records, names offset, names length
+snapshot_slot = struct.Struct('<IQ')
+snapshot_record = struct.Struct('<II')
+
+class Snapshot(RecordBackend):
+        """
+                Read-only record backend over a snapshot compiled from a logons file. The file is memory
+                mapped, so lookups read the page cache shared by all readers and need no lock.
+        """
+        def __init__(self,path):
+                import mmap
+                self.path = path
+                f = open(path,'rb')
+                try:
+                        self.map = mmap.mmap(f.fileno(),0,access=mmap.ACCESS_READ)
+                finally:
+                        f.close()
+                (magic, mtime, size, ino, generation, self.slots, self.records, self.names_offset, self.names_length) = snapshot_header.unpack_from(self.map,0)
+                if magic != snapshot_magic:
+                        self.map.close()
+                        raise ValueError, "%s is not a logonmgr snapshot" % path
+                self.signature = (mtime, size, ino, generation)
+
+        def _record(self,offset):
+                (key_length, value_length) = snapshot_record.unpack_from(self.map,offset)
+                start = offset + snapshot_record.size
+                return (self.map[start:start + key_length], start + key_length, value_length)
+
+        def _find(self,key):
+                import zlib
+                h = zlib.crc32(key) & 0xffffffff
+                mask = self.slots - 1
+                i = h & mask
+                while True:
+                        (slot_hash, offset) = snapshot_slot.unpack_from(self.map,snapshot_header.size + i * snapshot_slot.size)
+                        if offset == 0:
+                                return None
+                        if slot_hash == h:
+                                (record_key, start, length) = self._record(offset)
+                                if record_key == key:
+                                        return self.map[start:start + length]
+                        i = (i + 1) & mask
+
+        def record(self,key):
+                return self._find(key)
+
+        def has_key(self,key):
+                return self._find(key) is not None
+
+        def keys(self):
+                keys = []
+                for i in xrange(self.slots):
+                        (slot_hash, offset) = snapshot_slot.unpack_from(self.map,snapshot_header.size + i * snapshot_slot.size)
+                        if offset:
+                                keys.append(self._record(offset)[0])
+                return keys
+
+        def names(self):
+                """ sorted connection names, stored ready made """
+                if not self.names_length:
+                        return []
+                return self.map[self.names_offset:self.names_offset + self.names_length].split('\0')
+
+        def iter_names(self,start=''):
+                """ sorted connection names from the first one not before start, found by binary search """
+                (begin, end) = (self.names_offset, self.names_offset + self.names_length)
+                (lo, hi) = (begin, end)
+                while lo < hi:
+                        mid = (lo + hi) // 2
+                        name_start = self.map.rfind('\0',begin,mid) + 1 or begin
+                        name_end = self.map.find('\0',name_start,end)
+                        if name_end < 0:
+                                name_end = end
+                        if self.map[name_start:name_end] < start:
+                                lo = name_end + 1
+                        else:
+                                hi = name_start
+                while lo < end:
+                        name_end = self.map.find('\0',lo,end)
+                        if name_end < 0:
+                                name_end = end
+                        yield self.map[lo:name_end]
+                        lo = name_end + 1
+
+        def close(self):
+                self.map.close()
+
+def snapshot_path(path):
+        return path + '.snap'
+
+def open_snapshot(path,snapshot_file=None):
+        """
+                Snapshot of the logons file at path (in snapshot_file, by default <path>.snap) if one has
+                been compiled since the file last changed, otherwise None. $LOGONMGR_NO_SNAPSHOT turns
+                snapshots off.
+        """
+        if os.environ.get('LOGONMGR_NO_SNAPSHOT'):
+                return None
+        try:
+                snapshot = Snapshot(snapshot_file or snapshot_path(path))
+        except (EnvironmentError, ValueError, struct.error):
+                return None
+        try:
+                fresh = snapshot.signature == store_signature(path)
+        except OSError:
+                fresh = False
+        if not fresh:
+                snapshot.close()
+                return None
+        return snapshot
+
+def cache_path(path):
+        """ the host-local snapshot of the logons file at path under $LOGONMGR_CACHE_DIR, None without a cache """
+        cache_dir = os.environ.get('LOGONMGR_CACHE_DIR')
+        if not cache_dir or os.environ.get('LOGONMGR_NO_SNAPSHOT'):
+                return None
+        return os.path.join(cache_dir,os.path.realpath(path).strip('/').replace('/','%') + '.snap')
+
+def open_cache(path):
+        """
+                Snapshot of the logons file at path from the host-local cache, compiled there first if the
+                file changed since, or None if there is no cache or it cannot be written. Processes
+                finding the cache stale take turns on its lock file, so one compiles and the rest use it;
+                those kept waiting longer than $LOGONMGR_CACHE_WAIT seconds get None too.
+        """
+        cached = cache_path(path)
+        if cached is None:
+                return None
+        snapshot = open_snapshot(path,cached)
+        if snapshot is not None:
+                return snapshot
+        try:
+                if not os.path.isdir(os.path.dirname(cached)):
+                        os.makedirs(os.path.dirname(cached),0700)
+                lock = StoreLock(cached)
+                try:
+                        lock.acquire(True,float(os.environ.get('LOGONMGR_CACHE_WAIT',5)))
+                        if lock.held is None:   # no lock file in the cache directory
+                                return None
+                        snapshot = open_snapshot(path,cached)   # compiled while this process waited
+                        if snapshot is None:
+                                source = LogonStore(path,'r',snapshot=False)
+                                try:
+                                        source.compile(cached)
+                                finally:
+                                        source.close()
+                                snapshot = open_snapshot(path,cached)
+                finally:
+                        lock.close()
+        except (EnvironmentError, LockTimeout):
+                return None
+        return snapshot
+
+# gdbm file header magic numbers and the format of the start of the header in files that use them:
+# magic, block size, directory offset, directory size, directory bits, bucket size, bucket elements,
+# next free block, then the header free list: size, count, next free list block and count (size, offset) pairs
+gdbm_headers = {0x13579acf : ('Iiqiiiiqiiq', 'i4xq'),         # 64 bit offsets
+                0x13579acd : ('Iiiiiiiiiii', 'ii'),           # 32 bit offsets
+                0x13579ace : struct.calcsize('P') == 8 and ('Iiqiiiiqiiq', 'i4xq') or ('Iiiiiiiiiii', 'ii')}   # gdbm 1.8, native offsets
+
+def gdbm_header(path):
+        """
+                Layout of a gdbm file from its header and directory: block_size, dir_size, dir_entries, dir_bits, buckets,
+                bucket_size, bucket_elems, free_blocks and free_bytes (of the free list kept in the header).
+                None for files gdbm wrote in another format, and for files that are not gdbm files.
+        """
+        try:
+                f = open(path,'rb')
+        except IOError:
+                return None
+        try:
+                try:
+                        head = f.read(4)
+                        for order in '<>':
+                                formats = gdbm_headers.get(struct.unpack(order + 'I',head)[0])
+                                if formats is not None:
+                                        break
+                        else:
+                                return None
+                        (fields, elem) = (struct.Struct(order + formats[0]), struct.Struct(order + formats[1]))
+                        f.seek(0)
+                        head = f.read(fields.size)
+                        (magic, block_size, dir_offset, dir_size, dir_bits, bucket_size, bucket_elems,
+                                next_block, avail_size, avail_count, avail_next) = fields.unpack(head)
+                        if not 0 <= avail_count <= avail_size or dir_offset + dir_size > os.path.getsize(path):
+                                return None
+                        free = f.read(avail_count * elem.size)
+                        free_bytes = sum([elem.unpack_from(free,i * elem.size)[0] for i in xrange(avail_count)])
+                        f.seek(dir_offset)
+                        offset = struct.Struct(order + formats[0][2])
+                        directory = f.read(dir_size)
+                        buckets = len(set([offset.unpack_from(directory,i) for i in xrange(0,len(directory) - offset.size + 1,offset.size)]))
+                except (struct.error, IOError, OSError):
+                        return None
+        finally:
+                f.close()
+        return {'block_size' : block_size, 'dir_size' : dir_size, 'dir_entries' : dir_size // offset.size, 'dir_bits' : dir_bits, 'buckets' : buckets,
+                'bucket_size' : bucket_size, 'bucket_elems' : bucket_elems,
+                'free_blocks' : avail_count, 'free_bytes' : free_bytes}
+
+class LockTimeout(ConnectionEntryError):
+        pass
+
+# an SQLite logons file starts with the SQLite header string; anything else is opened with gdbm
+sqlite_magic = 'SQLite format 3\0'
+
+# entry attributes that are text columns of the entries table, which SqliteBackend.query can match in SQL
+sqlite_text_columns = ['name','userid','server','dbms','database','create_userid','last_updt_userid']
+
+def is_sqlite_file(path):
+        try:
+                f = open(path,'rb')
+        except IOError:
+                return False
+        try:
+                return f.read(len(sqlite_magic)) == sqlite_magic
+        finally:
+                f.close()
+
+def encode_dboptions(dboptions):
+        """ dboptions column value: marshalled, or pickled when marshal cannot write the values """
+        if dboptions is None:
+                return None
+        try:
+                return marshal.dumps(dboptions)
+        except ValueError:
+                return cPickle.dumps(dboptions,-1)
+
+def decode_dboptions(data):
+        if data is None:
+                return None
+        data = str(data)
+        if data[:1] == '\x80':          # pickle protocol 2 and up; marshalled dictionaries start with {
+                return unpickle(data)
+        return marshal.loads(data)
+
+class SqliteBackend(object):
+        """
+                Backend of an SQLite logons file in WAL mode, offering what RecordBackend does. Entries are
+                rows of the entries table, with a column per attribute (the index_attrs ones indexed) and
+                dboptions serialized, read into ConnectionEntry objects directly; the keys and other
+                bookkeeping records are rows of the meta table. Records are encoded as on gdbm only for
+                the journal, the snapshot and sync. Reads see the last commit and never wait for a
+                writer; a read-only handle reads in one transaction, so a command sees one state.
+                Writers take turns through BEGIN IMMEDIATE, waiting up to $LOGONMGR_LOCK_TIMEOUT seconds.
+        """
+        name = 'sqlite'
+        index_records = False
+        compacts_in_place = True        # VACUUM lets readers carry on
+
+        def __init__(self,path,read_only=False):
+                import sqlite3
+                self.path = path
+                self.conn = sqlite3.connect(path,timeout=lock_timeout(),isolation_level=None)
+                self.conn.text_factory = str
+                self.inode = os.stat(path).st_ino
+                self.in_transaction = False
+                if not self.conn.execute("SELECT 1 FROM sqlite_master WHERE name = 'entries'").fetchone():
+                        self._create()
+                if read_only:
+                        self.conn.execute('BEGIN')
+                        self.in_transaction = True
+
+        def _create(self):
+                columns = ['name TEXT PRIMARY KEY','userid TEXT','password BLOB','server TEXT','dbms TEXT','database TEXT',
+                        'dboptions BLOB','create_ts INTEGER','last_updt_ts INTEGER','create_userid TEXT','last_updt_userid TEXT']
+                self.conn.execute('PRAGMA journal_mode=WAL')
+                self.conn.execute('BEGIN IMMEDIATE')
+                self.conn.execute('CREATE TABLE IF NOT EXISTS entries (%s)' % ', '.join(columns))
+                for attr in index_attrs:
+                        self.conn.execute('CREATE INDEX IF NOT EXISTS entries_%s ON entries (%s)' % (attr, attr))
+                self.conn.execute('CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value BLOB)')
+                self.conn.execute('COMMIT')
+
+        def begin(self):
+                """
+                        Starts a write transaction, raising LockTimeout if other writers keep the file too long.
+                        Returns False, without a transaction, if the file has been replaced since it was opened.
+                """
+                import sqlite3
+                if self.in_transaction:
+                        self.conn.execute('COMMIT')
+                try:
+                        self.conn.execute('BEGIN IMMEDIATE')
+                except sqlite3.OperationalError, e:
+                        self.in_transaction = False
+                        raise LockTimeout("%s: %s" % (self.path, e))
+                self.in_transaction = True
+                if os.stat(self.path).st_ino != self.inode:
+                        self.commit()
+                        return False
+                return True
+
+        def commit(self):
+                if self.in_transaction:
+                        self.conn.execute('COMMIT')
+                        self.in_transaction = False
+
+        def _entry(self,row):
+                entry = ConnectionEntry.from_record(row[:2] + (row[2] is not None and str(row[2]) or None,) + row[3:6] +
+                        (decode_dboptions(row[6]),) + row[7:])
+                return entry
+
+        def get(self,key,default=None):
+                if is_internal_key(key):
+                        row = self.conn.execute('SELECT value FROM meta WHERE key = ?',(key,)).fetchone()
+                        if row is None:
+                                return default
+                        return decode_record(str(row[0]))
+                row = self.conn.execute('SELECT * FROM entries WHERE name = ?',(key,)).fetchone()
+                if row is None:
+                        return default
+                return self._entry(row)
+
+        def record(self,key):
+                if is_internal_key(key):
+                        row = self.conn.execute('SELECT value FROM meta WHERE key = ?',(key,)).fetchone()
+                        return row is not None and str(row[0]) or None
+                entry = self.get(key)
+                return entry is not None and encode_entry(entry) or None
+
+        def put(self,key,data,value=None):
+                import sqlite3
+                if is_internal_key(key):
+                        self.conn.execute('INSERT OR REPLACE INTO meta VALUES (?, ?)',(key, sqlite3.Binary(data)))
+                        return
+                if value is None:
+                        value = decode_record(data)
+                record = value.record()
+                password = record[2] is not None and sqlite3.Binary(record[2]) or None
+                self.conn.execute('INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                        (key,) + record[1:2] + (password,) + record[3:6] + (encode_dboptions(record[6]),) + record[7:])
+
+        def delete(self,key):
+                if is_internal_key(key):
+                        cursor = self.conn.execute('DELETE FROM meta WHERE key = ?',(key,))
+                else:
+                        cursor = self.conn.execute('DELETE FROM entries WHERE name = ?',(key,))
+                if cursor.rowcount == 0:
+                        raise KeyError(key)
+
+        def has_key(self,key):
+                if is_internal_key(key):
+                        return self.conn.execute('SELECT 1 FROM meta WHERE key = ?',(key,)).fetchone() is not None
+                return self.conn.execute('SELECT 1 FROM entries WHERE name = ?',(key,)).fetchone() is not None
+
+        def keys(self):
+                return self.names() + [row[0] for row in self.conn.execute('SELECT key FROM meta')]
+
+        def iter_keys(self):
+                return iter(self.keys())
+
+        def names(self):
+                """ sorted connection names """
+                return [row[0] for row in self.conn.execute('SELECT name FROM entries ORDER BY name')]
+
+        def iter_names(self,start=''):
+                """ sorted connection names from the first one not before start, read through the primary key """
+                for row in self.conn.execute('SELECT name FROM entries WHERE name >= ? ORDER BY name',(start,)):
+                        yield row[0]
+
+        def query(self,criteria):
+                """ sorted names of the entries whose text columns equal the criteria on them; other criteria are left to the caller """
+                where = [(attr, value) for (attr, value) in sorted(criteria.items()) if attr in sqlite_text_columns]
+                sql = 'SELECT name FROM entries'
+                if where:
+                        sql = sql + ' WHERE ' + ' AND '.join(['%s = ?' % attr for (attr, value) in where])
+                return [row[0] for row in self.conn.execute(sql + ' ORDER BY name',[value for (attr, value) in where])]
+
+        def stats(self):
+                """ the statistics record of the meta table, kept current by LogonStore as on gdbm """
+                return self.get(stats_key)
+
+        def space(self,stats):
+                """ page_size, pages and free_pages of the file, and the free pages as unused """
+                for (key, pragma) in (('page_size','page_size'), ('pages','page_count'), ('free_pages','freelist_count')):
+                        stats[key] = self.conn.execute('PRAGMA %s' % pragma).fetchone()[0]
+                stats['unused'] = stats['free_pages'] * stats['page_size']
+                return stats
+
+        def compact(self):
+                """ rewrites the file without its free pages; waits for the writers like begin does """
+                self.commit()
+                self.conn.execute('VACUUM')
+                self.conn.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+
+        def sync(self):
+                pass
+
+        def close(self):
+                self.commit()
+                self.conn.close()
+
+def lock_timeout():
+        """ seconds to wait for the logons file lock, $LOGONMGR_LOCK_TIMEOUT (default 60) """
+        return float(os.environ.get('LOGONMGR_LOCK_TIMEOUT',60))
+
+def backoff(delay,deadline):
+        """ sleeps for about delay seconds, but not past deadline, and returns the next (doubled, capped) delay """
+        import random
+        time.sleep(max(min(delay * random.uniform(0.5,1.0),deadline - time.time()),0))
+        return min(delay * 2,0.25)
+
+class StoreLock(object):
+        """
+                Reader/writer lock of a logons file, kept with POSIX record locks on <logons file>.lock.
+                Byte 1 is held shared by readers and exclusively by a writer. Byte 0 is a gate: a writer
+                holds it while it waits, so new readers queue behind the writer instead of starving it.
+                Waits are bounded by lock_timeout() and retried with backoff; waits of
+                $LOGONMGR_LOCK_REPORT seconds (default 1) or more are reported on stderr.
+                POSIX locks belong to the process, so two LogonStores on one file in one process
+                do not exclude each other.
+        """
+        def __init__(self,path):
+                self.path = path + '.lock'
+                self.fd = None
+                self.writable = False
+                self.held = None        # None, 'read' or 'write'
+                self.waited = 0.0       # total seconds spent waiting
+
+        def _open(self):
+                if self.fd is not None:
+                        return
+                try:
+                        self.fd = os.open(self.path,os.O_RDWR | os.O_CREAT,0644)
+                        self.writable = True
+                except OSError:
+                        try:
+                                self.fd = os.open(self.path,os.O_RDONLY) # readers can share-lock a file they cannot write
+                        except OSError:
+                                self.fd = None # no lock file and no permission to create one: run unlocked as before
+
+        def _lock(self,operation,byte,start,deadline,what):
+                import fcntl, errno
+                delay = 0.005
+                while True:
+                        try:
+                                fcntl.lockf(self.fd,operation | fcntl.LOCK_NB,1,byte)
+                                return
+                        except IOError, e:
+                                if e.errno not in (errno.EACCES,errno.EAGAIN):
+                                        raise
+                        if time.time() >= deadline:
+                                raise LockTimeout("timed out after %.1fs waiting for the %s lock on %s" % (time.time() - start, what, self.path))
+                        delay = backoff(delay,deadline)
+
+        def acquire(self,write=False,timeout=None):
+                """ takes the lock, waiting up to timeout seconds (lock_timeout() by default) """
+                import fcntl
+                self._open()
+                if self.fd is None or (write and not self.writable):
+                        return
+                what = write and 'write' or 'read'
+                start = time.time()
+                if timeout is None:
+                        timeout = lock_timeout()
+                deadline = start + timeout
+                if write:
+                        self._lock(fcntl.LOCK_EX,0,start,deadline,what)
+                        try:
+                                self._lock(fcntl.LOCK_EX,1,start,deadline,what)
+                        finally:
+                                fcntl.lockf(self.fd,fcntl.LOCK_UN,1,0)
+                else:
+                        self._lock(fcntl.LOCK_SH,0,start,deadline,what)
+                        fcntl.lockf(self.fd,fcntl.LOCK_UN,1,0)
+                        self._lock(fcntl.LOCK_SH,1,start,deadline,what)
+                self.held = what
+                waited = time.time() - start
+                self.waited += waited
+                if waited >= float(os.environ.get('LOGONMGR_LOCK_REPORT',1)):
+                        sys.stderr.write("logonmgr: waited %.3fs for the %s lock on %s\n" % (waited, what, self.path))
+
+        def release(self):
+                import fcntl
+                if self.held is not None:
+                        fcntl.lockf(self.fd,fcntl.LOCK_UN,1,1)
+                        self.held = None
+
+        def close(self):
+                self.release()
+                if self.fd is not None:
+                        os.close(self.fd)
+                        self.fd = None
+
+# bookkeeping records replicas need to decrypt the entries, journaled with operation 'key':
+# the key pair, the data key and, during a key rotation, the old ones. An empty record removes the key
+journal_keys = ['eiw_ctl','__datakey__','__oldkeys__']
+
+def drop_torn_tail(path):
+        """ cuts the file at path back to its last newline, if a write was torn after it """
+        if not os.path.exists(path):
+                return
+        f = open(path,'r+b')
+        try:
+                f.seek(0,2)
+                end = f.tell()
+                good = end
+                while good > 0:
+                        start = max(good - 65536,0)
+                        f.seek(start)
+                        newline = f.read(good - start).rfind('\n')
+                        if newline >= 0:
+                                good = start + newline + 1
+                                break
+                        good = start
+                if good < end:
+                        f.truncate(good)
+                        f.flush()
+                        os.fsync(f.fileno())
+        finally:
+                f.close()
+
+def open_journal(path):
+        """ the Journal of the logons file at path, None when $LOGONMGR_NO_JOURNAL turns journaling off """
+        if os.environ.get('LOGONMGR_NO_JOURNAL'):
+                return None
+        return Journal(path + '.journal')
+
+class Journal(object):
+        """
+                Append-only journal of the changes committed to a logons file, kept in segment files
+                <logons file>.journal/<first sequence number>.log. Each change is one line of tab separated
+                sequence number, timestamp (microseconds), operation (put, delete or key), key and
+                base64 stored record. A new segment is started once the current one reaches
+                $LOGONMGR_JOURNAL_SEGMENT bytes (default 16MB). Changes are numbered under the write lock
+                as they are made and written by commit, which the store calls once the changes are durable
+                in the logons file: the journal never holds a change the file lost in a crash (one the file
+                kept but the journal lost is caught by sync). A line without its newline (a torn write) is ignored,
+                and cut off before the next change is written after it; read skips lines that do not parse.
+        """
+        def __init__(self,path):
+                self.path = path
+                self.file = None
+                self.seq = None
+                self.size = 0
+                self.pending = []       # (sequence number, line) appended but not written yet
+
+        def segments(self):
+                """ (first sequence number, path) of the segment files, oldest first """
+                try:
+                        files = os.listdir(self.path)
+                except OSError:
+                        return []
+                return sorted([(int(f[:-4]),os.path.join(self.path,f)) for f in files if f.endswith('.log') and f[:-4].isdigit()])
+
+        def last_seq(self):
+                """ sequence number of the last complete change, 0 for an empty journal """
+                segments = self.segments()
+                while segments:
+                        (first, path) = segments.pop()
+                        f = open(path,'rb')
+                        try:
+                                f.seek(0,2)
+                                start = max(f.tell() - 65536,0)
+                                f.seek(start)
+                                lines = f.read().split('\n')[:-1]     # drop the unterminated tail
+                        finally:
+                                f.close()
+                        if start > 0:
+                                lines = lines[1:]       # may start mid line
+                        for line in reversed(lines):
+                                if line.count('\t') == 4:
+                                        return int(line.split('\t',1)[0])
+                return 0
+
+        def _open(self):
+                if not os.path.isdir(self.path):
+                        os.mkdir(self.path,0700)
+                self.seq = self.last_seq()
+                segments = self.segments()
+                if segments:
+                        self._open_segment(segments[-1][1])
+                else:
+                        self._open_segment(os.path.join(self.path,'%012d.log' % (self.seq + 1)))
+
+        def _open_segment(self,path):
+                if self.file is not None:
+                        self.file.flush()
+                        os.fsync(self.file.fileno())
+                        self.file.close()
+                drop_torn_tail(path)
+                self.file = open(path,'ab')
+                self.size = self.file.tell()
+
+        def append(self,op,key,record):
+                """ numbers a change for the next commit, returns its sequence number """
+                import binascii
+                if self.seq is None:
+                        self._open()
+                self.seq += 1
+                line = '%d\t%d\t%s\t%s\t%s\n' % (self.seq, timestamp_now(), op, key, binascii.b2a_base64(record or '').rstrip())
+                self.pending.append((self.seq, line))
+                return self.seq
+
+        def commit(self):
+                """ writes the appended changes and makes them durable """
+                if not self.pending:
+                        return
+                limit = int(os.environ.get('LOGONMGR_JOURNAL_SEGMENT',16 * 1024 * 1024))
+                for (seq, line) in self.pending:
+                        if self.size >= limit:
+                                self._open_segment(os.path.join(self.path,'%012d.log' % seq))
+                        self.file.write(line)
+                        self.size += len(line)
+                self.pending = []
+                self.file.flush()
+                os.fsync(self.file.fileno())
+
+        def close(self):
+                """
+                        Commits and forgets the sequence number and segment: the next writer may be another
+                        process, so they are read again by the next append
+                """
+                self.commit()
+                if self.file is not None:
+                        self.file.close()
+                        self.file = None
+                self.seq = None
+
+        def read(self,since=0):
+                """ yields (seq, timestamp, op, key, record) of the changes after sequence number since """
+                import binascii
+                segments = self.segments()
+                for i in xrange(len(segments)):
+                        if i + 1 < len(segments) and segments[i + 1][0] <= since + 1:
+                                continue        # every change in this segment is at or before since
+                        f = open(segments[i][1],'rb')
+                        try:
+                                for line in f:
+                                        if not line.endswith('\n'):
+                                                break
+                                        fields = line[:-1].split('\t')
+                                        if len(fields) != 5 or not fields[0].isdigit() or not fields[1].isdigit():
+                                                # e.g. a change written after a torn write by an older logonmgr
+                                                sys.stderr.write("logonmgr: skipped a damaged line in %s\n" % segments[i][1])
+                                                continue
+                                        (seq, ts, op, key, record) = fields
+                                        if int(seq) > since:
+                                                yield (int(seq), int(ts), op, key, binascii.a2b_base64(record))
+                        finally:
+                                f.close()
+
+        def prune(self,seq):
+                """ removes the segments holding only changes before sequence number seq, returns how many """
+                segments = self.segments()
+                removed = 0
+                for i in xrange(len(segments) - 1):     # the current segment is always kept
+                        if segments[i + 1][0] <= seq:
+                                os.remove(segments[i][1])
+                                removed = removed + 1
+                return removed
+
+class LogonStore(object):
+        """
+                A logons file: the dbm handle, the eiw_ctl keys and the secondary indexes.
+                Methods return ConnectionEntry objects and values rather than printing them,
+                so Python programs can look up credentials in process and keep one handle
+                open across any number of lookups:
+
+                        with LogonStore('/path/to/logons.gdbm') as store:
+                                entry = store.get('tdprod')
+                                password = store.decrypt_password(entry)
+
+                Opened read-only by default; pass flag='w' (or 'c' to create the file) to
+                add, update or delete entries. Errors about missing or duplicate entries
+                are raised as ConnectionEntryError. A read-only store reads the compiled
+                snapshot instead of the gdbm file while the snapshot is up to date, unless
+                snapshot is False.
+
+                Access is coordinated through a StoreLock. A store opened for writing still reads
+                under the shared lock; each change first calls begin_write, which takes the write
+                lock and reopens the file for writing, and end_write (or close) gives it back, so
+                parsing and encryption happen outside the write critical section.
+                Every committed change is also recorded in the store's Journal for replay
+                on other hosts.
+        """
+        def __init__(self,path,flag='r',db=None,snapshot=True):
+                self.path = path
+                self.flag = flag
+                self.lock = None
+                self.journal = None
+                self.writing = False
+                if db is None and flag == 'r' and snapshot and not os.path.exists(path + '.undo'):
+                        db = open_snapshot(path)
+                self.db = db
+                if db is None and (is_sqlite_file(path) or
+                                (flag != 'r' and not os.path.exists(path) and os.environ.get('LOGONMGR_BACKEND') == 'sqlite')):
+                        self.db = SqliteBackend(path,flag == 'r')
+                        self.journal = open_journal(path)
+                elif db is None:
+                        self.lock = StoreLock(path)
+                        self.journal = open_journal(path)
+                        if flag != 'r' and not os.path.exists(path):
+                                self._open(flag,True)
+                        else:
+                                self._open('r',False)
+                self._keys = None
+                self._compact = None
+                self.undo = None        # during a transaction: key -> record before it, None if there was none
+                self.held = None        # during a transaction: journal changes held back until commit
+
+        def _open(self,flag,write):
+                """
+                        Takes the lock, then opens the dbm file. Retries while the file is held by a
+                        process that does not use the lock file, such as an older logonmgr. Opens it as
+                        SQLite instead if convert replaced it while waiting for the lock.
+                """
+                # 'gdbm' type causes the db to be created in a non-proprietary format of Linux file type 'data' rather than SQLite 3.x or Berkeley DB
+                import gdbm, errno
+                self.lock.acquire(write)
+                if is_sqlite_file(self.path):
+                        self.lock.release()
+                        self.lock.close()
+                        self.lock = None
+                        self.db = SqliteBackend(self.path,self.flag == 'r')
+                        if write:
+                                self.begin_write()
+                        return
+                if not write and os.path.exists(self.path + '.undo'):
+                        self._recover_to_read()         # readers never see half a batch
+                deadline = time.time() + lock_timeout()
+                delay = 0.005
+                while True:
+                        try:
+                                self.db = GdbmBackend(self.path,flag)
+                                self.writing = write
+                                return
+                        except gdbm.error, e:
+                                if e.args[0] != errno.EAGAIN or time.time() >= deadline:
+                                        self.lock.release()
+                                        raise
+                        delay = backoff(delay,deadline)
+
+        def begin_write(self):
+                """
+                        Takes the write lock and reopens the file for writing, unless that is done already.
+                        Changes call it before reading anything they depend on.
+                """
+                if self.flag == 'r':
+                        raise ConnectionEntryError('%s is open read-only' % self.path)
+                if self.writing:
+                        return
+                if self.lock is None:
+                        if not self.db.begin():         # SQLite keeps other writers out, readers carry on
+                                self._reopen()          # convert replaced the file
+                                return self.begin_write()
+                        self.writing = True
+                else:
+                        if self.db is not None:
+                                self.db.close()
+                                self.lock.release()
+                        self._open('w',True)
+                if os.path.exists(self.path + '.undo'):
+                        self._recover()
+
+        def end_write(self):
+                """
+                        Commits the changes: makes them durable in the file, then journals them, and goes
+                        back to reading, so waiting readers can proceed
+                """
+                if not self.writing or self.undo is not None:
+                        return
+                self._commit()
+                if self.lock is None:
+                        self.writing = False
+                        return
+                self.db.close()
+                self.lock.release()
+                self._open('r',False)
+
+        def release_read(self):
+                """
+                        Closes the file and gives the shared lock back until acquire_read or begin_write,
+                        so that the locks of several stores can be taken again in a fixed order
+                """
+                if self.lock is None or self.writing or self.db is None:
+                        return
+                self.db.close()
+                self.db = None
+                self.lock.release()
+
+        def acquire_read(self):
+                if self.db is None:
+                        self._open('r',False)
+
+        def _commit(self):
+                """ makes the changes durable in the file, then writes their journal lines """
+                self.db.commit()
+                if self.journal is not None:
+                        self.journal.close()    # the next writer may be another process: read its sequence number again
+                bump_generation(self.path)
+
+        def close(self):
+                if self.undo is not None:
+                        self.rollback()
+                if self.writing:
+                        self._commit()
+                if self.db is not None:
+                        self.db.close()
+                self.db = None
+                if self.lock is not None:
+                        self.lock.close()
+
+        def __enter__(self):
+                return self
+
+        def __exit__(self,exc_type,exc_value,traceback):
+                self.close()
+
+        def _load(self,key,default=None):
+                return self.db.get(key,default)
+
+        def _store(self,key,value):
+                self.begin_write()
+                if isinstance(value,ConnectionEntry) and self.compact_records():
+                        data = encode_entry(value)
+                else:
+                        data = cPickle.dumps(value,-1)
+                if isinstance(value,ConnectionEntry):
+                        self._journal('put',key,data)
+                elif key in journal_keys:
+                        self._journal('key',key,data)
+                self._write(key,data,value)
+
+        def _write(self,key,data,value=None):
+                if self.undo is not None:
+                        self._keep_undo(key)
+                self.db.put(key,data,value)
+
+        def _erase(self,key):
+                if self.undo is not None:
+                        self._keep_undo(key)
+                self.db.delete(key)
+
+        def _keep_undo(self,key):
+                """ saves the record a transaction is about to change the first time it changes it """
+                if key in self.undo:
+                        return
+                old = self.db.record(key)
+                self.undo[key] = old
+                marshal.dump((key, old),self.undo_file)
+                self.undo_file.flush()
+
+        def begin_transaction(self):
+                """
+                        Takes the write lock and groups the changes that follow until commit or rollback.
+                        The records they replace are kept, in memory and in <logons file>.undo, and their journal
+                        lines are held back, so rollback, or the next writer after a crash, restores the file.
+                        The undo file starts with the last journal sequence number: once the journal goes
+                        past it, the transaction was committed and recovery keeps it.
+                """
+                self.begin_write()
+                self.undo = {}
+                self.held = []
+                self.undo_file = open(self.path + '.undo','wb')
+                marshal.dump(self._journal_seq(),self.undo_file)
+                self.undo_file.flush()
+
+        def _journal_seq(self):
+                """ sequence number of the last change journaled, or numbered for the journal, -1 without a journal """
+                if self.journal is None:
+                        return -1
+                if self.journal.seq is not None:
+                        return self.journal.seq
+                return self.journal.last_seq()
+
+        def commit(self):
+                """ makes the changes of the transaction durable, journals them and only then drops the undo file """
+                held = self.held
+                self.held = None
+                for (op, key, data) in held:
+                        self._journal(op,key,data)
+                self._commit()
+                self._end_transaction()
+                self.end_write()
+
+        def rollback(self):
+                """ puts back the records changed by the transaction """
+                for (key, old) in self.undo.items():
+                        self._restore(key,old)
+                self.sync()
+                self._end_transaction()
+                self._keys = None
+                self._compact = None
+                self.end_write()
+
+        def _restore(self,key,old):
+                if old is not None:
+                        self.db.put(key,old)
+                elif self.db.has_key(key):
+                        self.db.delete(key)
+
+        def _end_transaction(self):
+                self.undo_file.close()
+                os.remove(self.path + '.undo')
+                self.undo = None
+                self.held = None
+
+        def _recover(self):
+                """
+                        Rolls back the transaction of a writer that died before it committed, or keeps it if the
+                        writer died after journaling it, when its changes were already durable
+                """
+                f = open(self.path + '.undo','rb')
+                try:
+                        try:
+                                seq = marshal.load(f)
+                        except (EOFError, ValueError, TypeError):
+                                seq = None
+                        if isinstance(seq,tuple):       # an undo file without the sequence number
+                                f.seek(0)
+                        elif seq is not None and self.journal is not None and self.journal.last_seq() > seq:
+                                f.close()
+                                os.remove(self.path + '.undo')
+                                sys.stderr.write("logonmgr: kept the journaled batch of a writer that died in %s\n" % self.path)
+                                return
+                        while True:
+                                try:
+                                        (key, old) = marshal.load(f)
+                                except (EOFError, ValueError, TypeError):
+                                        break   # the end, or a torn last record whose change was never made
+                                self._restore(key,old)
+                finally:
+                        f.close()
+                self.sync()
+                os.remove(self.path + '.undo')
+                sys.stderr.write("logonmgr: rolled back an unfinished batch in %s\n" % self.path)
+
+        def _recover_to_read(self):
+                """
+                        Rolls back the batch of a writer that died, found by a reader: under the write lock,
+                        as begin_write does. Refuses to read the file if this process cannot write it.
+                """
+                import gdbm
+                self.lock.release()
+                if self.lock.fd is not None and not self.lock.writable:
+                        raise ConnectionEntryError('%s has the unfinished batch of a writer that died; a write command rolls it back' % self.path)
+                try:
+                        self._open('w',True)
+                except gdbm.error, e:
+                        raise ConnectionEntryError('%s has the unfinished batch of a writer that died, which cannot be rolled back: %s' % (self.path, e))
+                if os.path.exists(self.path + '.undo'):
+                        self._recover()
+                self.db.close()
+                self.lock.release()
+                self.writing = False
+                self.lock.acquire(False)
+
+        def _journal(self,op,key,data):
+                """ records a change for the journal, which writes it once the change is committed """
+                if self.journal is None:
+                        return
+                if self.held is not None:
+                        self.held.append((op, key, data))
+                        return
+                if self.journal.seq is None and not self.journal.segments():
+                        # a new journal starts with the keys needed to read the entries that follow
+                        for name in journal_keys:
+                                if name != key and self.db.has_key(name):
+                                        self.journal.append('key',name,self.db.record(name))
+                self.journal.append(op,key,data)
+
+        def compact_records(self):
+                """
+                        True once the file has been upgraded (or created) with compact entry records.
+                        Until then entries are written as pickles, which older logonmgr versions can read
+                """
+                if self._compact is None:
+                        self._compact = self.db.has_key('__format__')
+                return self._compact
+
+        def sync(self):
+                self.db.sync()
+
+        def init_keys(self):
+                """ creates the eiw_ctl key pair of a new logons file, returns True if it did """
+                if self.db.has_key('eiw_ctl'):
+                        return False
+                self.begin_write()
+                if self.db.has_key('eiw_ctl'):
+                        return False
+                import rsa
+                (pubkey, privkey) = rsa.newkeys(512)
+                self._store('eiw_ctl',[(pubkey), (privkey)])
+                if self.db.index_records:
+                        self._store('__idx__',index_marker)    # a new file starts out indexed
+                        self._store(names_key,(0,[]))
+                self._store(stats_key,empty_stats())
+                self._store('__format__',ord(record_version))  # and with compact records
+                self._keys = None
+                self._compact = None
+                return True
+
+        @property
+        def keys(self):
+                """ KeyRing for this file, loaded on first use """
+                if self._keys is None:
+                        with timed('keys'):
+                                eiw_ctl = self._load('eiw_ctl')
+                                if eiw_ctl is None:
+                                        raise ConnectionEntryError("%s has no eiw_ctl keys" % self.path)
+                                old = self._load('__oldkeys__')
+                                previous = None
+                                if old is not None:
+                                        previous = KeyRing(old[0],old[1])
+                                self._keys = KeyRing(eiw_ctl,self._load('__datakey__'),previous)
+                return self._keys
+
+        def encrypt_password(self,plaintext):
+                return self.keys.encrypt(plaintext)
+
+        def decrypt_password(self,entry):
+                """ plaintext password of an entry or connection name, None if it has no password """
+                if not isinstance(entry,ConnectionEntry):
+                        name = entry
+                        entry = self.get(name)
+                        if entry is None:
+                                raise ConnectionEntryError('Connection Entry %s not found' % name)
+                if entry.password is None:
+                        return None
+                return self.keys.decrypt(entry.password)
+
+        def __contains__(self,name):
+                return self.db.has_key(name.lower())
+
+        def get(self,name):
+                """ ConnectionEntry for a connection name, None if there is none """
+                name = name.lower()
+                if is_internal_key(name):
+                        return None
+                return self._load(name)
+
+        def record(self,name):
+                """ stored (encoded) record of a connection name, None if there is none """
+                name = name.lower()
+                if is_internal_key(name):
+                        return None
+                return self.db.record(name)
+
+        def get_many(self,names):
+                """ dictionary of connection name to ConnectionEntry (None for unknown names) """
+                entries = {}
+                for name in names:
+                        entries[name] = self.get(name)
+                return entries
+
+        def names(self):
+                """ sorted connection names """
+                return self.db.names()
+
+        def iter_names(self,prefix='',after=None):
+                """
+                        Connection names in order that start with prefix and, if after is given, sort after it.
+                        Reads only the names returned (and the rest of their name index page), so listing
+                        a prefix or a page of names does not depend on the number of entries.
+                """
+                prefix = prefix.lower()
+                start = prefix
+                if after is not None:
+                        after = after.lower()
+                        start = max(start,after)
+                for name in self.db.iter_names(start):
+                        if name == after:
+                                continue
+                        if not name.startswith(prefix):
+                                break
+                        yield name
+
+        def _update_pages(self,key,adds,removes):
+                """
+                        Applies added and removed connection names to the pages under the root record at key,
+                        the sorted name index or a secondary index record. Only the pages whose names changed
+                        are written, and the root record only if the list of pages or their first names
+                        changed. A secondary index record left without names is erased; one still holding
+                        the set of names older versions wrote is split into pages.
+                """
+                import bisect
+                root = self._load(key)
+                loaded = {}     # position in pages -> names of that page
+                changed = set()
+                if not root:
+                        if key == names_key:
+                                return          # a file indexed before the name index: reindex builds it
+                        (next_page, pages) = (0, [])
+                elif isinstance(root,set):
+                        (next_page, pages) = (1, [(min(root), 0)])
+                        loaded[0] = sorted(root)
+                        changed.add(0)
+                else:
+                        (next_page, pages) = root
+                        root = (next_page, pages[:])
+                firsts = [first for (first, page) in pages]
+                for name in sorted(adds | removes):
+                        if not pages:
+                                pages.append((name, next_page))
+                                firsts.append(name)
+                                loaded[0] = []
+                                next_page = next_page + 1
+                        i = max(bisect.bisect_right(firsts,name) - 1, 0)
+                        if i not in loaded:
+                                loaded[i] = self._load(page_key(key,pages[i][1]),[])
+                        names = loaded[i]
+                        j = bisect.bisect_left(names,name)
+                        present = j < len(names) and names[j] == name
+                        if name in adds and not present:
+                                names.insert(j,name)
+                                changed.add(i)
+                        elif name in removes and present:
+                                del names[j]
+                                changed.add(i)
+                if not changed:
+                        return          # e.g. only existing entries were rewritten
+                new_pages = []
+                for (i, (first, page)) in enumerate(pages):
+                        if i not in changed:
+                                new_pages.append((first, page))
+                                continue
+                        names = loaded[i]
+                        if not names:
+                                if self.db.has_key(page_key(key,page)):
+                                        self._erase(page_key(key,page))
+                                continue
+                        if len(names) > 2 * name_page_size:
+                                chunks = [names[k:k + name_page_size] for k in xrange(0,len(names),name_page_size)]
+                        else:
+                                chunks = [names]
+                        for (k, chunk) in enumerate(chunks):
+                                if k > 0:
+                                        page = next_page
+                                        next_page = next_page + 1
+                                self._store(page_key(key,page),chunk)
+                                new_pages.append((chunk[0], page))
+                if not new_pages and key != names_key:
+                        if self.db.has_key(key):
+                                self._erase(key)
+                elif (next_page, new_pages) != root:
+                        self._store(key,(next_page,new_pages))
+
+        def _update_stats(self,delta):
+                """ adds the counts of an index_changes delta to the entry statistics """
+                stats = self._load(stats_key)
+                if stats is None:
+                        return          # a file indexed before there were statistics: reindex builds them
+                stats['entries'] += delta['entries']
+                stats['no_password'] += delta['no_password']
+                for attr in ('dbms','server'):
+                        counts = stats[attr]
+                        for (value, n) in delta[attr].items():
+                                counts[value] = counts.get(value,0) + n
+                                if counts[value] == 0:
+                                        del counts[value]
+                stats['last_updt_ts'] = max(stats['last_updt_ts'],delta['last_updt_ts'])
+                self._store(stats_key,stats)
+
+        def stats(self):
+                """
+                        Entry statistics without reading the entries: a dictionary of the number of entries,
+                        of those with no password (no_password), the number per dbms and per server value and
+                        the newest last_updt_ts written. None for a file indexed before there were statistics.
+                """
+                return self.db.stats()
+
+        def count(self):
+                stats = self.stats()
+                if stats is not None:
+                        return stats['entries']
+                return len(self.names())
+
+        def entries(self):
+                """ all entries in connection name order """
+                for name in self.names():
+                        entry = self._load(name)
+                        if entry is not None:
+                                yield entry
+
+        def has_indexes(self):
+                """
+                        indexes are only trusted once reindex (or creation of a new file) has built them;
+                        of an SQLite file, which indexes its columns itself, that is the statistics record
+                """
+                if self.db.index_records:
+                        return self.db.has_key('__idx__')
+                return self.db.has_key(stats_key)
+
+        def query(self,**criteria):
+                """
+                        Entries whose attributes equal all the given values, e.g. query(dbms='teradata',server='tdprod').
+                        Indexed attributes narrow the candidates through the secondary indexes, or SQL
+                        on an SQLite file, the remaining criteria are checked against each candidate.
+                """
+                s_criteria = set(criteria.items())
+                names = self.db.query(criteria)
+                if names is None:
+                        names = self.names()
+
+                results = []
+                for name in names:
+                        entry = self.get(name)
+                        if entry is not None:
+                                searchset = set([ (field,entry.value(field)) for field in entry_fields if field != 'dboptions'])
+                                if s_criteria.issubset(searchset):
+                                        results.append(entry)
+                return results
+
+        def flush(self,batch):
+                """ write the index records changed in batch """
+                self.begin_write()
+                delta = batch.pop(stats_key,None)
+                if delta is not None:
+                        self._update_stats(delta)
+                for key, (adds, removes) in batch.items():
+                        if not self.db.index_records:
+                                continue        # SQLite indexes its columns itself
+                        self._update_pages(key,adds,removes)
+                batch.clear()
+
+        def put(self,entry,batch=None):
+                """
+                        Stores entry under its name, keeping the secondary indexes current.
+                        Bulk loaders pass a batch dictionary and call flush once at the end
+                        so each index record is rewritten once rather than once per entry.
+                """
+                name = entry.name
+                self.begin_write()
+                if self.has_indexes():
+                        own_batch = batch is None
+                        if own_batch:
+                                batch = {}
+                        old = self._load(name)
+                        if old is not None:
+                                index_changes(old,-1,batch)
+                        index_changes(entry,1,batch)
+                        self._store(name,entry)
+                        if own_batch:
+                                self.flush(batch)
+                else:
+                        self._store(name,entry)
+
+        def save(self,entry):
+                """ stamps the update audit trail attributes and stores entry """
+                entry.last_updt_ts = timestamp_now()
+                entry.last_updt_userid = os.environ['USER']
+                self.put(entry)
+
+        def add(self,name,**attrs):
+                """
+                        Adds a new entry. attrs are attribute values with the password in plaintext
+                        and dboptions as a dictionary. Returns the new entry.
+                """
+                name = name.lower()
+                if name in self:
+                        raise ConnectionEntryError('Connection Entry %s Already exists' % name)
+                for key in attrs:
+                        if key not in valid_attrs:
+                                raise AttributeError, "Invalid keyword:" + key
+                attrs['name'] = name
+                entry = new_entry(self.keys,attrs)
+                self.begin_write()
+                if name in self:
+                        raise ConnectionEntryError('Connection Entry %s Already exists' % name)
+                self.put(entry)
+                return entry
+
+        def update(self,name,**attrs):
+                """
+                        Sets one or more attributes of an existing entry. The password is given in
+                        plaintext, dboptions are merged into the entry's dboptions and a new name
+                        renames the entry. Returns the updated entry.
+                """
+                for key in attrs:
+                        if key not in valid_attrs:
+                                raise AttributeError, "Invalid keyword:" + key
+                if attrs.get('password',None) is not None:
+                        password = self.keys.encrypt(attrs['password'])
+                self.begin_write()
+                entry = self.get(name)
+                if entry is None:
+                        raise ConnectionEntryError('Connection Entry %s not found' % name)
+                old_name = entry.name
+                for (key,value) in attrs.items():
+                        if key == 'password' and value is not None:
+                                entry.password = password
+                        elif key == 'dboptions':
+                                if not entry.dboptions:
+                                        entry.dboptions = {}
+                                entry.dboptions.update(value)
+                        elif key == 'name':
+                                entry.name = value.lower()
+                        else:
+                                entry.update_attrs({key : value})
+                if entry.name != old_name:
+                        if entry.name in self:
+                                raise ConnectionEntryError('Connection Entry %s Already exists' % entry.name)
+                        self.delete(old_name)
+                self.save(entry)
+                return entry
+
+        def delete(self,name):
+                """ removes an entry and its secondary index references """
+                self.begin_write()
+                entry = self.get(name)
+                if entry is None:
+                        raise ConnectionEntryError('Connection Entry %s not found' % name)
+                if self.has_indexes():
+                        batch = {}
+                        index_changes(entry,-1,batch)
+                        self.flush(batch)
+                self._journal('delete',name.lower(),None)
+                self._erase(name.lower())
+                return entry
+
+        def reindex(self):
+                """
+                        rebuilds the secondary indexes and the entry statistics (only the statistics of an
+                        SQLite file), returns the number of entries indexed
+                """
+                self.begin_write()
+                for key in self.db.keys():
+                        if key.startswith('__idx__') or key.startswith(names_key) or key == stats_key:
+                                self._erase(key)
+                batch = {}
+                count = 0
+                for entry in self.entries():
+                        index_changes(entry,1,batch)
+                        count = count + 1
+                if self.db.index_records:
+                        self._store('__idx__',index_marker)
+                        self._store(names_key,(0,[]))
+                self._store(stats_key,empty_stats())
+                self.flush(batch)
+                return count
+
+        def enable_envelope(self):
+                """ creates the wrapped data key of envelope mode, returns True if it did """
+                self.begin_write()
+                if self.db.has_key('__datakey__'):
+                        return False
+                import rsa
+                self._store('__datakey__',rsa.encrypt(os.urandom(32),self.keys.eiw_ctl[0]))
+                self.sync()
+                self._keys = None
+                return True
+
+        def start_rotation(self,bits=512):
+                """
+                        Starts a key rotation: a new eiw_ctl key pair and data key take over, and the old ones
+                        are kept in __oldkeys__ to read the passwords that have not been re-encrypted yet.
+                        The new keys are committed before it returns, so worker processes started next
+                        inherit neither the write lock nor unwritten journal lines.
+                        Returns False if a rotation is already in progress.
+                """
+                if self.rotation_progress() is not None:
+                        return False
+                import rsa
+                (pubkey, privkey) = rsa.newkeys(bits)  # before taking the lock, this can take a while
+                self.begin_write()
+                if self.rotation_progress() is not None:
+                        self.end_write()
+                        return False
+                self._store('__oldkeys__',(self._load('eiw_ctl'),self._load('__datakey__')))
+                self._store('eiw_ctl',[(pubkey), (privkey)])
+                self._store('__datakey__',rsa.encrypt(os.urandom(32),pubkey))
+                self._store('__rotate__','')
+                self.end_write()
+                self._keys = None
+                return True
+
+        def rotation_progress(self):
+                """ during a key rotation the last connection name re-encrypted ('' before the first one), otherwise None """
+                if not self.db.has_key('__oldkeys__'):
+                        return None
+                return self._load('__rotate__','')
+
+        def set_rotation_progress(self,name):
+                self._store('__rotate__',name)
+
+        def finish_rotation(self):
+                """
+                        Ends a key rotation, re-encrypting the passwords still written with the old keys, e.g. by a
+                        writer that loaded them before the rotation started. Those are looked for without the
+                        write lock. Returns the number of passwords re-encrypted.
+                """
+                self.end_write()
+                keys = self.keys
+                stale = [entry.name for entry in self.entries() if entry.password is not None and not keys.is_current(entry.password)]
+                self.begin_write()
+                count = 0
+                batch = {}
+                for name in stale:
+                        entry = self.get(name)
+                        if entry is not None and entry.password is not None and not keys.is_current(entry.password):
+                                entry.password = keys.encrypt(keys.decrypt(entry.password))
+                                self.put(entry,batch)
+                                count = count + 1
+                self.flush(batch)
+                self._remove_key('__oldkeys__')
+                if self.db.has_key('__rotate__'):
+                        self._erase('__rotate__')
+                self._keys = None
+                return count
+
+        def _remove_key(self,key):
+                """ removes a key record, journaled as an empty key record """
+                self.begin_write()
+                if self.db.has_key(key):
+                        self._journal('key',key,'')
+                        self._erase(key)
+
+        def replay(self,changes,batch_size=1000):
+                """
+                        Applies journaled changes, as yielded by Journal.read, and returns the number applied
+                        and the sequence number of the last one. Journaled keys are taken over when this
+                        store has none or no entries yet; different keys raise ConnectionEntryError, as the
+                        journaled passwords could not be decrypted with them.
+                """
+                count = 0
+                last = None
+                batch = {}
+                for (seq, ts, op, key, record) in changes:
+                        if op == 'key':
+                                self._adopt_key(key,record)
+                        elif op == 'put':
+                                self.put(decode_record(record),batch)
+                        elif op == 'delete':
+                                self.flush(batch)       # the index records must include earlier puts
+                                if key in self:
+                                        self.delete(key)
+                        count = count + 1
+                        last = seq
+                        if count % batch_size == 0:
+                                self.flush(batch)
+                                self.end_write()
+                self.flush(batch)
+                return count, last
+
+        def _adopt_key(self,key,record):
+                self.begin_write()
+                if not record:
+                        self._remove_key(key)
+                        self._keys = None
+                        return
+                value = unpickle(record)
+                if key == '__oldkeys__' and self.count() > 0 and value[0] != self._load('eiw_ctl'):
+                        # a key rotation is only followed from the keys this store has
+                        raise ConnectionEntryError('%s has different eiw_ctl keys than the journal' % self.path)
+                if self.db.has_key(key) and self.db.record(key) != record:
+                        if unpickle(self.db.record(key)) == value:
+                                return
+                        if self.count() > 0 and not self.db.has_key('__oldkeys__'):
+                                raise ConnectionEntryError('%s has different %s keys than the journal' % (self.path, key))
+                self._store(key,value)
+                self._keys = None
+
+        def key_records(self):
+                """ stored records of the keys, None for keys the file does not have """
+                return tuple([self.db.record(key) for key in journal_keys])
+
+        def record_hashes(self):
+                """ dictionary of connection name to the md5 digest of its stored record """
+                import hashlib
+                hashes = {}
+                for name in self.names():
+                        data = self.record(name)
+                        if data is not None:
+                                hashes[name] = hashlib.md5(data).digest()
+                return hashes
+
+        def is_snapshot(self):
+                return isinstance(self.db,Snapshot)
+
+        def space(self):
+                """
+                        How the file is used: file_bytes, live_bytes (keys and records), records, entries and,
+                        where the gdbm header can be read, the gdbm_header layout and the bytes used by neither
+                        records nor buckets nor directory (unused), most of which compaction gives back.
+                        For an SQLite file, its page_size, pages and free_pages, and the free pages as unused.
+                """
+                stats = {'file_bytes' : os.path.getsize(self.path), 'live_bytes' : 0, 'records' : 0, 'entries' : 0}
+                if os.path.exists(self.path + '-wal'):
+                        stats['file_bytes'] += os.path.getsize(self.path + '-wal')
+                for key in self.db.iter_keys():
+                        stats['live_bytes'] += len(key) + len(self.db.record(key))
+                        stats['records'] += 1
+                        if not is_internal_key(key):
+                                stats['entries'] += 1
+                return self.db.space(stats)
+
+        def compact(self,in_place=False):
+                """
+                        Rewrites the logons file without the space left behind by rewritten and deleted records,
+                        and returns its size before and after. The gdbm records are copied to a new file while
+                        holding only the shared lock, so readers carry on and writers wait; the copy is
+                        renamed over the file under the write lock (and made again there if a writer got in
+                        between). in_place has gdbm reorganize the file under the write lock instead.
+                        An SQLite file is vacuumed. A snapshot that was up to date is compiled again.
+                """
+                before = os.path.getsize(self.path)
+                snapshot = open_snapshot(self.path)
+                if snapshot is not None:
+                        snapshot.close()
+                if in_place or self.db.compacts_in_place:
+                        self.begin_write()
+                        self.db.compact()
                 else:
-                        print key
+                        tmp = self.path + '.compact'
+                        signature = store_signature(self.path)
+                        self._copy_to(tmp,'gdbm')
+                        self.begin_write()
+                        if store_signature(self.path) != signature:
+                                self._copy_to(tmp,'gdbm')
+                        self._swap(tmp,'gdbm')
+                self.end_write()
+                if snapshot is not None:
+                        self.compile()
+                return (before, os.path.getsize(self.path))
+
+        def backend(self):
+                return self.db.name
+
+        def convert(self,backend):
+                """
+                        Moves the logons file to the 'sqlite' or 'gdbm' backend by copy and swap, as compact does,
+                        and returns the number of records copied. The index records of a gdbm file are left behind
+                        for SQLite, which indexes its columns, and rebuilt when going back to gdbm; the entry
+                        statistics are built again for both.
+                """
+                tmp = self.path + '.convert'
+                signature = store_signature(self.path)
+                count = self._copy_to(tmp,backend)
+                self.begin_write()
+                if store_signature(self.path) != signature:
+                        count = self._copy_to(tmp,backend)
+                self._swap(tmp,backend)
+                self.reindex()
+                self.end_write()
+                self._keys = None
+                self._compact = None
+                return count
+
+        def _swap(self,path,backend):
+                """
+                        Renames the file at path, of the given backend, over this one while holding the write lock,
+                        and reopens it for writing. gdbm users wait on the lock file meanwhile; SQLite writers
+                        waiting for the old file notice that it has been replaced.
+                """
+                lock = self.lock
+                if lock is None:
+                        lock = StoreLock(self.path)
+                        lock.acquire(True)
+                os.rename(path,self.path)
+                sync_directory(self.path)
+                self.db.close()
+                if backend == 'sqlite':
+                        self.db = SqliteBackend(self.path)
+                        self.db.begin()
+                        lock.release()
+                        lock.close()
+                        self.lock = None
+                else:
+                        for stale in (self.path + '-wal', self.path + '-shm'):
+                                if os.path.exists(stale):
+                                        os.remove(stale)
+                        self.lock = lock
+                        self.db = GdbmBackend(self.path,'w')
+                self.writing = True
+
+        def _reopen(self):
+                """ opens the logons file again, with the backend it has now, after convert replaced it """
+                self.db.close()
+                if self.lock is not None:
+                        self.lock.close()
+                        self.lock = None
+                self.writing = False
+                if is_sqlite_file(self.path):
+                        self.db = SqliteBackend(self.path,self.flag == 'r')
+                else:
+                        self.lock = StoreLock(self.path)
+                        self._open('r',False)
+                self._keys = None
+                self._compact = None
+
+        def _copy_to(self,path,backend):
+                """
+                        Copies every record to a new file of the given backend at path, with the permissions of
+                        this one, and returns the number of records copied
+                """
+                st = os.stat(self.path)
+                for old in (path, path + '-wal', path + '-shm'):
+                        if os.path.exists(old):
+                                os.remove(old)
+                if backend == 'sqlite':
+                        copy = SqliteBackend(path)
+                        copy.begin()
+                else:
+                        copy = GdbmBackend(path,'n',stat.S_IMODE(st.st_mode))
+                count = 0
+                try:
+                        for key in self.db.iter_keys():
+                                if copy.index_records or not (key.startswith('__idx__') or key.startswith(names_key) or key == stats_key):
+                                        copy.put(key,self.db.record(key))
+                                        count = count + 1
+                finally:
+                        copy.close()
+                os.chmod(path,stat.S_IMODE(st.st_mode))
+                try:
+                        os.chown(path,st.st_uid,st.st_gid)
+                except OSError:
+                        pass    # not the owner: the copy belongs to whoever made it
+                fd = os.open(path,os.O_RDONLY)
+                try:
+                        os.fsync(fd)
+                finally:
+                        os.close(fd)
+                return count
+
+        def compile(self,path=None):
+                """
+                        Writes the snapshot of this logons file read by read-only stores until the file
+                        next changes, and returns the number of records in it. The snapshot is
+                        written to a temporary file and renamed into place: <logons file>.snap
+                        unless path says otherwise.
+                """
+                import zlib
+                if path is None:
+                        path = snapshot_path(self.path)
+                signature = store_signature(self.path)
+                keys = self.db.keys()
+                slots = 2
+                while slots < 2 * len(keys):            # keep the table at most half full
+                        slots = slots * 2
+                table = [(0,0)] * slots
+                names = '\0'.join(self.names())
+                temp_path = '%s.%d.tmp' % (path, os.getpid())
+                f = open(temp_path,'wb')
+                try:
+                        offset = snapshot_header.size + slots * snapshot_slot.size
+                        f.seek(offset)
+                        for key in keys:
+                                value = self.db.record(key)
+                                h = zlib.crc32(key) & 0xffffffff
+                                i = h & (slots - 1)
+                                while table[i][1]:
+                                        i = (i + 1) & (slots - 1)
+                                table[i] = (h, offset)
+                                f.write(snapshot_record.pack(len(key),len(value)) + key + value)
+                                offset += snapshot_record.size + len(key) + len(value)
+                        f.write(names)
+                        f.seek(0)
+                        f.write(snapshot_header.pack(snapshot_magic,*(signature + (slots,len(keys),offset,len(names)))))
+                        f.write(''.join([snapshot_slot.pack(h,o) for (h,o) in table]))
+                finally:
+                        f.close()
+                # the snapshot holds the same keys and ciphertexts as the logons file
+                os.chmod(temp_path,stat.S_IMODE(os.stat(self.path).st_mode))
+                os.rename(temp_path,path)
+                return len(keys)
+
+        def upgrade(self,dry_run=False):
+                """
+                        Rewrites entries stored as pickles in the compact record format and marks the
+                        file so that entries are written compactly from now on. Returns a dictionary of
+                        entries, rewritten, old_bytes and new_bytes, and the seconds spent decoding all
+                        records in the old (old_seconds) and new (new_seconds) format.
+                        With dry_run nothing is written.
+                """
+                if not dry_run:
+                        self.begin_write()
+                stats = {'entries' : 0, 'rewritten' : 0, 'old_bytes' : 0, 'new_bytes' : 0, 'old_seconds' : 0.0, 'new_seconds' : 0.0}
+                for name in self.names():
+                        data = self.db.record(name)
+                        start = time.time()
+                        entry = decode_record(data)
+                        stats['old_seconds'] += time.time() - start
+                        record = encode_entry(entry)
+                        start = time.time()
+                        decode_record(record)
+                        stats['new_seconds'] += time.time() - start
+                        stats['entries'] += 1
+                        stats['old_bytes'] += len(data)
+                        stats['new_bytes'] += len(record)
+                        if record != data:
+                                stats['rewritten'] += 1
+                                if not dry_run:
+                                        self._write(name,record)
+                if not dry_run:
+                        self._store('__format__',ord(record_version))
+                        self._compact = True
+                        if stats['rewritten'] and not self.db.compacts_in_place:
+                                self.db.compact()       # give the space of the larger pickles back
+                        self.sync()
+                return stats
+
+def reindex(args):
+        """
+                reindex
+                Rebuilds the secondary indexes used by the query command
+        """
+        count = store.reindex()
+        print "Indexed %d entries on %s" % (count, ','.join(index_attrs))
+
+def entry_content(entry):
+        """ the attributes two stores must agree on, apart from the password """
+        return (entry.name, entry.userid, entry.server, entry.dbms, entry.database, entry.dboptions)
+
+def transfer(entry,source,target):
+        """ entry of the source store with its password re-encrypted for the target store, audit trail kept """
+        if entry.password is not None and source.key_records() != target.key_records():
+                entry.password = target.keys.encrypt(source.keys.decrypt(entry.password))
+        return entry
+
+def sync_stores(local,remote,prefer=None,push=True,dry_run=False):
+        """
+                Brings two stores into line and returns the (action, connection name) pairs, where action
+                is pull, push, delete-local, delete-remote or conflict.
+                Changes are found by comparing each entry's record hash with the hashes recorded in
+                the local store at the last sync, so only entries that differ are read, decrypted and
+                re-encrypted. An entry changed on both sides since then is a conflict, unless the
+                content is the same or prefer ('local', 'remote' or 'newer' last_updt_ts) settles it.
+                Without a previous sync, entries on one side only are copied and differing entries are
+                settled by last_updt_ts. With push False, local changes are left for a later sync.
+        """
+        state_key = '__sync__|' + os.path.realpath(remote.path)
+        # a sync of the same pair from the other end takes the locks the other way round: give the
+        # shared locks back before waiting for any lock, then take them all in the same order
+        local.release_read()
+        remote.release_read()
+        for s in sorted([local,remote],key=lambda s: os.path.realpath(s.path)):
+                if not dry_run and (s is local or push):
+                        s.begin_write()
+                else:
+                        s.acquire_read()
+        base = local._load(state_key)
+        local_hashes = local.record_hashes()
+        remote_hashes = remote.record_hashes()
+
+        actions = []
+        skipped = set()         # names whose base must not move: conflicts and changes not pushed
+        for name in sorted(set(local_hashes) | set(remote_hashes)):
+                l = local_hashes.get(name)
+                r = remote_hashes.get(name)
+                if l == r:
+                        continue
+                if base is None:
+                        if l is None:
+                                action = 'pull'
+                        elif r is None:
+                                action = 'push'
+                        else:
+                                local_entry = local.get(name)
+                                remote_entry = remote.get(name)
+                                if entry_content(local_entry) == entry_content(remote_entry) and local_entry.last_updt_ts == remote_entry.last_updt_ts:
+                                        action = None
+                                elif local_entry.last_updt_ts >= remote_entry.last_updt_ts:
+                                        action = 'push'
+                                else:
+                                        action = 'pull'
+                else:
+                        (base_l, base_r) = base.get(name,(None,None))
+                        local_changed = l != base_l
+                        remote_changed = r != base_r
+                        if not local_changed and not remote_changed:
+                                continue
+                        elif not remote_changed:
+                                action = l is None and 'delete-remote' or 'push'
+                        elif not local_changed:
+                                action = r is None and 'delete-local' or 'pull'
+                        elif l is not None and r is not None and entry_content(local.get(name)) == entry_content(remote.get(name)) \
+                                        and local.decrypt_password(name) == remote.decrypt_password(name):
+                                action = None
+                        else:
+                                local_entry = local.get(name)
+                                remote_entry = remote.get(name)
+                                if prefer == 'newer':
+                                        # a change beats a deletion
+                                        use_local = remote_entry is None or (local_entry is not None and local_entry.last_updt_ts >= remote_entry.last_updt_ts)
+                                elif prefer in ('local','remote'):
+                                        use_local = prefer == 'local'
+                                else:
+                                        use_local = None
+                                if use_local is None:
+                                        action = 'conflict'
+                                elif use_local:
+                                        action = l is None and 'delete-remote' or 'push'
+                                else:
+                                        action = r is None and 'delete-local' or 'pull'
+                if action == 'conflict' or (action in ('push','delete-remote') and not push):
+                        skipped.add(name)
+                if action in ('push','delete-remote') and not push:
+                        continue
+                actions.append((action,name))
+
+        if dry_run:
+                return [(action,name) for (action,name) in actions if action]
+
+        import hashlib
+        new_base = dict(base or {})
+        local_batch = {}
+        remote_batch = {}
+        for (action,name) in actions:
+                if action == 'pull':
+                        local.put(transfer(remote.get(name),remote,local),local_batch)
+                        local_hashes[name] = hashlib.md5(local.record(name)).digest()
+                elif action == 'push':
+                        remote.put(transfer(local.get(name),local,remote),remote_batch)
+                        remote_hashes[name] = hashlib.md5(remote.record(name)).digest()
+                elif action == 'delete-local':
+                        local.flush(local_batch)
+                        local.delete(name)
+                        del local_hashes[name]
+                elif action == 'delete-remote':
+                        remote.flush(remote_batch)
+                        remote.delete(name)
+                        del remote_hashes[name]
+        local.flush(local_batch)
+        if push:
+                remote.flush(remote_batch)
+        for name in set(local_hashes) | set(remote_hashes) | set(new_base):
+                if name in skipped:
+                        if base is None:
+                                # first sync: record only the remote side, so the local change shows next time
+                                new_base[name] = (None, remote_hashes.get(name))
+                        continue
+                if name in local_hashes or name in remote_hashes:
+                        new_base[name] = (local_hashes.get(name), remote_hashes.get(name))
+                else:
+                        del new_base[name]
+        local._store(state_key,new_base)
+        return [(action,name) for (action,name) in actions if action]
+
+def sync(args):
+        """
+                sync [-pull] [-dry-run] [-prefer local|remote|newer] <other logons file>
+                Synchronizes this logons file with another, e.g. a host-local copy with the central
+                store, transferring only the entries that changed on either side since the last sync.
+                -pull leaves the other file unchanged. Entries changed on both sides are reported as
+                conflicts and left alone unless -prefer says which side wins.
+        """
+        global status
+        args = [a for a in args[1:]]
+        prefer = None
+        push = True
+        dry_run = False
+        while args and args[0].startswith('-'):
+                if args[0] == '-pull':
+                        push = False
+                elif args[0] == '-dry-run':
+                        dry_run = True
+                elif args[0] == '-prefer' and len(args) > 1 and args[1] in ('local','remote','newer'):
+                        prefer = args[1]
+                        del args[0]
+                else:
+                        break
+                del args[0]
+        if len(args) != 1:
+                sys.stderr.write("Usage: logonmgr sync [-pull] [-dry-run] [-prefer local|remote|newer] <other logons file>\n")
+                sys.exit(1)
+
+        start = time.time()
+        store.release_read()    # not held while waiting for the lock of the other file: see sync_stores
+        remote = LogonStore(args[0],(push and not dry_run) and 'w' or 'r')
+        try:
+                actions = sync_stores(store,remote,prefer,push,dry_run)
+        finally:
+                remote.close()
+        counts = {}
+        for (action,name) in actions:
+                print "%-13s %s" % (action, name)
+                counts[action] = counts.get(action,0) + 1
+        summary = ', '.join(["%s %d" % (action, counts.get(action,0)) for action in ['pull','push','delete-local','delete-remote','conflict']])
+        print "%s%s in %.2fs" % (dry_run and "Would sync: " or "Synced: ", summary, time.time() - start)
+        if counts.get('conflict'):
+                status = 1
+
+# fields diff compares; -audit adds the audit trail ones
+diff_fields = ['userid','password','server','dbms','database','dboptions']
+audit_fields = ['create_ts','last_updt_ts','create_userid','last_updt_userid']
+export_file_fields = ['userid','password','server','dbms','database']
+
+def merge_by_name(left,right):
+        """
+                Merges two streams of (name, value) pairs, each in connection name order, into
+                (name, left value or None, right value or None) triples in name order
+        """
+        l = next(left,None)
+        r = next(right,None)
+        while l is not None or r is not None:
+                if r is None or (l is not None and l[0] < r[0]):
+                        yield (l[0], l[1], None)
+                        l = next(left,None)
+                elif l is None or r[0] < l[0]:
+                        yield (r[0], None, r[1])
+                        r = next(right,None)
+                else:
+                        yield (l[0], l[1], r[1])
+                        l = next(left,None)
+                        r = next(right,None)
+
+def store_records(source):
+        """ (name, stored record) of every entry of a LogonStore in connection name order """
+        for name in source.iter_names(''):
+                record = source.record(name)
+                if record is not None:
+                        yield (name, record)
+
+def export_file_records(path):
+        """ (name, fields) of the lines of an export file, which must be in connection name order as export writes them """
+        prev = None
+        text_file = open(path)
+        try:
+                for (lineno,line) in enumerate(text_file,1):
+                        if not line.strip():
+                                continue
+                        fields = line.rstrip('\n').split('|')
+                        if len(fields) != 6:
+                                raise ConnectionEntryError('%s line %d: not a name|userid|password|server|dbms|database line' % (path, lineno))
+                        name = fields[0].lower()
+                        if prev is not None and name <= prev:
+                                raise ConnectionEntryError('%s line %d: %s is out of connection name order, as export writes it' % (path, lineno, name))
+                        prev = name
+                        yield (name, fields[1:])
+        finally:
+                text_file.close()
+
+def diff_stores(left,right,fields):
+        """
+                Streams the differences between the LogonStore left and right (another LogonStore or the
+                path of an export file) as ('+' or '-', name, None) for entries only in right or only in
+                left, and ('~', name, [(field, left value, right value)]) for entries whose fields differ.
+                Equal stored records are passed over without decoding them, and passwords are decrypted
+                only when their ciphertexts differ; a password that differs is given as None, None.
+                An export file holds plaintext, so the passwords of entries in both are decrypted.
+        """
+        if isinstance(right,LogonStore):
+                right_records = store_records(right)
+        else:
+                right_records = export_file_records(right)
+                fields = export_file_fields
+        for (name, l, r) in merge_by_name(store_records(left),right_records):
+                if r is None:
+                        yield ('-', name, None)
+                        continue
+                if l is None:
+                        yield ('+', name, None)
+                        continue
+                if l == r:
+                        continue
+                a = decode_record(l)
+                changes = []
+                if isinstance(right,LogonStore):
+                        b = decode_record(r)
+                        for field in fields:
+                                if field != 'password':
+                                        if a.value(field) != b.value(field):
+                                                changes.append((field, a.value(field), b.value(field)))
+                                elif a.password != b.password:
+                                        if a.password is None or b.password is None or \
+                                                        left.decrypt_password(a) != right.decrypt_password(b):
+                                                changes.append((field, None, None))
+                else:
+                        for (field, value) in zip(fields,r):
+                                if field == 'password':
+                                        if (left.decrypt_password(a) or '') != value:  # export writes no password as ''
+                                                changes.append((field, None, None))
+                                elif str(a.value(field)) != value:
+                                        changes.append((field, a.value(field), value))
+                if changes:
+                        yield ('~', name, changes)
+
+def diff(args):
+        """
+                diff [-audit] <other logons file>|-export <export file>
+                Shows the entries only in this logons file (-), only in the other one or the export
+                file (+) and those with different fields (~), reading both in connection name order
+                and decrypting only passwords whose ciphertexts differ. -audit compares the audit
+                trail attributes too. Exits with status 1 if there are differences
+        """
+        global status
+        args = [a for a in args[1:]]
+        fields = diff_fields
+        if '-audit' in args:
+                args.remove('-audit')
+                fields = diff_fields + audit_fields
+        export_file = value_option(args,'-export')
+        if (export_file is None and len(args) != 1) or (export_file is not None and args):
+                sys.stderr.write("Usage: logonmgr diff [-audit] <other logons file>|-export <export file>\n")
+                sys.exit(1)
+        other = export_file
+        if other is None:
+                other = LogonStore(args[0],'r')
+        counts = {'+' : 0, '-' : 0, '~' : 0}
+        try:
+                for (kind, name, changes) in diff_stores(store,other,fields):
+                        print "%s %s" % (kind, name)
+                        counts[kind] += 1
+                        for (field, old, new) in changes or []:
+                                if field == 'password':
+                                        print "    password: differs"
+                                else:
+                                        print "    %s: %s -> %s" % (field, format_timestamp(old), format_timestamp(new))
+        except ConnectionEntryError, e:
+                sys.stderr.write("%s\n" % e)
+                sys.exit(2)
+        finally:
+                if isinstance(other,LogonStore):
+                        other.close()
+        print "%d only here, %d only in %s, %d different" % (counts['-'], counts['+'], export_file or args[0], counts['~'])
+        if counts['+'] or counts['-'] or counts['~']:
+                status = 1
+
+def journal(args):
+        """
+                journal [prune <seq>]
+                Shows the journal segments and the last sequence number, or removes the segments
+                holding only changes before sequence number seq
+        """
+        changes = Journal(dbpath + '.journal')
+        if len(args) > 2 and args[1] == 'prune':
+                store.begin_write()     # writers start new segments under the write lock
+                print "Removed %d segments" % changes.prune(int(args[2]))
+                return
+        print "Journal: %s" % changes.path
+        print "Last sequence number: %d" % changes.last_seq()
+        for (first, path) in changes.segments():
+                print "  %12d %12d %s" % (first, os.path.getsize(path), path)
+
+def replay(args):
+        """
+                replay <source> [--since <seq>]
+                Applies the changes journaled by the logons file source (or a copy of its journal
+                directory) after sequence number seq. Without --since, replay continues after the
+                last change replayed from the same source.
+        """
+        global status
+        args = [a for a in args]
+        since = None
+        if '--since' in args:
+                i = args.index('--since')
+                since = int(args[i + 1])
+                del args[i:i + 2]
+        if len(args) < 2:
+                sys.stderr.write("Usage: logonmgr replay <source logons file|journal directory> [--since <seq>]\n")
+                sys.exit(1)
+        source = args[1]
+        if not os.path.isdir(source):
+                source = source + '.journal'
+        state_key = '__replay__|' + os.path.realpath(source)
+        if since is None:
+                since = store._load(state_key,0)
+        try:
+                count, last = store.replay(Journal(source).read(since))
+        except ConnectionEntryError, e:
+                sys.stderr.write("%s\n" % e)
+                status = 1
+                return
+        if last is not None:
+                store._store(state_key,last)
+                print "Replayed %d changes from %s (sequence numbers %d to %d)" % (count, source, since + 1, last)
+        else:
+                print "No changes in %s after sequence number %d" % (source, since)
+
+def compile_snapshot(args):
+        """
+                compile
+                Writes the memory mapped snapshot read commands use instead of the logons file
+                until it changes again
+        """
+        if store.is_snapshot():
+                print "%s is up to date" % snapshot_path(dbpath)
+                return
+        count = store.compile()
+        print "Compiled %d records into %s" % (count, snapshot_path(dbpath))
+
+def upgrade(args):
+        """
+                upgrade [-n]
+                Rewrites the entries in the compact record format and reports the record sizes
+                and decoding times before and after. -n only reports.
+        """
+        dry_run = '-n' in args
+        size = os.path.getsize(dbpath)
+        stats = store.upgrade(dry_run)
+        entries = max(stats['entries'],1)
+        print "%s %d of %d entries" % (dry_run and "Would rewrite" or "Rewrote", stats['rewritten'], stats['entries'])
+        print "Record bytes: %d -> %d (%.0f -> %.0f per entry)" % (stats['old_bytes'], stats['new_bytes'],
+                        float(stats['old_bytes']) / entries, float(stats['new_bytes']) / entries)
+        print "Decoding time: %.3fs -> %.3fs (%.1f -> %.1f microseconds per entry)" % (stats['old_seconds'], stats['new_seconds'],
+                        stats['old_seconds'] * 1000000 / entries, stats['new_seconds'] * 1000000 / entries)
+        if not dry_run:
+                print "File size: %d -> %d bytes" % (size, os.path.getsize(dbpath))
+
+def reencrypt_records(items):
+        """ worker: move the RSA encrypted passwords of (name, record) pairs to the data key """
+        results = []
+        for (name, record) in items:
+                entry = decode_record(record)
+                entry.password = worker_keys.encrypt(worker_keys.decrypt(entry.password))
+                results.append((name, record, entry))
+        return results
+
+def migrate_envelope(args):
+        """
+                migrate-envelope [-j <n>]
+                Switches the logons file to envelope mode: a random data key wrapped with the eiw_ctl
+                public key encrypts the passwords. Existing RSA encrypted passwords are re-encrypted
+                in place by <n> worker processes. Both kinds of record can be read at any time,
+                so an interrupted migration can simply be run again. Entries another writer changes
+                meanwhile are left as that writer stored them; running it again migrates them.
+        """
+        args = [a for a in args]
+        jobs = jobs_option(args)
+
+        if store.enable_envelope():
+                print "Created data key"
+
+        def rsa_records():
+                for name in store.names():
+                        record = store.record(name)
+                        if record is None:
+                                continue
+                        entry = decode_record(record)
+                        if entry.password is not None and not is_envelope(entry.password):
+                                yield (name, record)
+
+        count = 0
+        batch = {}
+        progress = Progress('migrated')
+        for (name, record, entry) in parallel_map(reencrypt_records,rsa_records(),jobs,store.keys):
+                store.begin_write()
+                if store.record(name) == record:        # not changed since it was read
+                        store.put(entry,batch)
+                        count = count + 1
+                        if count % 1000 == 0:
+                                store.flush(batch)
+                                store.end_write()
+                progress.tick()
+        store.flush(batch)
+        print "Migrated %d passwords to envelope encryption" % count
+
+def migrate_legacy(args):
+        """
+                migrate-legacy [-j <n>] <old logons.db>
+                Copies the entries of an old shelve logons file into this one, as happens when a new
+                logons.gdbm is created next to a logons.db
+        """
+        args = [a for a in args]
+        jobs = jobs_option(args)
+        if len(args) != 2:
+                sys.stderr.write("Usage: logonmgr migrate-legacy [-j <n>] <old logons.db>\n")
+                sys.exit(1)
+        count, skipped = create_logons_gdbm(args[1],jobs)
+        print "Migrated %d entries, skipped %d already here" % (count, skipped)
+
+def rotate_records(items):
+        """ worker: re-encrypt with the new keys the passwords of (name, record) pairs still under the old keys """
+        results = []
+        for (name, record) in items:
+                entry = decode_record(record)
+                if entry.password is None or worker_keys.is_current(entry.password):
+                        entry = None
+                else:
+                        entry.password = worker_keys.encrypt(worker_keys.decrypt(entry.password))
+                results.append((name, record, entry))
+        return results
+
+def rotate_keys(args):
+        """
+                rotate-keys [-j <n>] [-bits <bits>]
+                Replaces the eiw_ctl key pair and the data key with new ones and re-encrypts every password
+                in <n> worker processes, committing every 500 entries so readers are held up only briefly.
+                Progress is kept in the logons file: run it again to resume an interrupted rotation.
+                Until the rotation is finished passwords are read with the new or the old keys.
+        """
+        args = [a for a in args]
+        jobs = jobs_option(args)
+        try:
+                bits = int(value_option(args,'-bits',512))
+        except (IndexError, ValueError):
+                sys.stderr.write("Usage: logonmgr rotate-keys [-j <n>] [-bits <bits>]\n")
+                sys.exit(1)
+
+        if store.start_rotation(bits):
+                print "Created new %d bit eiw_ctl keys and data key" % bits
+        else:
+                print "Resuming key rotation after %s" % (store.rotation_progress() or 'the start')
+        after = store.rotation_progress() or None
+        keys = store.keys
+        keys.previous.envelope_keys()
+
+        def records():
+                # the names are read up front: writing closes the file an iterator over the name index reads
+                for name in [name for name in store.names() if after is None or name > after]:
+                        record = store.record(name)
+                        if record is not None:
+                                yield (name, record)
+
+        count = 0
+        batch = {}
+        progress = Progress('rotated')
+        for (name, record, entry) in parallel_map(rotate_records,records(),jobs,keys):
+                if entry is not None:
+                        store.begin_write()
+                        if store.record(name) == record:        # not changed since it was read
+                                store.put(entry,batch)
+                                count = count + 1
+                                if count % 500 == 0:
+                                        store.flush(batch)
+                                        store.set_rotation_progress(name)
+                                        store.end_write()
+                progress.tick()
+        store.flush(batch)
+        count = count + store.finish_rotation()
+        print "Rotated keys, re-encrypted %d passwords" % count
+
+def list(args):
+        """
+                list [<pattern>|--prefix <prefix>] [--limit <n>] [--after <connection_name>]
+                list keys of Connection entries, optionally only those matching a glob pattern or
+                starting with prefix, and only n of them after the given name for paging
+        """
+        args = [a for a in args]
+        try:
+                prefix = value_option(args,'--prefix','')
+                after = value_option(args,'--after')
+                limit = value_option(args,'--limit')
+                if limit is not None:
+                        limit = int(limit)
+        except (IndexError, ValueError):
+                sys.stderr.write("Usage: logonmgr list [<pattern>|--prefix <prefix>] [--limit <n>] [--after <connection_name>]\n")
+                sys.exit(1)
+        pattern = None
+        if len(args) > 1:
+                pattern = args[1]
+        import itertools
+        for key in itertools.islice(matching_names(pattern,prefix,after),limit):
+                print key
+
+def matching_names(pattern=None,prefix='',after=None):
+        """
+                Sorted connection names that start with prefix, match the glob pattern (if any) and sort
+                after after (if given). Only the part of the name index that starts with the literal
+                start of the pattern is read.
+        """
+        import fnmatch
+        prefix = prefix.lower()
+        if pattern is None:
+                return store.iter_names(prefix,after)
+        pattern = pattern.lower()
+        scan = glob_prefix(pattern)
+        if prefix.startswith(scan):
+                scan = prefix
+        return (name for name in store.iter_names(scan,after)
+                        if name.startswith(prefix) and fnmatch.fnmatchcase(name,pattern))
 
 def query(args):
         """
@@ -215,123 +3106,156 @@ def query(args):
         #print args
         criteria = []
         params = args[1:]
-        keys = db.keys()
         for arg in args:
                 if '=' in arg:
-                        (searchkey,v) = arg.split('=')
+                        (searchkey,v) = arg.split('=',1)
                         criteria.append((searchkey,v))
-        s_criteria = set(criteria)
-        #print "criteria is: ", s_criteria
-        for key in keys:
-        #       print "value of key is: ",key
-                entry = db[key]
-                if not type(entry) == type(()):
-                        searchattrs = [ x for x in entry.__dict__.items() if x[0] != 'dboptions']
-                        searchset = set(searchattrs)
-                        if s_criteria.issubset(searchset):
-                                print entry
+        #print "criteria is: ", criteria
+        for entry in store.query(**dict(criteria)):
+                print entry
+
+def info(args):
+        """
+                Prints summary information about logonmgr, including version, last date updated, number of entries and path of logons file
+        """
+        print version
+        print "logons file path: %s" % dbpath
+        print "Last modification: %s" % str(time.ctime(os.path.getmtime(dbpath)))
+        print "Number of entries: %d" % store.count()
+        stats = store.stats()
+        if stats is not None:
+                print "Entries without password: %d" % stats['no_password']
+                print "Last entry update: %s" % format_timestamp(stats['last_updt_ts'])
+        if store.rotation_progress() is not None:
+                print "Key rotation: in progress, run rotate-keys to finish it"
+        if store.is_snapshot():
+                print "Snapshot: %s (up to date)" % store.db.path
+        elif os.path.exists(snapshot_path(dbpath)):
+                print "Snapshot: %s (out of date, run compile)" % snapshot_path(dbpath)
+
+def stats(args):
+        """
+                stats [-space]
+                Shows the entry statistics the writers keep current. -space shows how much of the
+                logons file is live data and how its gdbm buckets or SQLite pages are laid out, to tell
+                when it is worth running compact
+        """
+        if '-space' not in args:
+                entry_stats = store.stats()
+                if entry_stats is None:
+                        sys.stderr.write("%s has no entry statistics yet, run logonmgr reindex\n" % dbpath)
+                        sys.exit(1)
+                print "logons file path: %s" % dbpath
+                print "Entries:        %12d" % entry_stats['entries']
+                print "No password:    %12d" % entry_stats['no_password']
+                print "Last update:    %s" % format_timestamp(entry_stats['last_updt_ts'])
+                for attr in ('dbms','server'):
+                        print "By %s:" % attr
+                        counts = entry_stats[attr]
+                        for value in sorted(counts,key=lambda value: (-counts[value], value)):
+                                print "  %-20s %8d" % (value, counts[value])
+                return
+        space = store.space()
+        print "logons file path: %s" % dbpath
+        print "File size:      %12d bytes" % space['file_bytes']
+        print "Live data:      %12d bytes in %d records (%d entries)" % (space['live_bytes'], space['records'], space['entries'])
+        if 'pages' in space:
+                print "Pages:          %12d of %d bytes, %d free" % (space['pages'], space['page_size'], space['free_pages'])
+                print "Unused:         %12d bytes, run logonmgr compact to give them back" % space['unused']
+                return
+        if 'buckets' not in space:
+                print "Free space:     unknown (the gdbm header is in a format logonmgr does not read)"
+                return
+        print "Buckets:        %12d of %d bytes, %d records each, directory of %d entries (%d bits)" % (
+                space['buckets'], space['bucket_size'], space['bucket_elems'], space['dir_entries'], space['dir_bits'])
+        print "Header free list: %10d blocks, %d bytes" % (space['free_blocks'], space['free_bytes'])
+        fragmentation = 100.0 * space['unused'] / max(space['file_bytes'],1)
+        print "Unused:         %12d bytes (%.0f%% of the file)" % (space['unused'], fragmentation)
+        if fragmentation >= 50:
+                print "Run logonmgr compact to give the space back"
+
+def compact(args):
+        """
+                compact [-in-place]
+                Rewrites the logons file without the space left by updates and deletes. By default the
+                records are copied to a new file, which readers do not wait for, and it is swapped in
+                under the write lock; -in-place has gdbm reorganize the file under the write lock.
+                An SQLite logons file is vacuumed
+        """
+        (before, after) = store.compact('-in-place' in args)
+        print "Compacted %s: %d -> %d bytes" % (dbpath, before, after)
 
-def info(args):
+def convert(args):
         """
-                Prints summary information about logonmgr, including version, last date updated, number of entries and path of logons file
+                convert sqlite|gdbm
+                Moves the logons file to the SQLite or gdbm backend, copying it while readers carry on
+                and swapping the copy in under the write lock
         """
-        print version
-        print "logons file path: %s" % dbpath
-        print "Last modification: %s" % str(time.ctime(os.path.getmtime(dbpath)))
-        print "Number of entries: %d" % len(db.keys())
+        if len(args) != 2 or args[1] not in ('sqlite','gdbm'):
+                sys.stderr.write("Usage: logonmgr convert sqlite|gdbm\n")
+                sys.exit(1)
+        if store.backend() == args[1]:
+                print "%s is already a %s logons file" % (dbpath, args[1])
+                return
+        count = store.convert(args[1])
+        print "Converted %s to %s: %d records" % (dbpath, args[1], count)
 
 def export(args):
-        """     Write logons file to pipe-delimited textfile """
-        entry = None
+        """
+                export [-j <n>] [<connection_name>|<pattern>|all [field1 field2 ...]]
+                export [-j <n>] --prefix <prefix> [field1 field2 ...]
+                Write logons file to pipe-delimited textfile. Entries are decrypted and formatted by
+                <n> worker processes and written in connection name order as they finish.
+                The fields, if given, replace the default name|userid|password|server|dbms|database
+        """
+        args = [a for a in args]
+        jobs = jobs_option(args)
+        prefix = value_option(args,'--prefix')
         field_list = []
-        fields = []
-        if len(args) > 1:
-                keys = [args[1]]
+        if prefix is not None:
+                names = [name for name in matching_names(None,prefix)]
+                field_list = args[1:]
         else:
-                keys = sorted(db.keys())
-
-        if len(args) > 2:
-                field_list = args[2:]
-
+                if len(args) > 1 and args[1].lower() != 'all':
+                        if glob_prefix(args[1]) != args[1]:
+                                names = [name for name in matching_names(args[1])]
+                        else:
+                                names = [args[1]]
+                else:
+                        names = store.names()
 
-        for k in keys:
-                try:
-                        if k != 'eiw_ctl':
-                                entry = db[k]
-                                work_password = entry.password
-                                if work_password is None:
-                                        password = ''
-                                else:
-                                        password = rsa.decrypt(entry.password,eiw_ctl[1])
-
-                                if len(field_list):
-                                        for field in field_list:
-                                                if field == 'password':
-                                                        fields.append(password)
-                                                else:
-                                                        fields.append(entry.__dict__[field])
-                                        export_rec = '|'.join(fields)
-                                else:
-                                        export_rec = "%s|%s|%s|%s|%s|%s" % (entry.name, entry.userid, password, entry.server, entry.dbms, entry.database)
-                                print export_rec
-                except KeyError,e:
-                        sys.stderr.write("Invalid Key: Record=%s,key=%s\n" % (entry,e))
+                if len(args) > 2:
+                        field_list = args[2:]
 
+        for (line,error) in stream_lines(names,('export',field_list),jobs):
+                if error is None:
+                        print line
+                else:
+                        sys.stderr.write(error)
 
 def gen_add_cmd(args):
         """
+                gen-add-cmd [-j <n>] <connection_name>|all
                 export a connection name for logonmgr add format
         """
 
         global status
-        keys = []
+        args = [a for a in args]
+        jobs = jobs_option(args)
 
         if args[1].lower() == "all":
-                keys = db.keys()
+                names = store.names()
+                cmd = ''
         else:
-                keys.append(args[1].lower())
-
-        for key in keys:
-                if key == 'eiw_ctl':
-                        continue
-
-                entry = db.get(key.lower(),None)
-                if entry is None:
-                        sys.stderr.write('Connection Entry ' + args[1] + ' not found\n')
-                        status = 1
-
-                userid = ''
-                password = ''
-                server = ''
-                database = ''
-                dbms = ''
-                dboptions = ''
-
-
-                if entry.userid:
-                        userid = "userid=" + entry.userid
-
-                if entry.password:
-                        password = "password=" + rsa.decrypt(entry.password,eiw_ctl[1])
-
-                if entry.server:
-                        server = "server=" + entry.server
-
-                if entry.dbms:
-                        dbms = "dbms=" + entry.dbms
-
-                if entry.database:
-                        database = "database=" + entry.database
+                names = [args[1]]
+                cmd = 'logonmgr add '
 
-                if entry.dboptions:
-                        dboptions = "dboptions=" + '"' + str(entry.dboptions) + '"'
-
-                if args[1].lower() == "all":
-                        cmd = ''
+        for (line,error) in stream_lines(names,('gen-add-cmd',cmd),jobs):
+                if error is None:
+                        print line
                 else:
-                        cmd = 'logonmgr add '
-
-                print "%s %s %s %s %s %s %s %s" % (cmd, entry.name, userid, password, server, database, dbms, dboptions)
+                        sys.stderr.write(error)
+                        status = 1
 
 def add(args):
         """
@@ -343,14 +3267,19 @@ def add(args):
 
         # If connection name already exists print message and exit
 
-        entry = db.get(args[1].lower(),None)
-        if entry != None:
+        if args[1].lower() in store:
                 sys.stderr.write('Connection Entry ' + args[1] + ' Already exists\n')
                 return
 
-        params = args[1:]
-
+        attr_dict = parse_add_params(args[1:])
+        store.add(attr_dict.pop('name'),**attr_dict)
 
+def parse_add_params(params):
+        """
+                Attribute dictionary from add format parameters:
+                <connection_name> <attr1=value1> [<attr2=value2> ...]
+                The password is left in plaintext
+        """
         attr_dict = {'name' : None, 'userid' : None, 'password' : None, 'server' : None, 'database' : None, 'dboptions' : None, 'dbms' : None}
 
         if params[0].find('=') >= 0:
@@ -362,8 +3291,6 @@ def add(args):
 
         for param in params[1:]:
                 key, value = param.split('=',1)
-                if key == 'password':
-                        value = rsa.encrypt(value,eiw_ctl[0])
                 if key == 'dboptions':
                         d = eval(value)
                         if type(d) == types.DictType:
@@ -374,8 +3301,7 @@ def add(args):
                         else:
                                 raise AttributeError, "Invalid keyword:" + key
 
-        entry = ConnectionEntry(attr_dict=attr_dict)
-        db[name] = entry
+        return attr_dict
 
 def update(args):
         """
@@ -388,8 +3314,7 @@ def update(args):
                 sys.stderr.write("Usage: update <connection_name> keyword_args\n")
                 return
 
-        entry = db.get(args[1].lower(),None)
-        if entry is None:
+        if args[1].lower() not in store:
                 sys.stderr.write('Connection Entry ' + args[1] + ' not found\n')
                 return
 
@@ -406,23 +3331,17 @@ def update(args):
                 name = params[0].lower() # force key to be lower case
 
         for param in params[1:]:
-                key, value = param.split('=')
-                if key == 'password':
-                        value = rsa.encrypt(value,eiw_ctl[0])
+                key, value = param.split('=',1)
                 if key == 'dboptions':
                         d = eval(value)
                         if type(d) == types.DictType:
-                                if not entry.dboptions:
-                                        entry.dboptions = {}
-                                entry.dboptions.update(d)
+                                attr_dict['dboptions'] = d
                 else:
                         if key in valid_attr_names:
-                                entry.__dict__[key] = value
+                                attr_dict[key] = value
                         else:
                                 raise AttributeError, "Invalid keyword:" + key
-        entry.last_update_userid = os.environ['USER']
-        entry.last_updt_ts = str(datetime.datetime.now())
-        db[name] = entry
+        store.update(name,**attr_dict)
         print "updated %s" % name
 
 def rm_options(args):
@@ -439,7 +3358,7 @@ def rm_options(args):
                 return
 
         name = args[1]
-        entry = db.get(args[1].lower(),None)
+        entry = store.get(name)
         if entry is None:
                 sys.stderr.write('Connection Entry ' + args[1] + ' not found\n')
                 return
@@ -467,9 +3386,7 @@ def rm_options(args):
                                 print "%s is not in dboptions dictionary." % param
 
         if there_were_updates:
-                entry.last_update_userid = os.environ['USER']
-                entry.last_updt_ts = str(datetime.datetime.now())
-                db[name] = entry
+                store.save(entry)
                 print "updated dboptions for %s" % name
         else:
                 print "There was nothing to update for entry %s" % args[1]
@@ -479,7 +3396,7 @@ def getattr(args):
         """
                 getattr
                 getattr is used to dynamically get the value of an attribute by name
-                uses the __dict__ dictionary of object to retrieve the attribute
+                uses the value method of the entry to retrieve the attribute
         """
 
         global status
@@ -488,15 +3405,104 @@ def getattr(args):
                 sys.stderr.write("Usage: logonmgr %s <connection_name>\n" % args[0])
                 sys.exit(1)
 
-        entry = db.get(args[1].lower(),None)
+        entry = store.get(args[1])
         if entry is None:
                 sys.stderr.write('Connection Entry ' + args[1] + ' not found\n')
                 status = 1
                 return
         if len(args) > 2 and args[0] == 'password' and args[2] == 'decrypt' and entry.password != None:
-                print rsa.decrypt(entry.__dict__[args[0]],eiw_ctl[1])
+                print store.decrypt_password(entry)
         else:
-                print entry.__dict__[args[0]]
+                print entry.value(args[0])
+
+def get_values(args):
+        """
+                get [-format shell|json|nul] [-attrs attr1,attr2,...] <connection_name>[:attr1,attr2,...] ...
+                Retrieves several attributes of several entries with one open of the logons file.
+                The attribute list after a connection name overrides -attrs (default userid,password).
+                Passwords are decrypted, but only when asked for.
+                  shell: export <NAME>_<ATTR>='value' lines, for eval in wrapper scripts; characters
+                         other than letters, digits and _ become _, and a leading digit gets a _ prefix
+                  json:  one object of connection name -> attribute -> value, without the entries
+                         with values that are not UTF-8 text
+                  nul:   name, attribute and value of each pair, each terminated by a NUL byte
+        """
+        global status
+        import json, pipes
+        args = [a for a in args[1:]]
+        out_format = 'shell'
+        default_attrs = ['userid','password']
+        while args and args[0] in ('-format','-attrs'):
+                if len(args) < 2:
+                        sys.stderr.write("Usage: logonmgr get [-format shell|json|nul] [-attrs attr1,attr2,...] <connection_name>[:attrs] ...\n")
+                        sys.exit(1)
+                if args[0] == '-format':
+                        out_format = args[1]
+                else:
+                        default_attrs = args[1].split(',')
+                del args[0:2]
+
+        if out_format not in ('shell','json','nul') or not args:
+                sys.stderr.write("Usage: logonmgr get [-format shell|json|nul] [-attrs attr1,attr2,...] <connection_name>[:attrs] ...\n")
+                sys.exit(1)
+
+        requests = []
+        for arg in args:
+                if ':' in arg:
+                        name, attrs = arg.split(':',1)
+                        attrs = attrs.split(',')
+                else:
+                        name, attrs = arg, default_attrs
+                for attr in attrs:
+                        if attr not in getter_attrs:
+                                raise AttributeError, "Invalid attribute: %s" % attr
+                requests.append((name.lower(),attrs))
+
+        entries = store.get_many([name for (name,attrs) in requests])
+        results = []
+        for (name,attrs) in requests:
+                entry = entries[name]
+                if entry is None:
+                        sys.stderr.write('Connection Entry ' + name + ' not found\n')
+                        status = 1
+                        continue
+                values = []
+                for attr in attrs:
+                        if attr == 'password':
+                                values.append((attr,store.decrypt_password(entry)))
+                        else:
+                                values.append((attr,entry.value(attr)))
+                results.append((name,values))
+
+        if out_format == 'json':
+                objects = {}
+                for (name,values) in results:
+                        try:
+                                json.dumps(dict(values))
+                        except UnicodeDecodeError:
+                                # JSON strings are text: a password of other bytes only comes out as nul fields
+                                sys.stderr.write('Connection Entry ' + name + ' has a value that is not UTF-8 text, use -format nul\n')
+                                status = 1
+                                continue
+                        objects[name] = dict(values)
+                print json.dumps(objects,sort_keys=True)
+                return
+        exported = {}   # shell variable -> connection name it was exported for
+        for (name,values) in results:
+                for (attr,value) in values:
+                        if value is None:
+                                value = ''
+                        if out_format == 'shell':
+                                var = re.sub('[^A-Za-z0-9_]','_',name + '_' + attr).upper()
+                                if var[0].isdigit():
+                                        var = '_' + var
+                                if exported.setdefault(var,name) != name:
+                                        sys.stderr.write('Connection Entries %s and %s both export %s, use -format json or nul\n' % (exported[var], name, var))
+                                        status = 1
+                                        continue
+                                sys.stdout.write("export %s=%s\n" % (var, pipes.quote(str(value))))
+                        else:
+                                sys.stdout.write("%s\0%s\0%s\0" % (name, attr, value))
 
 def setattr(args):
         """
@@ -512,27 +3518,20 @@ def setattr(args):
         else:
                 raise AttributeError, "Invalid attribute: %s" % args[2]
 
-        entry = db.get(args[1].lower(),None)
-        if entry is None:
+        if args[1].lower() not in store:
                 sys.stderr.write('Connection Entry ' + args[1] + ' not found\n')
                 return
 
-        if      args[2] == 'password':
-                password = rsa.encrypt(args[3],eiw_ctl[0])
-                entry.password = password
-        elif args[2] == 'dboptions':
+        if args[2] == 'dboptions':
                 d = eval(args[3])
                 if type(d) == types.DictType:
-                        entry.dboptions.update(d)
+                        value = d
                 else:
                         raise TypeError, "%s cannot be converted to a dictionary type!" % args[3]
         else:
-                entry.__dict__[args[2]] = args[3]
+                value = args[3]
 
-        entry.last_updt_ts = str(datetime.datetime.now())
-        entry.last_updt_userid = os.environ['USER']
-
-        db[args[1].lower()] = entry
+        store.update(args[1],**{args[2] : value})
 
 def show(args):
         """
@@ -545,7 +3544,7 @@ def show(args):
                 sys.stderr.write( "usage: logonmgr show <connection_name>\n")
                 sys.exit(1)
 
-        entry = db.get(args[1].lower(),None)
+        entry = store.get(args[1])
         if entry is None:
                 sys.stderr.write('Connection Entry ' + args[1] + ' not found\n')
                 status = 1
@@ -559,60 +3558,470 @@ def delete(args):
                 delete ConnectionEntry from logons file
         """
 
-        entry = db.get(args[1].lower(),None)
+        entry = store.get(args[1])
         if entry is None:
                 sys.stderr.write('Connection Entry ' + args[1] + ' not found\n')
-        del db[entry.name]
+                return
+        store.delete(entry.name)
         print "Entry " + entry.name + " deleted."
 
+# commands a batch may contain
+batch_cmds = ['add','set','update','delete','rm-options']
+
+def batch(args):
+        """
+                batch [-n]
+                Reads add, set, update, delete and rm-options command lines from stdin (with or without
+                a leading logonmgr, quoted as in the shell, # comments allowed) and runs them under one
+                write lock as one transaction: they are committed together, or not at all if any line
+                fails. Prints the result of each line. -n runs the lines and rolls them back.
+        """
+        global status
+        import shlex
+        dry_run = '-n' in args
+        store.begin_transaction()
+        count = 0
+        failed = 0
+        for (lineno, line) in enumerate(sys.stdin,1):
+                try:
+                        words = shlex.split(line,comments=True)
+                except ValueError, e:
+                        words = None
+                        (ok, output) = (False, "%s\n" % e)
+                if words and os.path.basename(words[0]) in ('logonmgr','logonmgr.py'):
+                        words = words[1:]
+                if words == []:
+                        continue
+                if words is not None:
+                        if words[0] not in batch_cmds:
+                                (ok, output) = (False, "%s is not allowed in a batch (%s only)\n" % (words[0], ', '.join(batch_cmds)))
+                        else:
+                                (ok, output) = run_batch_line(words)
+                count = count + 1
+                if not ok:
+                        failed = failed + 1
+                output = output.rstrip('\n').replace('\n','\n\t')
+                print "line %d: %s%s" % (lineno, ok and 'ok' or 'FAILED', output and '\n\t' + output or '')
+        if failed or dry_run:
+                store.rollback()
+                if failed:
+                        print "Rolled back %d commands, %d failed" % (count, failed)
+                        status = 1
+                else:
+                        print "Rolled back %d commands (-n)" % count
+        else:
+                store.commit()
+                print "Committed %d commands" % count
+
+def run_batch_line(words):
+        """ runs one command of a batch, returns whether it succeeded and what it printed """
+        global status
+        out = cStringIO.StringIO()
+        err = cStringIO.StringIO()
+        saved = (sys.stdout, sys.stderr)
+        status = 0
+        ok = True
+        sys.stdout, sys.stderr = out, err
+        try:
+                try:
+                        cmds[words[0]](words)
+                except SystemExit, e:
+                        ok = not e.code
+                except LockTimeout:
+                        raise
+                except Exception, e:
+                        err.write("%s\n" % e)
+                        ok = False
+        finally:
+                sys.stdout, sys.stderr = saved
+        # the commands report missing and duplicate entries on stderr without failing
+        ok = ok and status == 0 and not err.getvalue()
+        status = 0
+        return (ok, out.getvalue() + err.getvalue())
+
+def jobs_option(args):
+        """
+                Removes a -j <n> option from args and returns the number of worker processes,
+                which defaults to $LOGONMGR_JOBS or the number of cpus (1 in the lookup daemon)
+        """
+        import multiprocessing
+        if serving:
+                jobs = 1
+        else:
+                jobs = int(os.environ.get('LOGONMGR_JOBS',0)) or multiprocessing.cpu_count()
+        if '-j' in args:
+                i = args.index('-j')
+                jobs = int(args[i + 1])
+                del args[i:i + 2]
+        return max(jobs,1)
+
+def value_option(args,option,default=None):
+        """ Removes an <option> <value> pair from args and returns the value, default if it is not there """
+        if option not in args:
+                return default
+        i = args.index(option)
+        value = args[i + 1]
+        del args[i:i + 2]
+        return value
+
+def init_worker(keys):
+        """ pool initializer: worker processes only need the KeyRing, never the open logons file """
+        global worker_keys, store
+        worker_keys = keys
+        store = None
+
+def iter_chunks(items,size):
+        chunk = []
+        for item in items:
+                chunk.append(item)
+                if len(chunk) >= size:
+                        yield chunk
+                        chunk = []
+        if chunk:
+                yield chunk
+
+def parallel_map(func,items,jobs,keys,chunk_size=200):
+        """
+                Applies func to chunks of items in a pool of jobs worker processes and yields
+                the results in input order. func takes a list of items and returns a list of results;
+                it finds the KeyRing keys in worker_keys.
+                At most two chunks per worker are in flight, so items may be a stream of any length.
+                With jobs == 1 everything runs in this process.
+        """
+        global worker_keys
+        import multiprocessing, collections
+        chunks = iter_chunks(items,chunk_size)
+        keys.envelope_keys()    # unwrap once here rather than in every worker
+        if jobs <= 1:
+                worker_keys = keys
+                for chunk in chunks:
+                        for result in func(chunk):
+                                yield result
+                return
+
+        pool = multiprocessing.Pool(jobs,init_worker,(keys,))
+        try:
+                pending = collections.deque()
+                for chunk in chunks:
+                        pending.append(pool.apply_async(func,(chunk,)))
+                        if len(pending) >= jobs * 2:
+                                for result in pending.popleft().get():
+                                        yield result
+                while pending:
+                        for result in pending.popleft().get():
+                                yield result
+        finally:
+                pool.terminate()
+                pool.join()
+
+class Progress(object):
+        """ periodic progress line on stderr for long running commands """
+        def __init__(self,what,interval=2.0):
+                self.what = what
+                self.interval = interval
+                self.start = time.time()
+                self.last = self.start
+                self.count = 0
+
+        def tick(self,n=1):
+                self.count += n
+                now = time.time()
+                if now - self.last >= self.interval:
+                        self.last = now
+                        self.report()
+
+        def report(self):
+                elapsed = max(time.time() - self.start,0.001)
+                sys.stderr.write("%s %d records in %.1fs (%d/s)\n" % (self.what, self.count, elapsed, self.count / elapsed))
+
+def export_line_entries(lines):
+        """ worker: parse and encrypt numbered pipe-delimited export lines """
+        results = []
+        for (lineno,line) in lines:
+                try:
+                        (name,userid,password,server,dbms,database) = line.rstrip().split('|')
+                        newentry = ConnectionEntry(name.lower(),userid=userid,password=worker_keys.encrypt(password),server=server, database=database,dbms=dbms)
+                        results.append((lineno,newentry,None))
+                except Exception, e:
+                        results.append((lineno,None,'%s: %s' % (e, line.rstrip())))
+        return results
+
+def export_fields(entry,password,fields):
+        """ export line of an entry: name|userid|password|server|dbms|database or the given fields """
+        if not fields:
+                return "%s|%s|%s|%s|%s|%s" % (entry.name, entry.userid, password, entry.server, entry.dbms, entry.database)
+        values = []
+        for field in fields:
+                if field == 'password':
+                        values.append(password)
+                elif field in entry_fields:
+                        values.append(entry.value(field))
+                else:
+                        raise KeyError(field)
+        return '|'.join(values)
+
+def add_cmd_line(entry,password,cmd):
+        """ gen-add-cmd line of an entry """
+        userid = ''
+        server = ''
+        database = ''
+        dbms = ''
+        dboptions = ''
+
+        if entry.userid:
+                userid = "userid=" + entry.userid
+
+        if password is None:
+                password = ''
+        else:
+                password = "password=" + password
+
+        if entry.server:
+                server = "server=" + entry.server
+
+        if entry.dbms:
+                dbms = "dbms=" + entry.dbms
+
+        if entry.database:
+                database = "database=" + entry.database
+
+        if entry.dboptions:
+                dboptions = "dboptions=" + '"' + str(entry.dboptions) + '"'
+
+        return "%s %s %s %s %s %s %s %s" % (cmd, entry.name, userid, password, server, database, dbms, dboptions)
+
+def format_records(records):
+        """
+                worker: decode, decrypt and format (name, stored record, spec) items as export lines
+                (spec ('export', fields)) or gen-add-cmd lines (spec ('gen-add-cmd', command prefix)).
+                Returns (line, None) or (None, error message) for each item
+        """
+        results = []
+        for (name,data,(kind,arg)) in records:
+                entry = None
+                try:
+                        if data is None:
+                                raise KeyError(name)
+                        entry = decode_record(data)
+                        password = None
+                        if entry.password is not None and (kind != 'export' or not arg or 'password' in arg):
+                                password = worker_keys.decrypt(entry.password)
+                        if kind == 'export':
+                                if password is None:
+                                        password = ''
+                                results.append((export_fields(entry,password,arg),None))
+                        else:
+                                results.append((add_cmd_line(entry,password,arg),None))
+                except KeyError, e:
+                        if kind == 'export':
+                                results.append((None,"Invalid Key: Record=%s,key=%s\n" % (entry,e)))
+                        else:
+                                results.append((None,'Connection Entry ' + name + ' not found\n'))
+        return results
+
+def stream_lines(names,spec,jobs,chunk_size=200):
+        """
+                Yields the export or gen-add-cmd lines (see format_records) of the named entries in
+                order. Stored records are read here and decoded, decrypted and formatted by the worker
+                pool, so memory stays flat whatever the number of entries.
+        """
+        if not names:
+                return iter([])
+        if len(names) <= chunk_size:
+                jobs = 1        # not worth starting a pool
+        records = ((name,store.record(name),spec) for name in names)
+        return parallel_map(format_records,records,jobs,store.keys,chunk_size)
+
+def add_line_entries(lines):
+        """ worker: parse and encrypt numbered add format lines """
+        results = []
+        for (lineno,line) in lines:
+                try:
+                        results.append((lineno,new_entry(worker_keys,parse_add_params(line.split())),None))
+                except Exception, e:
+                        results.append((lineno,None,'%s: %s' % (e, line.rstrip())))
+        return results
+
+def bulk_load(path,worker,jobs,replace=True,batch_size=1000):
+        """
+                Streams the lines of path through worker in a process pool and writes the
+                resulting entries in input order, committing them and releasing the write lock
+                every batch_size entries.
+                With replace False, entries that already exist (in the file or earlier in the
+                input) are rejected, as the add command does.
+                Returns the number of entries written and the list of rejected (line number, reason).
+        """
+        text_file = open(path)
+        lines = ((lineno,line) for (lineno,line) in enumerate(text_file,1) if line.strip())
+        count = 0
+        rejected = []
+        loaded = set()
+        batch = {}
+        progress = Progress('loaded')
+        for (lineno,entry,error) in parallel_map(worker,lines,jobs,store.keys):
+                if error is None and not replace and (entry.name in loaded or entry.name in store):
+                        error = 'Connection Entry %s Already exists' % entry.name
+                if error is not None:
+                        rejected.append((lineno,error))
+                        continue
+                store.put(entry,batch)
+                loaded.add(entry.name)
+                count = count + 1
+                progress.tick()
+                if count % batch_size == 0:
+                        store.flush(batch)
+                        store.end_write()       # let waiting readers in between batches
+        store.flush(batch)
+        store.sync()
+        text_file.close()
+        progress.report()
+        return count, rejected
+
+def report_rejected(rejected):
+        if rejected:
+                print "Rejected %d lines:" % len(rejected)
+                for (lineno,error) in rejected:
+                        print "  line %d: %s" % (lineno, error)
+
 def load_from_textfile(args):
+        """
+                load_from_textfile [-j <n>] filename
+                Loads entries in the pipe-delimited export format. Passwords are encrypted in
+                a pool of worker processes and the entries are written in file order.
+        """
+        args = [a for a in args]
+        jobs = jobs_option(args)
         if len(args) < 2:
                 sys.stderr.write("Filename is required.\n")
                 sys.exit(2)
-        text_file = open(args[1])
         print "processing file: " + args[1]
-        count = 0
-        for line in text_file:
-                try:
-                        (name,userid,password,server,dbms,database) = line.rstrip().split('|')
-                        newentry = ConnectionEntry(name.lower(),userid=userid,password=rsa.encrypt(password,eiw_ctl[0]),server=server, database=database,dbms=dbms)
-                        db[name.lower()] = newentry
-                        print "Imported " + name
-                        count = count + 1
-                except Exception, e:
-                        print 'Error processing record: %s. Error=%s\n' % (line,e)
+        count, rejected = bulk_load(args[1],export_line_entries,jobs)
+        report_rejected(rejected)
         print "Imported %s records" % count
 
 def bulk_add(args):
         """
-        bulk_add <logon_args_file>
+        bulk_add [-j <n>] <logon_args_file>
         Adds several entries to a logonmgrdb that are in connection name and key=value format.
+        Entries that already exist are rejected, as with the add command.
         """
+        args = [a for a in args]
+        jobs = jobs_option(args)
         if len(args) < 2:
-                print >> sys.stderr, "Usage: logonmgr bulk_add <args_file>"
+                print >> sys.stderr, "Usage: logonmgr bulk_add [-j <n>] <args_file>"
                 sys.exit(1)
 
-        args_file_path = args[1]
-        f = open(args_file_path)
-        for line in f:
-                add_args = ['add']
-                add_args += line.strip().split()
-                add(add_args)
-
+        count, rejected = bulk_load(args[1],add_line_entries,jobs,replace=False)
+        report_rejected(rejected)
+        print "Added %s records" % count
 
-def import_logons(args):
+def adwlogon_changes(directory,state):
         """
-                import dbaccess|adwlogons
-                Imports logon information from either the HOME/dbaccess files or from
-                the centralized adw logon file
+                (stamps, digests, changed) of the ADW logon files in directory, where changed lists the
+                (file name, logon string) pairs whose content differs from the digests in state.
+                A file whose size and mtime are those in state is not read.
         """
+        import glob, hashlib
+        stamps = {}
+        digests = {}
+        changed = []
+        for path in sorted(glob.glob(os.path.join(directory,'*logon.dat'))):
+                f = os.path.basename(path)
+                try:
+                        st = os.stat(path)
+                        stamp = (st.st_mtime, st.st_size)
+                        if state['stamps'].get(f) == stamp and f in state['digests']:
+                                stamps[f] = stamp
+                                digests[f] = state['digests'][f]
+                                continue
+                        logon_string = open(path,'r').read().strip()
+                except (IOError, OSError):
+                        print "%s is not readable. Cannot import." % f
+                        continue
+                stamps[f] = stamp
+                digests[f] = hashlib.md5(logon_string).hexdigest()
+                if state['digests'].get(f) == digests[f]:
+                        continue
+                if logon_string == '':
+                        print "logon for %s is empty. Skipped." % f
+                        continue
+                changed.append((f, logon_string))
+        return (stamps, digests, changed)
 
+def dbaccess_changes(path,state):
+        """
+                (stamps, digests, changed) of the dbaccess dbm file at path, where changed lists the
+                (key, value) pairs that differ from the digests in state. The file is not read if
+                none of its files changed size or mtime.
+        """
+        import dbm, hashlib
+        stamps = {}
+        for f in (path, path + '.db', path + '.pag', path + '.dir'):
+                if os.path.exists(f):
+                        st = os.stat(f)
+                        stamps[f] = (st.st_mtime, st.st_size)
+        if stamps and stamps == state['stamps']:
+                return (stamps, state['digests'], [])
+        digests = {}
+        changed = []
+        dbaccess = dbm.open(path)
         try:
-                adwlogon_dir = os.environ['ADWCMNDIR'] + '/td/env'
-        except Exception, e:
-                sys.stderr.write("Could not access ETLCMNDIR environment variable: %s\n" % e)
-                sys.exit(2)
+                for key in dbaccess.keys():
+                        value = dbaccess[key]
+                        digests[key] = hashlib.md5(value).hexdigest()
+                        if state['digests'].get(key) != digests[key]:
+                                changed.append((key, value))
+        finally:
+                dbaccess.close()
+        return (stamps, digests, changed)
+
+def adwlogon_entries(items):
+        """ worker: parse and encrypt (file name, logon string) pairs of ADW logon files """
+        results = []
+        for (f, logon_string) in items:
+                try:
+                        logon_pos = logon_string.find('.logon')
+                        if logon_pos >= 0:
+                                connection_string = logon_string[logon_pos + 6:]
+                        else:
+                                connection_string = logon_string
+                        tpid,logonpwd = connection_string.split('/')
+                        logon, password = logonpwd.split(',')
+                        connection_name, ext_string = os.path.splitext(f)
+                        attrs = { 'name' : connection_name.lower(), 'server': tpid, 'dbms': 'teradata',
+                                        'userid':logon,'password':worker_keys.encrypt(password)}
+                        results.append((f,ConnectionEntry(attr_dict=attrs),None))
+                except Exception, e:
+                        results.append((f,None,'%s: %s' % (f, e)))
+        return results
+
+def dbaccess_entries(items):
+        """ worker: parse and encrypt (key, 'userid,password') pairs of the dbaccess file """
+        results = []
+        for (key, value) in items:
+                try:
+                        userid, password = value.split(',')
+                        newentry = ConnectionEntry(key.lower(),userid=userid,password=worker_keys.encrypt(password), database=key,dbms='db2')
+                        results.append((key,newentry,None))
+                except Exception, e:
+                        results.append((key,None,'%s: %s' % (key, e)))
+        return results
 
+def import_logons(args):
+        """
+                import_logons [-j <n>] [-full] dbaccess|adwlogons
+                Imports logon information from either the HOME/dbaccess files or from
+                the centralized adw logon file. Only the logons that changed since the last
+                import are parsed, encrypted by <n> worker processes and written; the size, mtime
+                and content digest of each source are kept in the logons file to tell.
+                -full imports every logon again
+        """
+        global status
+        args = [a for a in args]
+        jobs = jobs_option(args)
+        full = '-full' in args
+        if full:
+                args.remove('-full')
 
         if len(args) < 2:
                 sys.stderr.write("dbaccess or adwlogons type required!\n")
@@ -620,47 +4029,275 @@ def import_logons(args):
 
         if args[1] == "dbaccess":
                 print "importing dbaccess file"
-                dbaccess = dbm.open(os.environ['HOME'] + '/dbaccess')
-                keys = dbaccess.keys()
-                for key in keys:
-                        userid, password = dbaccess[key].split(',')
-                        newentry = ConnectionEntry(key.lower(),userid=userid,password=rsa.encrypt(password,eiw_ctl[0]), database=key,dbms='db2')
-                        db[key.lower()] = newentry
-                        print "added %s" % key.lower()
+                source = os.environ['HOME'] + '/dbaccess'
+                (changes, worker) = (dbaccess_changes, dbaccess_entries)
         elif args[1] == "adwlogons":
                 print "importing logons from ADW logon files"
-                os.chdir(adwlogon_dir)
-                files = glob.glob('*logon.dat')
-                for f in files:
-                        if os.access(f,os.R_OK):
-                                logon_string = open(f,'r').read().strip()
-                                print f + ":" + logon_string
-                                if logon_string == '':
-                                 print "logon for %s is empty. Skipped." % f
-                                 continue
-                                logon_pos = logon_string.find('.logon')
-                                if logon_pos >= 0:
-                                        connection_string = logon_string[logon_pos + 6:]
-                                else:
-                                        connection_string = logon_string
-                                tpid,logonpwd = connection_string.split('/')
-                                logon, password = logonpwd.split(',')
-                                dbms = 'teradata'
-                                connection_name, ext_string = os.path.splitext(f)
-                                password = rsa.encrypt(password,eiw_ctl[0])
-                                attrs = { 'name' : connection_name.lower(), 'server': tpid, 'dbms':dbms,
-                                                'userid':logon,'password':password}
-                                print attrs
-                                entry = ConnectionEntry(attr_dict=attrs)
-                                db[connection_name.lower()] = entry
-                        else:
-                                print "%s is not readable. Cannot import." % f
+                try:
+                        source = os.environ['ADWCMNDIR'] + '/td/env'
+                except Exception, e:
+                        sys.stderr.write("Could not access ADWCMNDIR environment variable: %s\n" % e)
+                        sys.exit(2)
+                (changes, worker) = (adwlogon_changes, adwlogon_entries)
         else:
                 sys.stderr.write(args[1] + ' is an invalid import type\n')
+                sys.exit(2)
+
+        state_key = '__import__|%s|%s' % (args[1], os.path.realpath(source))
+        state = store._load(state_key)
+        if full or state is None:
+                state = {'stamps' : {}, 'digests' : {}}
+        (stamps, digests, changed) = changes(source,state)
+
+        unchanged = len(digests) - len(changed)
+        count = 0
+        batch = {}
+        for (item,entry,error) in parallel_map(worker,changed,jobs,store.keys):
+                if error is not None:
+                        sys.stderr.write(error + '\n')
+                        status = 1
+                        # so it is tried again next time: ADW stamps are per logon file,
+                        # the dbaccess ones per file of the dbm, which has to be read again
+                        if item in stamps:
+                                del stamps[item]
+                        else:
+                                stamps.clear()
+                        digests.pop(item,None)
+                        continue
+                store.put(entry,batch)
+                print "imported %s" % entry.name
+                count = count + 1
+                if count % 1000 == 0:
+                        store.flush(batch)
+                        store.end_write()       # let waiting readers in between batches
+        if stamps != state['stamps'] or digests != state['digests']:
+                store._store(state_key,{'stamps' : stamps, 'digests' : digests})
+        store.flush(batch)
+        print "Imported %d changed logons, %d unchanged" % (count, unchanged)
+
+def socket_path():
+        """
+                Path of the lookup daemon socket for the current logons file.
+                LOGONMGR_SOCKET overrides the default of <logons file>.sock
+        """
+        return os.environ.get('LOGONMGR_SOCKET', dbpath + '.sock')
+
+def store_signature(path):
+        """ (mtime, size, inode, write generation) of a logons file, used to detect that it has been rewritten """
+        st = os.stat(path)
+        (mtime, size) = (st.st_mtime, st.st_size)
+        try:
+                # an SQLite logons file commits to its write-ahead log
+                wal = os.stat(path + '-wal')
+                (mtime, size) = (max(mtime,wal.st_mtime), size + wal.st_size)
+        except OSError:
+                pass
+        return (mtime, size, st.st_ino, store_generation(path))
+
+def store_generation(path):
+        """
+                Number of writes committed to the logons file at path, from <path>.gen; 0 before the first.
+                Opening the file makes NFS clients check for a newer copy, unlike the attributes stat returns.
+        """
+        try:
+                f = open(path + '.gen','rb')
+        except IOError:
+                return 0
+        try:
+                data = f.read(32).strip()
+        finally:
+                f.close()
+        return data.isdigit() and int(data) or 0
+
+def bump_generation(path):
+        """ counts a committed write in <path>.gen, rewritten in place in one write, under the write lock """
+        try:
+                fd = os.open(path + '.gen',os.O_RDWR | os.O_CREAT,stat.S_IMODE(os.stat(path).st_mode) & 0666)
+        except OSError:
+                return          # readers still compare the size, mtime and inode
+        try:
+                data = os.read(fd,32).strip()
+                os.lseek(fd,0,0)
+                os.write(fd,'%020d\n' % ((data.isdigit() and int(data) or 0) + 1))
+        finally:
+                os.close(fd)
+
+def sync_directory(path):
+        """ makes a rename to path durable """
+        fd = os.open(os.path.dirname(os.path.abspath(path)),os.O_RDONLY)
+        try:
+                os.fsync(fd)
+        finally:
+                os.close(fd)
+
+class LookupService(object):
+        """
+                Resident lookup daemon. Keeps a copy of the logons file and the eiw_ctl keys
+                in memory and answers the read commands in served_cmds.
+                The copy is reloaded whenever the logons file signature changes, so the daemon
+                never holds the gdbm file open and never blocks writers.
+                Requests are answered one at a time: the commands print their answers, so run_command
+                points sys.stdout and sys.stderr at buffers for the whole process while it holds
+                self.lock. The server threads only overlap in reading requests and writing replies,
+                which is plenty for lookups answered from memory.
+        """
+        def __init__(self,store_path):
+                import threading
+                self.store_path = store_path
+                self.signature = None
+                self.lock = threading.Lock()
+                self.reload()
+
+        def reload(self):
+                """ load the logons file into memory if it changed since the last load """
+                global store
+                signature = store_signature(self.store_path)
+                if signature == self.signature:
+                        return
+                source = LogonStore(self.store_path,'r')
+                try:
+                        records = {}
+                        for key in source.db.iter_keys():
+                                records[key] = source.db.record(key)
+                finally:
+                        source.close()
+                store = LogonStore(self.store_path,db=RecordBackend(records))
+                self.signature = signature
+
+        def run_command(self,args):
+                """ run a served command against the in-memory copy and capture its output """
+                global status
+                out = cStringIO.StringIO()
+                err = cStringIO.StringIO()
+                self.lock.acquire()
+                saved = (sys.stdout, sys.stderr)
+                try:
+                        try:
+                                self.reload()
+                        except Exception, e:
+                                # keep answering from the last good copy, e.g. while a writer holds the file
+                                if self.signature is None:
+                                        raise
+                        status = 0
+                        sys.stdout, sys.stderr = out, err
+                        try:
+                                cmds[args[0]](args)
+                        except SystemExit, e:
+                                if e.code:
+                                        status = e.code
+                        except Exception, e:
+                                err.write("%s\n" % e)
+                                status = 1
+                finally:
+                        sys.stdout, sys.stderr = saved
+                        self.lock.release()
+                return {'status' : status, 'stdout' : out.getvalue(), 'stderr' : err.getvalue()}
+
+        def handle(self,line):
+                """
+                        One request per connection: a JSON object with the logons file path and the
+                        command arguments, answered with a JSON object holding status, stdout and stderr.
+                """
+                import json
+                try:
+                        request = json.loads(line)
+                        args = [str(a) for a in request['args']]
+                        if os.path.realpath(request['dbpath']) != os.path.realpath(self.store_path):
+                                reply = {'served' : False} # client is asking about another logons file
+                        elif not args or args[0] not in served_cmds:
+                                reply = {'served' : False}
+                        else:
+                                reply = self.run_command(args)
+                                reply['served'] = True
+                        reply = json.dumps(reply)
+                except Exception, e:
+                        reply = json.dumps({'served' : False})
+                return reply + '\n'
+
+def serve(args):
+        """
+                serve [socket_path]
+                Runs the resident lookup daemon for the current logons file until terminated
+        """
+        global serving
+        import socket, signal, SocketServer
+
+        if len(args) > 1:
+                path = args[1]
+        else:
+                path = socket_path()
+
+        if os.path.exists(path):
+                try:
+                        probe = socket.socket(socket.AF_UNIX,socket.SOCK_STREAM)
+                        probe.connect(path)
+                        probe.close()
+                        sys.stderr.write("A logonmgr daemon is already listening on %s\n" % path)
+                        sys.exit(1)
+                except socket.error:
+                        os.remove(path) # stale socket left by a daemon that died
+
+        serving = True
+        store.close()
+        service = LookupService(dbpath)
+
+        class LookupHandler(SocketServer.StreamRequestHandler):
+                def handle(self):
+                        self.wfile.write(service.handle(self.rfile.readline()))
+
+        umask = os.umask(0077)          # the socket is created private, no other user can connect in between
+        try:
+                server = SocketServer.ThreadingUnixStreamServer(path,LookupHandler)
+        finally:
+                os.umask(umask)
+        server.daemon_threads = True
+        os.chmod(path,0600)
+
+        def shutdown(signum,frame):
+                raise SystemExit(0)
+        signal.signal(signal.SIGTERM,shutdown)
+
+        print "logonmgr daemon serving %s on %s" % (dbpath, path)
+        sys.stdout.flush()
+        try:
+                server.serve_forever()
+        finally:
+                server.server_close()
+                if os.path.exists(path):
+                        os.remove(path)
+
+def client_request(args):
+        """
+                Sends a served command to a running lookup daemon.
+                Returns the daemon's exit status, or None if no daemon answered, in which case
+                the caller opens the logons file itself.
+        """
+        path = socket_path()
+        if not os.path.exists(path):
+                return None
+        import socket, json
+        try:
+                sock = socket.socket(socket.AF_UNIX,socket.SOCK_STREAM)
+                sock.connect(path)
+                sock.sendall(json.dumps({'dbpath' : dbpath, 'args' : args}) + '\n')
+                f = sock.makefile('rb')
+                reply = f.readline()
+                f.close()
+                sock.close()
+                reply = json.loads(reply)
+        except (socket.error, ValueError):
+                return None
+        if not reply.get('served',False):
+                return None
+        sys.stdout.write(reply['stdout'].encode('utf-8'))
+        sys.stderr.write(reply['stderr'].encode('utf-8'))
+        return reply['status']
 
 def usage():
 
-        print """ logonmgr [-l] [-f/ile logonfilename] <command> <args>
+        if not command_help:
+                register_help_commands()
+        print """ logonmgr [-timing] [-l] [-f/ile logonfilename] <command> <args>
                                 commands:
                         """
         c_list = command_help.keys()
@@ -686,6 +4323,9 @@ def help_general(args):
                                 -f/ile  <logonfile>      This options lets you specify a datastore path other than the
                                                 default or $HOME logons file.
                                                 The default datastore is $APP_OBJECTS_DIR/logons.gdbm
+
+                                -timing Writes the time spent in each phase of the run to stderr as JSON. Also set
+                                                by $LOGONMGR_TIMING; $LOGONMGR_METRICS_FILE adds the run to a Prometheus textfile
                         """
 
 
@@ -699,11 +4339,17 @@ def register_help_commands():
                                                 'Updates one or more attributes for a logonmgr entry')
         command_help['rm-options'] = CommandHelp('rm-options','<connection_name> <optionname1> <optionname2> ... |ALL|all',
                                                 'removes one, more or all options from a dboptions dictionary for an entry')
-        command_help['list'] = CommandHelp('list','No arguments','Lists entries in logonmgr')
+        command_help['list'] = CommandHelp('list','[<pattern>|--prefix <prefix>] [--limit <n>] [--after <connection_name>]','Lists entries in logonmgr, '
+                                                'optionally only those matching a glob pattern (e.g. td_*) or starting with prefix, n at a time')
         command_help['show'] = CommandHelp('show','<connection_name>', 'Displays all attributes for a connection name. Displays the encrypted password.')
-        command_help['export'] = CommandHelp('export','<connection_name>|all','Exports logonmgr entry or all entries in pipe-delimited format')
-        command_help['gen-add-cmd'] = CommandHelp('gen-add-cmd','<connection_name>|all','Exports logonmgr entry or all entries in logonmgr add format')
-        command_help['load_from_textfile'] = CommandHelp('load_from_textfile','filename','Loads logonmgr datastore with entries exported via the export command. Expects same field order as in export command')
+        command_help['export'] = CommandHelp('export','[-j <n>] [<connection_name>|<pattern>|all|--prefix <prefix> [field1 field2 ...]]','Exports logonmgr entry, '
+                                                'the entries matching a glob pattern or starting with prefix, or all entries in pipe-delimited format, '
+                                                'optionally only the given fields. Passwords are decrypted by <n> worker processes')
+        command_help['gen-add-cmd'] = CommandHelp('gen-add-cmd','[-j <n>] <connection_name>|all','Exports logonmgr entry or all entries in logonmgr add format. '
+                                                'Passwords are decrypted by <n> worker processes')
+        command_help['load_from_textfile'] = CommandHelp('load_from_textfile','[-j <n>] filename','Loads logonmgr datastore with entries exported via the export command. Expects same field order as in export command. '
+                                                'Passwords are encrypted by <n> worker processes (default $LOGONMGR_JOBS or number of cpus)')
+        command_help['bulk_add'] = CommandHelp('bulk_add','[-j <n>] filename','Adds the entries in a file of add command arguments, one entry per line. Existing entries are rejected')
         for getter in getters:
                 command_help[getter] = CommandHelp(getter,'<connection_name>','Retrieves %s attribute for connection name' % getter)
         for auditor in auditors:
@@ -712,12 +4358,52 @@ def register_help_commands():
         command_help['help-commands'] = CommandHelp('help-commands','','Shows more detailed help for commands')
         command_help['info'] = CommandHelp('info','','Shows logonmgr version, number of entries, last date modified, location of db')
         command_help['help'] = CommandHelp('help','','Shows general usage')
+        command_help['get'] = CommandHelp('get','[-format shell|json|nul] [-attrs attr1,attr2,...] <connection_name>[:attr1,attr2,...] ...',
+                                                'Retrieves several attributes of several entries at once (default userid,password) as export VAR=value lines, '
+                                                'JSON or NUL-delimited name/attribute/value fields. Passwords are decrypted')
+        command_help['query'] = CommandHelp('query','<attr1=value1> [<attr2=value2> ...]','Shows the entries matching all of the given attribute values')
+        command_help['batch'] = CommandHelp('batch','[-n] < commands','Runs add, set, update, delete and rm-options command lines read from stdin '
+                                                'under one write lock as one transaction, committed only if every line succeeds. -n rolls back in any case')
+        command_help['stats'] = CommandHelp('stats','[-space]','Shows the number of entries per dbms and server, those without a password and the last update. '
+                                                '-space shows the size of the logons file against its live data, the gdbm bucket layout and the unused space compact gives back')
+        command_help['compact'] = CommandHelp('compact','[-in-place]','Rewrites the logons file without the space left by updates and deletes: copies it '
+                                                'while readers carry on and swaps it in under the write lock, or with -in-place reorganizes it under the write lock')
+        command_help['import_logons'] = CommandHelp('import_logons','[-j <n>] [-full] dbaccess|adwlogons','Imports the logons in $HOME/dbaccess or the ADW logon files '
+                                                'that changed since the last import, encrypting them in <n> worker processes. -full imports all of them again')
+        command_help['convert'] = CommandHelp('convert','sqlite|gdbm','Moves the logons file to the SQLite (WAL mode, a column per attribute) or the gdbm backend '
+                                                'by copy and swap. $LOGONMGR_BACKEND=sqlite makes new logons files SQLite')
+        command_help['rotate-keys'] = CommandHelp('rotate-keys','[-j <n>] [-bits <bits>]','Replaces the eiw_ctl key pair and data key with new ones and re-encrypts '
+                                                'the passwords in <n> worker processes, committing in small batches. Run it again to resume an interrupted rotation')
+        command_help['reindex'] = CommandHelp('reindex','','Rebuilds the secondary indexes used by the query command and the sorted name index used by list and export')
+        command_help['migrate-envelope'] = CommandHelp('migrate-envelope','[-j <n>]','Switches to envelope encryption: passwords are encrypted with a data key wrapped by the RSA key pair. '
+                                                'Re-encrypts existing passwords in place')
+        command_help['migrate-legacy'] = CommandHelp('migrate-legacy','[-j <n>] <old logons.db>','Copies the entries of an old shelve logons file, audit attributes '
+                                                'included. A logons file without entries takes over its keys; otherwise passwords are re-encrypted in <n> worker processes')
+        command_help['compile'] = CommandHelp('compile','','Writes a memory mapped snapshot (<logons file>.snap) that read commands use instead of the logons file '
+                                                'until the logons file changes again')
+        command_help['journal'] = CommandHelp('journal','[prune <seq>]','Shows the change journal segments and last sequence number, or removes the segments '
+                                                'holding only changes before <seq>')
+        command_help['replay'] = CommandHelp('replay','<source> [--since <seq>]','Applies the changes journaled by the logons file <source> (or a copy of its journal directory) '
+                                                'after <seq>, by default after the last change replayed from it')
+        command_help['diff'] = CommandHelp('diff','[-audit] <other logons file>|-export <export file>','Shows the entries only in this logons file, only in the other '
+                                                'one or export file and those whose fields differ, streaming both in connection name order and decrypting only the '
+                                                'passwords whose ciphertexts differ. -audit compares the audit trail attributes too')
+        command_help['sync'] = CommandHelp('sync','[-pull] [-dry-run] [-prefer local|remote|newer] <other logons file>','Synchronizes with another logons file, e.g. '
+                                                'a host-local copy with the central store, transferring only the entries changed on either side. Entries changed on both '
+                                                'sides are reported as conflicts unless -prefer says which side wins')
+        command_help['upgrade'] = CommandHelp('upgrade','[-n]','Rewrites the entries in the compact record format and reports size and decoding time before and after. '
+                                                '-n only reports')
+        command_help['serve'] = CommandHelp('serve','[socket_path]','Runs a resident lookup daemon on a Unix socket (default <logons file>.sock, or $LOGONMGR_SOCKET). '
+                                                'Read commands are answered by the daemon while it is running')
 
 def help_commands(args):
+        if not command_help:
+                register_help_commands()
         help_text = 'logonmgr commands:\n'
         for c in command_help:
                 help_text += '\n' + str(command_help[c]) + '\n'
 
+        import pydoc
         pydoc.pager(help_text)
 
 cmds = { 'list' : list, 'add' : add, 'delete' : delete, 'userid' : getattr,
@@ -727,48 +4413,280 @@ cmds = { 'list' : list, 'add' : add, 'delete' : delete, 'userid' : getattr,
                  'rm-options' : rm_options,
                  'create_userid' : getattr, 'last_updt_ts' : getattr, 'last_updt_userid' : getattr,
                  'export' : export, 'load_from_textfile' : load_from_textfile, 'help-commands' : help_commands ,
-                 'bulk_add' : bulk_add, 'help' : help_general, 'gen-add-cmd' : gen_add_cmd,'info' : info}
+                 'bulk_add' : bulk_add, 'help' : help_general, 'gen-add-cmd' : gen_add_cmd,'info' : info,
+                 'serve' : serve, 'reindex' : reindex, 'get' : get_values, 'migrate-envelope' : migrate_envelope,
+                 'upgrade' : upgrade, 'compile' : compile_snapshot, 'journal' : journal, 'replay' : replay,
+                 'sync' : sync, 'rotate-keys' : rotate_keys, 'batch' : batch,
+                 'stats' : stats, 'compact' : compact, 'convert' : convert, 'import_logons' : import_logons,
+                 'diff' : diff, 'migrate-legacy' : migrate_legacy}
 
 read_only_cmds = ['list','show','userid','server','password','dboptions',
-                                'query','export','database','dbms','create_userid','last_updt_ts','create_ts','last_updt_userid']
+                                'query','export','database','dbms','create_userid','last_updt_ts','create_ts','last_updt_userid',
+                                'serve','get','info','gen-add-cmd','compile','stats','diff']
+
+# read commands that look at the logons file itself, never the snapshot, when given the option
+file_options = {'stats' : '-space'}
+
+no_store_cmds = ['help','help-commands']
+
+# upper bounds in seconds of the command duration histogram buckets in the metrics textfile
+timing_buckets = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300]
+
+class PhaseTimer(object):
+        """ adds the wall time spent in a with block to one phase of a Timings """
+        def __init__(self,timings,phase):
+                self.timings = timings
+                self.phase = phase
+
+        def __enter__(self):
+                self.start = time.time()
+                return self
+
+        def __exit__(self,exc_type,exc_value,traceback):
+                self.timings.add(self.phase,time.time() - self.start)
+                if exc_type is SystemExit:
+                        self.timings.exit_status = exc_value.code if exc_value is not None else None
+                return False
+
+class NullTimer(object):
+        """ what timed() returns when timing is off, so instrumented code costs next to nothing """
+        def __enter__(self):
+                return self
+        def __exit__(self,exc_type,exc_value,traceback):
+                return False
+
+null_timer = NullTimer()
+
+def timed(phase):
+        """
+                with timed('phase'): ... counts the time spent in the block against phase when timing is on.
+                Phases may nest: command includes the keys and rsa time spent by the command.
+        """
+        if timings is None:
+                return null_timer
+        return PhaseTimer(timings,phase)
+
+def process_age():
+        """ seconds since this process was started, from /proc, or None where that is not available """
+        try:
+                stat_line = open('/proc/self/stat').read()
+                start_ticks = float(stat_line[stat_line.rindex(')') + 2:].split()[19])
+                uptime = float(open('/proc/uptime').read().split()[0])
+                return max(uptime - start_ticks / os.sysconf('SC_CLK_TCK'), 0.0)
+        except (IOError, OSError, ValueError, IndexError):
+                return None
+
+class Timings(object):
+        """
+                Wall time of the phases of one logonmgr run: startup (interpreter start until this module
+                runs), imports (this module), daemon, open (including lock_wait), keys, rsa, command and close.
+                Reported when the process exits, as a JSON line on stderr and/or added to the Prometheus
+                textfile $LOGONMGR_METRICS_FILE.
+        """
+        def __init__(self,to_stderr,metrics_file):
+                self.to_stderr = to_stderr
+                self.metrics_file = metrics_file
+                self.phases = {}
+                self.command = None
+                self.exit_status = None
+                now = time.time()
+                age = process_age()
+                # /proc counts in clock ticks, so startup is only known to about 10ms
+                if age is not None:
+                        self.phases['startup'] = max(age - (now - module_started), 0.0)
+                self.phases['imports'] = now - module_started
+                self.started = now - self.phases.get('startup',0.0) - self.phases['imports']
+                self.last = now
+
+        def add(self,phase,seconds):
+                self.phases[phase] = self.phases.get(phase,0.0) + seconds
+
+        def lap(self,phase):
+                """ counts the time since the previous lap, or since timing started, against phase """
+                now = time.time()
+                self.add(phase,now - self.last)
+                self.last = now
+
+        def report(self):
+                """ atexit handler """
+                total = time.time() - self.started
+                if store is not None and store.lock is not None and store.lock.waited:
+                        self.phases['lock_wait'] = store.lock.waited
+                exit_status = self.exit_status
+                if exit_status is None:
+                        exit_status = status
+                if not isinstance(exit_status,int):
+                        exit_status = 1
+                if self.to_stderr:
+                        import json
+                        sys.stdout.flush()
+                        sys.stderr.write(json.dumps({'command': self.command, 'status': exit_status,
+                                'total': round(total,6),
+                                'phases': dict([(p, round(s,6)) for (p, s) in self.phases.items()])},
+                                sort_keys=True) + '\n')
+                if self.metrics_file:
+                        try:
+                                update_metrics_file(self.metrics_file,self.command or 'none',exit_status,total,self.phases)
+                        except (IOError, OSError), e:
+                                sys.stderr.write("Unable to update %s: %s\n" % (self.metrics_file, e))
+
+def start_timings(flag):
+        """ turns timing on for -timing, $LOGONMGR_TIMING or $LOGONMGR_METRICS_FILE """
+        global timings
+        to_stderr = flag or bool(os.environ.get('LOGONMGR_TIMING'))
+        metrics_file = os.environ.get('LOGONMGR_METRICS_FILE')
+        if not (to_stderr or metrics_file):
+                return
+        import atexit
+        timings = Timings(to_stderr,metrics_file)
+        atexit.register(timings.report)
+
+metrics_sample = re.compile(r'^([a-zA-Z_:][a-zA-Z0-9_:]*)(\{(?:[^}"]|"(?:[^"\\]|\\.)*")*\})?\s+(\S+)\s*$')
+
+def escape_label(value):
+        """ a label value in the text exposition format: backslash, double quote and newline escaped """
+        return str(value).replace('\\','\\\\').replace('"','\\"').replace('\n','\\n')
+
+def read_metrics(path):
+        """ samples of a metrics textfile as a dictionary of (metric name, labels) -> value """
+        samples = {}
+        try:
+                lines = open(path).readlines()
+        except IOError:
+                return samples
+        for line in lines:
+                m = metrics_sample.match(line)
+                if m and not line.startswith('#'):
+                        try:
+                                samples[(m.group(1), m.group(2) or '')] = float(m.group(3))
+                        except ValueError:
+                                pass
+        return samples
+
+metrics_help = [('logonmgr_command_duration_seconds', 'histogram', 'Wall time of logonmgr runs by command'),
+                ('logonmgr_command_runs_total', 'counter', 'logonmgr runs by command and exit status'),
+                ('logonmgr_phase_seconds_total', 'counter', 'Wall time of logonmgr runs by command and phase')]
+
+def update_metrics_file(path,command,exit_status,total,phases):
+        """
+                Adds one run to the Prometheus textfile at path: a command duration histogram, runs by exit
+                status and seconds by phase. Concurrent runs serialize on <path>.lock and the file is replaced
+                by rename, so a textfile collector never reads it half written.
+        """
+        import fcntl
+        command = escape_label(command)
+        exit_status = escape_label(exit_status)
+        lock = open(path + '.lock','a')
+        try:
+                fcntl.lockf(lock,fcntl.LOCK_EX)
+                samples = read_metrics(path)
+                def count(name,labels,value):
+                        samples[(name, labels)] = samples.get((name, labels),0.0) + value
+                histogram = 'logonmgr_command_duration_seconds'
+                for bound in timing_buckets:
+                        count(histogram + '_bucket','{command="%s",le="%s"}' % (command, bound),total <= bound and 1 or 0)
+                count(histogram + '_bucket','{command="%s",le="+Inf"}' % command,1)
+                count(histogram + '_sum','{command="%s"}' % command,total)
+                count(histogram + '_count','{command="%s"}' % command,1)
+                count('logonmgr_command_runs_total','{command="%s",status="%s"}' % (command, exit_status),1)
+                for (phase, seconds) in phases.items():
+                        count('logonmgr_phase_seconds_total','{command="%s",phase="%s"}' % (command, escape_label(phase)),seconds)
+
+                def bucket_order(sample):
+                        (name, labels) = sample
+                        le = re.search(r'le="([^"]*)"',labels)
+                        if le is None:
+                                return (name, labels, 0)
+                        return (name, labels[:le.start()], le.group(1) == '+Inf' and float('inf') or float(le.group(1)))
+                out = []
+                for (metric, kind, desc) in metrics_help:
+                        out.append('# HELP %s %s\n# TYPE %s %s\n' % (metric, desc, metric, kind))
+                        for sample in sorted([k for k in samples if k[0] == metric or k[0].startswith(metric + '_')],key=bucket_order):
+                                value = samples[sample]
+                                if value == int(value):
+                                        value = int(value)
+                                out.append('%s%s %r\n' % (sample[0], sample[1], value))
+                tmp = '%s.%d.tmp' % (path, os.getpid())
+                f = open(tmp,'w')
+                f.write(''.join(out))
+                f.close()
+                os.rename(tmp,path)
+        finally:
+                lock.close()
 
 def init():
         """
                 Initialize logonmgr variables
         """
-        global logons_dir, dbpath, db
+        global logons_dir, dbpath
         logons_dir = os.environ.get('APP_OBJECTS_DIR',None)
         if logons_dir:
                 dbpath = logons_dir + '/logons.gdbm' #set default dbpath to APP_OBJECTS_DIR/logons.gdbm
         else:
                 dbpath = "UNKNOWN"      # if APP_OBJECTS_DIR nonexistant then -f or -l must be used below
 
-def create_logons_gdbm(old_dbpath):
+def legacy_path(path):
+        """ path of the old shelve logons.db a new logons.gdbm at path is migrated from, None if path is not a logons.gdbm """
+        old_dbpath = path.replace('/logons.gdbm','/logons.db')
+        if old_dbpath == path:
+                return None
+        return old_dbpath
+
+def create_logons_gdbm(old_dbpath,jobs=1):
         """
         this function is called when the batchID or developer has an old logons.db file but there is not a new logons.gdbm file
-        this function will create a new logons.gdbm in a non-proprietary format using the export file from the old one logons.db
-        """
-        print "Creating a new logons.gdbm in a non- proprietary format using the export file from the old logons.db"
-        exp_file = old_dbpath + ".exp"
-        cmd="logonmgr.old -f %s export | sort > %s" % (old_dbpath, exp_file)
-        status,output = commands.getstatusoutput(cmd)
-        if status or output != "":
-                print "  *** ERROR  -  logonmgr.old export FAILED ***"
-                print output
-                print status
-                sys.exit(1)
-
-        load_from_textfile(("dummy",exp_file))
-        os.remove(exp_file)
-
+        this function copies the entries of the old shelve file into the logons file in this process, audit attributes included.
+        A logons file without entries takes over the old eiw_ctl keys, so the encrypted passwords are copied as they are;
+        otherwise they are re-encrypted with its keys by <jobs> worker processes and entries it already has are skipped.
+        Returns the number of entries copied and skipped
+        """
+        import anydbm
+        old = anydbm.open(old_dbpath,'r')
+        try:
+                old_keys = unpickle(old['eiw_ctl'])
+                carry_keys = store.count() == 0 and not store.db.has_key('__datakey__')
+                names = sorted([key for key in old.keys() if not is_internal_key(key)])
+                def records():
+                        for name in names:
+                                yield (name, old[name])
+                if carry_keys:
+                        print "Copying %d entries from %s with its keys" % (len(names), old_dbpath)
+                        store._store('eiw_ctl',old_keys)
+                        store._keys = None
+                        results = ((name, record, None) for (name, record) in records())
+                else:
+                        print "Copying %d entries from %s, re-encrypting the passwords" % (len(names), old_dbpath)
+                        store.end_write()       # the worker processes must not inherit the write lock
+                        keys = KeyRing(store._load('eiw_ctl'),store._load('__datakey__'),KeyRing(old_keys))
+                        results = parallel_map(rotate_records,records(),jobs,keys)
+                count = 0
+                skipped = 0
+                batch = {}
+                progress = Progress('migrated')
+                for (name, record, entry) in results:
+                        progress.tick()
+                        if entry is None:
+                                entry = decode_record(record)   # carried over, or no password to re-encrypt
+                        if not carry_keys and entry.name in store:
+                                skipped = skipped + 1
+                                continue
+                        store.put(entry,batch)
+                        count = count + 1
+                        if count % 1000 == 0:
+                                store.flush(batch)
+                                store.end_write()       # let waiting readers in between batches
+                store.flush(batch)
+                store.sync()
+                progress.report()
+        finally:
+                old.close()
+        return count, skipped
 
 #######   MAINLINE   ########
 
 #validate parms
 if __name__ == "__main__":
 
-        register_help_commands()
-
         if len(sys.argv) < 2:
                 help_general(0)
                 sys.exit(1)
@@ -781,6 +4699,15 @@ if __name__ == "__main__":
         # process options
         ########################
 
+        # -timing reports the time spent in each phase of this run on stderr
+        timing_flag = args[1] == '-timing'
+        if timing_flag:
+                del args[1]
+        start_timings(timing_flag)
+        if len(args) < 2:
+                help_general(0)
+                sys.exit(1)
+
         # check for -version option
         if args[1] == '-version':
                 print version
@@ -794,9 +4721,8 @@ if __name__ == "__main__":
                 if os.path.exists(dbpath + '.' + hostname):
                         dbpath = dbpath + '.' + hostname
                 del args[1]
-                cmd="grep `whoami` /etc/passwd | cut -d':' -f6 | grep ^/home"
-                status,output = commands.getstatusoutput(cmd)
-                if output == "" or status:
+                import pwd
+                if not pwd.getpwuid(os.geteuid()).pw_dir.startswith('/home'):
                         print "FATAL ERROR - -l option NOT available to BatchIDs"
                         sys.exit(1)
                 if len(args) < 2:
@@ -811,16 +4737,33 @@ if __name__ == "__main__":
                 dbpath = args[2]
                 del args[1:3]
 
-        if dbpath == "UNKNOWN":
-                print "FATAL ERROR - You MUST have APP_OBJECTS_DIR set or use -f or -l option to point to logons file"
-                sys.exit(2)
-
         cmd = args[1]
+        if timings is not None:
+                timings.command = cmd in cmds and cmd or 'invalid'
+                timings.lap('options')
 
         if cmd not in cmds:
                 print cmd + " is invalid."
                 help_general(0)
-                sys.exit(3)
+                status = 3
+                sys.exit(status)
+
+        #help does not need the logons file
+        if cmd in no_store_cmds:
+                cmds[cmd](args[1:])
+                sys.exit(status)
+
+        if dbpath == "UNKNOWN":
+                print "FATAL ERROR - You MUST have APP_OBJECTS_DIR set or use -f or -l option to point to logons file"
+                status = 2
+                sys.exit(status)
+
+        #answer read commands from a running lookup daemon if there is one
+        if cmd in served_cmds and not os.environ.get('LOGONMGR_NO_DAEMON'):
+                with timed('daemon'):
+                        served_status = client_request(args[1:])
+                        if served_status is not None:
+                                sys.exit(served_status)
 
         #open for read or read-write access depending on cmd
         #       unless file does not exist then create it.
@@ -830,29 +4773,40 @@ if __name__ == "__main__":
                 print "Creating new file: " + dbpath
                 open_flag = 'c'
 
-        #Initialize encryption keys if they don't exist
-        try:
-                db = shelve.open(dbpath,flag=open_flag,protocol=-1)
-        except Exception, e:
-                print "Unable to open %s:" % dbpath , e
-                sys.exit(4)
-
-        eiw_ctl = db.get('eiw_ctl',None)
+        with timed('open'):
+                try:
+                        cached = None
+                        snapshot = file_options.get(cmd) not in args[1:]
+                        if open_flag == 'r' and snapshot:
+                                cached = open_cache(dbpath)
+                        store = LogonStore(dbpath,open_flag,db=cached,snapshot=snapshot)
+                except Exception, e:
+                        print "Unable to open %s:" % dbpath , e
+                        sys.exit(4)
 
-        if eiw_ctl == None:
-                (pubkey, privkey) = rsa.newkeys(512)
-                eiw_ctl = [(pubkey), (privkey)]
-                print 'new eiw_ctl'
-                db['eiw_ctl'] = eiw_ctl
-#               if creating new logons.gdbm and and old logons.db exists in same path then call create_logons_gdbm to copy all entries
-                old_dbpath = dbpath.replace('/logons.gdbm','/logons.db')
-                if os.path.exists(old_dbpath):
-                        create_logons_gdbm(old_dbpath)
-                        print
-                        #cmd_ls="ls -l $HOME/logons*"
-                        #status,output = commands.getstatusoutput(cmd_ls)
-                        #print output
-                        #print status
-
-        cmds[cmd](args[1:])
+        # changes a failing command made are committed, and journaled, as far as they got
+        try:
+                with timed('command'):
+                        try:
+                                #Initialize encryption keys if they don't exist
+                                if open_flag != 'r' and store.init_keys():
+                                        print 'new eiw_ctl'
+#                                       if creating new logons.gdbm and and old logons.db exists in same path then call create_logons_gdbm to copy all entries
+                                        old_dbpath = legacy_path(dbpath)
+                                        if old_dbpath is not None and os.path.exists(old_dbpath):
+                                                count, skipped = create_logons_gdbm(old_dbpath,jobs_option([]))
+                                                print "Migrated %d entries from %s" % (count, old_dbpath)
+                                                print
+                                                #cmd_ls="ls -l $HOME/logons*"
+                                                #status,output = commands.getstatusoutput(cmd_ls)
+                                                #print output
+                                                #print status
+
+                                cmds[cmd](args[1:])
+                        except LockTimeout, e:
+                                sys.stderr.write("Unable to update %s: %s\n" % (dbpath, e))
+                                sys.exit(4)
+        finally:
+                with timed('close'):
+                        store.close()
         sys.exit(status)
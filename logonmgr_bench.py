@@ -0,0 +1,400 @@
+#!/usr/bin/env python
+######################################################################################
+# logonmgr_bench - timing checks for logonmgr
+#
+# logonmgr_bench [-logonmgr <path to logonmgr.py>] <check> <args>
+#
+#       checks:
+#
+#       startup [-runs n] [-max-ms ms]
+#        Measures the cold-start latency of the list and userid commands against a
+#        scratch logons file, each run in a new interpreter as batch jobs do.
+#        Fails (exit 1) if the median latency of a command is above -max-ms (default 150)
+#        or if a command imports modules it should not need (rsa, pydoc, the daemon and
+#        worker pool modules).
+#
+#       commands [-sizes 1000,10000,100000,1000000] [-runs n] [-cmds cmd1,cmd2,...] [-dir path] [-o file]
+#        Generates synthetic logons files of each size (real ConnectionEntry records, eiw_ctl keys
+#        and indexes; kept in -dir, default $TMPDIR/logonmgr_bench, and reused until the logonmgr
+#        version or the generated layout changes) and times each command with a warm and a cold
+#        page cache. Commands: list, query, export, userid, get, add, load_from_textfile, info.
+#        add and load_from_textfile run on a fresh copy of the logons file each time, so they leave
+#        the kept one as generated.
+#        One JSON object per size, command and cache state
+#        is written to stdout (and appended to -o): median/p90/max milliseconds and, for commands
+#        that process many entries, entries per second.
+#        The cold runs evict the logons file from the page cache with posix_fadvise first.
+#
+#       rotate [-entries n]
+#        Rotates the keys of a scratch logons file of n entries (default 3000, several name index
+#        pages): once interrupted and resumed, then once straight through. Fails (exit 1) unless
+#        every rotation finishes with the passwords unchanged and no rotation left in progress.
+#
+#       compare [-threshold ratio] <baseline results> <new results>
+#        Compares two result files of the commands check and fails (exit 1) if any median got
+#        slower than ratio (default 1.25) times the baseline.
+#
+# The logonmgr.py next to this script is used unless -logonmgr is given.
+######################################################################################
+
+import sys, os, time, subprocess, tempfile, shutil, json, imp
+
+startup_cmds = [['list'], ['userid','conn00001']]
+
+# changed when generate_store fills the entries differently, so kept logons files are generated again
+generated_layout = 2
+
+# modules that list and userid must not import
+heavy_modules = ['rsa','pydoc','SocketServer','multiprocessing','glob','commands','pipes']
+
+module_probe = """
+import sys, runpy
+sys.argv = [%(script)r, '-f', %(dbpath)r] + %(args)r
+try:
+        runpy.run_path(%(script)r, run_name='__main__')
+except SystemExit:
+        pass
+sys.stderr.write(repr([m for m in %(heavy)r if m in sys.modules]) + '\\n')
+"""
+
+class Scratch(object):
+        """ a temporary directory holding a runnable copy of logonmgr.py and a logons file """
+        def __init__(self,logonmgr_path,entries=100):
+                self.dir = tempfile.mkdtemp(prefix='logonmgr_bench.')
+                self.script = os.path.join(self.dir,'logonmgr.py')
+                self.dbpath = os.path.join(self.dir,'logons.gdbm')
+                shutil.copy(logonmgr_path,self.script)
+                export_file = os.path.join(self.dir,'entries.txt')
+                f = open(export_file,'w')
+                for i in range(entries):
+                        f.write('conn%05d|user%d|pw%d|server%d|teradata|db%d\n' % (i, i, i, i % 10, i))
+                f.close()
+                self.run(['load_from_textfile','-j','1',export_file])
+
+        def env(self):
+                env = dict(os.environ)
+                env['LOGONMGR_NO_DAEMON'] = '1'
+                env.setdefault('USER','logonmgr_bench')
+                return env
+
+        def run(self,args):
+                """ runs logonmgr in a new interpreter, returns the elapsed seconds """
+                devnull = open(os.devnull,'w')
+                start = time.time()
+                rc = subprocess.call([sys.executable,self.script,'-f',self.dbpath] + args,stdout=devnull,stderr=devnull,env=self.env())
+                elapsed = time.time() - start
+                devnull.close()
+                if rc:
+                        raise RuntimeError("logonmgr %s failed with status %d" % (' '.join(args), rc))
+                return elapsed
+
+        def output(self,args):
+                """ runs logonmgr in a new interpreter, returns its exit status and standard output """
+                p = subprocess.Popen([sys.executable,self.script,'-f',self.dbpath] + args,stdout=subprocess.PIPE,stderr=open(os.devnull,'w'),env=self.env())
+                out = p.communicate()[0]
+                return (p.returncode, out)
+
+        def imported(self,args):
+                """ heavy modules imported while running a command """
+                probe = module_probe % {'script' : self.script, 'dbpath' : self.dbpath, 'args' : args, 'heavy' : heavy_modules}
+                p = subprocess.Popen([sys.executable,'-c',probe],stdout=open(os.devnull,'w'),stderr=subprocess.PIPE,env=self.env())
+                err = p.communicate()[1]
+                return eval(err.strip().splitlines()[-1])
+
+        def remove(self):
+                shutil.rmtree(self.dir,True)
+
+def percentile(values,p):
+        values = sorted(values)
+        return values[min(int(len(values) * p),len(values) - 1)]
+
+def startup(logonmgr_path,args):
+        """ cold-start latency check for list and userid """
+        runs = 20
+        max_ms = 150.0
+        while args:
+                if args[0] == '-runs':
+                        runs = int(args[1])
+                elif args[0] == '-max-ms':
+                        max_ms = float(args[1])
+                else:
+                        sys.stderr.write("Unknown option %s\n" % args[0])
+                        return 2
+                del args[0:2]
+
+        scratch = Scratch(logonmgr_path)
+        failed = False
+        results = []
+        try:
+                for cmd in startup_cmds:
+                        scratch.run(cmd)        # warm the page cache for the interpreter and the file
+                        times = [scratch.run(cmd) * 1000 for i in range(runs)]
+                        modules = scratch.imported(cmd)
+                        median = percentile(times,0.5)
+                        result = {'check' : 'startup', 'command' : ' '.join(cmd), 'runs' : runs,
+                                  'median_ms' : round(median,2), 'p90_ms' : round(percentile(times,0.9),2),
+                                  'max_ms' : round(max(times),2), 'bound_ms' : max_ms, 'heavy_imports' : modules}
+                        result['ok'] = median <= max_ms and not modules
+                        failed = failed or not result['ok']
+                        results.append(result)
+        finally:
+                scratch.remove()
+
+        for result in results:
+                print json.dumps(result,sort_keys=True)
+        return failed and 1 or 0
+
+def rotate(logonmgr_path,args):
+        """ key rotation of a logons file with several name index pages, straight and resumed """
+        entries = 3000
+        if args and args[0] == '-entries':
+                entries = int(args[1])
+                del args[0:2]
+        scratch = Scratch(logonmgr_path,entries)
+        results = []
+        try:
+                (rc, before) = scratch.output(['export'])
+                for interrupt in (True, False):         # the first rotation, from the RSA keys, is the slow one
+                        result = {'check' : 'rotate', 'entries' : entries, 'interrupted' : interrupt}
+                        if interrupt:
+                                import signal
+                                p = subprocess.Popen([sys.executable,scratch.script,'-f',scratch.dbpath,'rotate-keys'],
+                                        stdout=open(os.devnull,'w'),stderr=open(os.devnull,'w'),env=scratch.env())
+                                while p.poll() is None and 'Key rotation' not in scratch.output(['info'])[1]:
+                                        time.sleep(0.05)
+                                time.sleep(0.5)         # into the re-encryption, past a commit or two
+                                if p.poll() is None:
+                                        p.send_signal(signal.SIGINT)
+                                p.wait()
+                                result['in_progress'] = 'Key rotation' in scratch.output(['info'])[1]
+                        (rc, out) = scratch.output(['rotate-keys'])
+                        result['status'] = rc
+                        result['passwords_kept'] = scratch.output(['export'])[1] == before
+                        result['finished'] = 'Key rotation' not in scratch.output(['info'])[1]
+                        result['ok'] = rc == 0 and result['passwords_kept'] and result['finished']
+                        results.append(result)
+        finally:
+                scratch.remove()
+
+        for result in results:
+                print json.dumps(result,sort_keys=True)
+        return not all([result['ok'] for result in results]) and 1 or 0
+
+def load_logonmgr(path):
+        """ logonmgr as a module, for generating logons files through its LogonStore """
+        return imp.load_source('logonmgr',path)
+
+def generate_store(logonmgr,path,size):
+        """ a logons file of size entries shaped like production ones """
+        os.environ.setdefault('USER','logonmgr_bench')
+        journaling = os.environ.get('LOGONMGR_NO_JOURNAL')
+        os.environ['LOGONMGR_NO_JOURNAL'] = '1'        # a generated file has no history to replicate
+        try:
+                store = logonmgr.LogonStore(path,'c')
+        finally:
+                if journaling is None:
+                        del os.environ['LOGONMGR_NO_JOURNAL']
+                else:
+                        os.environ['LOGONMGR_NO_JOURNAL'] = journaling
+        store.init_keys()
+        dbms = ['teradata','oracle','db2','sqlserver']
+        batch = {}
+        for i in xrange(size):
+                password = store.encrypt_password('secret%d' % i)
+                entry = logonmgr.ConnectionEntry('conn%07d' % i,userid='user%d' % i,password=password,
+                                server='server%d' % (i % 50),database='db%d' % (i % 500),dbms=dbms[i % 4])
+                if i % 10 == 0:
+                        entry.dboptions = {'charset' : 'UTF8', 'tmode' : 'ANSI'}
+                store.put(entry,batch)
+                if i % 10000 == 9999:
+                        store.flush(batch)
+                        store.end_write()
+        store.flush(batch)
+        store.close()
+
+def evict(paths):
+        """ drops files from the page cache; returns False where posix_fadvise is not available """
+        try:
+                import ctypes, ctypes.util
+                libc = ctypes.CDLL(ctypes.util.find_library('c'),use_errno=True)
+                fadvise = libc.posix_fadvise
+        except (ImportError, OSError, AttributeError):
+                return False
+        for path in paths:
+                if os.path.isfile(path):
+                        fd = os.open(path,os.O_RDONLY)
+                        try:
+                                fadvise(fd,ctypes.c_longlong(0),ctypes.c_longlong(0),4)        # POSIX_FADV_DONTNEED
+                        finally:
+                                os.close(fd)
+        return True
+
+def store_files(path):
+        directory = os.path.dirname(path)
+        return [os.path.join(directory,f) for f in os.listdir(directory) if f.startswith(os.path.basename(path))]
+
+def copy_store(path,directory):
+        """ a fresh copy of the logons file at path and the files next to it, in directory """
+        shutil.rmtree(directory,True)
+        os.makedirs(directory)
+        for f in store_files(path):
+                if os.path.isfile(f):
+                        shutil.copy2(f,directory)
+        return os.path.join(directory,os.path.basename(path))
+
+# command arguments for a logons file of size entries and run i, whether it processes all entries
+# and whether it changes the logons file (and so runs on a fresh copy)
+bench_cmds = {
+        'list' :                (lambda size,i: ['list'], True, False),
+        'query' :               (lambda size,i: ['query','dbms=teradata','server=server%d' % (i % 50 // 4 * 4)], False, False),
+        'export' :              (lambda size,i: ['export'], True, False),
+        'userid' :              (lambda size,i: ['userid','conn%07d' % (i * 7919 % size)], False, False),
+        'get' :                 (lambda size,i: ['get','conn%07d' % (i % size),'conn%07d:userid,server' % ((i + 1) % size)], False, False),
+        'add' :                 (lambda size,i: ['add','bench_add_%d' % i,'userid=u','password=p','dbms=teradata'], False, True),
+        'load_from_textfile' :  (lambda size,i: ['load_from_textfile',load_file], False, True),
+        'info' :                (lambda size,i: ['info'], False, False),
+}
+load_file = None
+load_lines = 1000
+
+def commands(logonmgr_path,args):
+        """ latency and throughput of the commands on generated logons files """
+        global load_file
+        sizes = [1000,10000,100000,1000000]
+        runs = 5
+        cmd_names = ['list','query','export','userid','get','add','load_from_textfile','info']
+        directory = os.path.join(tempfile.gettempdir(),'logonmgr_bench')
+        output = None
+        while args:
+                if args[0] == '-sizes':
+                        sizes = [int(n) for n in args[1].split(',')]
+                elif args[0] == '-runs':
+                        runs = int(args[1])
+                elif args[0] == '-cmds':
+                        cmd_names = args[1].split(',')
+                elif args[0] == '-dir':
+                        directory = args[1]
+                elif args[0] == '-o':
+                        output = args[1]
+                else:
+                        sys.stderr.write("Unknown option %s\n" % args[0])
+                        return 2
+                del args[0:2]
+        for name in cmd_names:
+                if name not in bench_cmds:
+                        sys.stderr.write("Unknown command %s\n" % name)
+                        return 2
+
+        if not os.path.isdir(directory):
+                os.makedirs(directory)
+        script = os.path.join(directory,'logonmgr.py')
+        shutil.copy(logonmgr_path,script)
+        load_file = os.path.join(directory,'load.txt')
+        f = open(load_file,'w')
+        for i in range(load_lines):
+                f.write('bench_load%05d|user%d|pw%d|server%d|teradata|db%d\n' % (i, i, i, i % 50, i % 500))
+        f.close()
+        logonmgr = load_logonmgr(script)
+        version = subprocess.Popen([sys.executable,script,'-version'],stdout=subprocess.PIPE).communicate()[0].strip()
+
+        env = dict(os.environ)
+        env['LOGONMGR_NO_DAEMON'] = '1'
+        env.setdefault('USER','logonmgr_bench')
+        devnull = open(os.devnull,'w')
+        out = output and open(output,'a')
+        for size in sizes:
+                size_dir = os.path.join(directory,'size%d' % size)
+                dbpath = os.path.join(size_dir,'logons.gdbm')
+                version_file = os.path.join(size_dir,'version')
+                stamp = '%s layout %d' % (version, generated_layout)
+                if not os.path.exists(version_file) or open(version_file).read() != stamp:
+                        # generated by another logonmgr version, which may lay the file out differently
+                        shutil.rmtree(size_dir,True)
+                        os.makedirs(size_dir)
+                        start = time.time()
+                        generate_store(logonmgr,dbpath,size)
+                        f = open(version_file,'w')
+                        f.write(stamp)
+                        f.close()
+                        sys.stderr.write("generated %d entries in %.1fs\n" % (size, time.time() - start))
+                for name in cmd_names:
+                        (cmd_args, all_entries, changes) = bench_cmds[name]
+                        run_path = dbpath
+                        for cache in ('warm','cold'):
+                                times = []
+                                for i in range(runs):
+                                        if cache == 'warm' and i == 0:
+                                                if changes:
+                                                        run_path = copy_store(dbpath,os.path.join(directory,'work'))
+                                                subprocess.call([sys.executable,script,'-f',run_path] + cmd_args(size,runs),stdout=devnull,stderr=devnull,env=env)
+                                        if changes:
+                                                run_path = copy_store(dbpath,os.path.join(directory,'work'))
+                                        if cache == 'cold' and not evict(store_files(run_path) + [script]):
+                                                break
+                                        start = time.time()
+                                        rc = subprocess.call([sys.executable,script,'-f',run_path] + cmd_args(size,i),stdout=devnull,stderr=devnull,env=env)
+                                        times.append((time.time() - start) * 1000)
+                                        if rc:
+                                                sys.stderr.write("%s failed with status %d on %s\n" % (name, rc, run_path))
+                                if not times:
+                                        continue
+                                median = percentile(times,0.5)
+                                result = {'check' : 'commands', 'version' : version, 'size' : size, 'command' : name, 'cache' : cache,
+                                          'runs' : len(times), 'median_ms' : round(median,2), 'p90_ms' : round(percentile(times,0.9),2),
+                                          'max_ms' : round(max(times),2)}
+                                if all_entries:
+                                        result['entries_per_s'] = round(size / (median / 1000),1)
+                                elif name == 'load_from_textfile':
+                                        result['entries_per_s'] = round(load_lines / (median / 1000),1)
+                                line = json.dumps(result,sort_keys=True)
+                                print line
+                                sys.stdout.flush()
+                                if out:
+                                        out.write(line + '\n')
+        shutil.rmtree(os.path.join(directory,'work'),True)
+        devnull.close()
+        if out:
+                out.close()
+        return 0
+
+def compare(logonmgr_path,args):
+        """ regressions of the median latencies between two results files """
+        threshold = 1.25
+        if args and args[0] == '-threshold':
+                threshold = float(args[1])
+                del args[0:2]
+        if len(args) != 2:
+                sys.stderr.write("Usage: logonmgr_bench compare [-threshold ratio] <baseline results> <new results>\n")
+                return 2
+        def results(path):
+                r = {}
+                for line in open(path):
+                        if line.strip():
+                                result = json.loads(line)
+                                if result.get('check') == 'commands':
+                                        r[(result['size'],result['command'],result['cache'])] = result
+                return r
+        baseline = results(args[0])
+        new = results(args[1])
+        failed = False
+        for key in sorted(set(baseline) & set(new)):
+                ratio = new[key]['median_ms'] / max(baseline[key]['median_ms'],0.001)
+                ok = ratio <= threshold
+                failed = failed or not ok
+                print json.dumps({'check' : 'compare', 'size' : key[0], 'command' : key[1], 'cache' : key[2],
+                                  'baseline_ms' : baseline[key]['median_ms'], 'new_ms' : new[key]['median_ms'],
+                                  'ratio' : round(ratio,3), 'ok' : ok},sort_keys=True)
+        return failed and 1 or 0
+
+checks = { 'startup' : startup, 'commands' : commands, 'rotate' : rotate, 'compare' : compare }
+
+if __name__ == "__main__":
+        args = sys.argv[1:]
+        logonmgr_path = os.path.join(os.path.dirname(os.path.abspath(__file__)),'logonmgr.py')
+        if args and args[0] == '-logonmgr':
+                logonmgr_path = args[1]
+                del args[0:2]
+        if not args or args[0] not in checks:
+                print "usage: logonmgr_bench [-logonmgr <path to logonmgr.py>] %s <args>" % '|'.join(sorted(checks.keys()))
+                sys.exit(2)
+        sys.exit(checks[args[0]](logonmgr_path,args[1:]))